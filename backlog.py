@@ -0,0 +1,199 @@
+import random
+import logging
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from telegram import Update
+from telegram.ext import Application
+from chat_registry import ChatRegistry
+from state_manager import StateManager
+from message_manager import MessageManager
+from send_dispatcher import SendDispatcher
+from metrics import COMMANDS, NEW_PARTICIPANTS, RATE_LIMITED
+import handlers
+from config import BACKLOG_MAX_AGE, BACKLOG_MAX_UPDATES, BACKLOG_MIN_UPDATES
+
+logger = logging.getLogger(__name__)
+
+# Telegram отдаёт не больше 100 обновлений за один getUpdates
+PAGE_SIZE = 100
+
+async def fetch_backlog(application: Application, webhook: bool,
+                        max_updates: int = BACKLOG_MAX_UPDATES,
+                        min_updates: int = BACKLOG_MIN_UPDATES) -> List[Update]:
+    """
+    Забирает накопившиеся за время сна обновления пачками getUpdates.
+
+    В режиме вебхука getUpdates недоступен, поэтому при достаточно большой
+    очереди (pending_update_count >= min_updates) вебхук снимается без потери
+    обновлений; run_webhook установит его заново. Последняя страница не
+    подтверждается до вызова confirm_backlog.
+    """
+    bot = application.bot
+    if webhook:
+        info = await bot.get_webhook_info()
+        if info.pending_update_count < min_updates:
+            return []
+        logger.info(f"Ожидает обновлений: {info.pending_update_count}, забираем их одной пачкой.")
+        await bot.delete_webhook(drop_pending_updates=False)
+
+    updates: List[Update] = []
+    offset: Optional[int] = None
+    while len(updates) < max_updates:
+        # Запрос со следующим offset подтверждает предыдущую страницу
+        page = await bot.get_updates(offset=offset, limit=PAGE_SIZE, timeout=0,
+                                     allowed_updates=Update.ALL_TYPES)
+        updates.extend(page)
+        if len(page) < PAGE_SIZE:
+            break
+        offset = page[-1].update_id + 1
+    return updates
+
+async def confirm_backlog(application: Application, updates: List[Update]) -> None:
+    """
+    Подтверждает обработанные обновления, чтобы Telegram не прислал их снова.
+    Обновления, пришедшие за это время, остаются неподтверждёнными.
+    """
+    if updates:
+        await application.bot.get_updates(offset=updates[-1].update_id + 1, limit=1, timeout=0)
+
+def is_stale(update: Update, now: datetime, max_age: float) -> bool:
+    """
+    Слишком ли старо обновление, чтобы на него отвечать.
+    """
+    message = update.effective_message
+    if max_age <= 0 or message is None or message.date is None:
+        return False
+    return (now - message.date).total_seconds() > max_age
+
+async def coalesce_posts(application: Application, posts: List[Tuple[Update, Optional[str]]],
+                         state_manager: StateManager, registry: ChatRegistry, message_manager: MessageManager,
+                         dispatcher: SendDispatcher) -> None:
+    """
+    Выполняет только первую из накопившихся команд /post чата, а на остальные
+    отвечает одним сообщением уставшего бота со сводкой.
+    """
+    first, category = posts[0]
+    for _, requested in posts:
+        COMMANDS.inc(requested or "any")
+    user_id = str(first.effective_user.id) if first.effective_user else ""
+    rejected = len(posts) - 1
+    wait = handlers.rate_limiter.acquire(state_manager, user_id, category or "any")
+    if wait == 0:
+        chat_id = first.effective_chat.id
+        if category is None:
+            await handlers.post_any(chat_id, first.message.reply_text, state_manager, message_manager,
+                                    registry, dispatcher)
+        else:
+            await handlers.post_message(chat_id, first.message.reply_text, state_manager, message_manager,
+                                        category, registry, dispatcher)
+        wait = handlers.rate_limiter.time_until_allowed(state_manager, user_id, category or "any")
+    else:
+        rejected += 1
+    if not rejected or wait <= 0:
+        return
+    RATE_LIMITED.inc(amount=rejected)
+    tired_message = random.choice(handlers.TIRED_BOT_MESSAGES).format(time=handlers.format_time_left(wait))
+    last = posts[-1][0]
+    await last.message.reply_text(f"{tired_message}\n\n(Пока бот спал, команду /post прислали {len(posts)} раз.)")
+
+async def process_chat(application: Application, chat_updates: List[Update], username: str,
+                       registry: ChatRegistry, message_manager: MessageManager, dispatcher: SendDispatcher,
+                       passthrough: List[Update], stats: Dict[str, int]) -> None:
+    """
+    Обрабатывает текстовые обновления одного чата из очереди после сна
+    (см. process_backlog). Обновления для обычных обработчиков добавляются в passthrough.
+    """
+    posts: List[Tuple[Update, Optional[str]]] = []
+    async with registry.acquire(chat_updates[0].effective_chat.id) as state_manager:
+        for update in chat_updates:
+            message = update.message
+            if not message.text.startswith("/"):
+                at = message.date.timestamp() if message.date else None
+                if message.from_user and state_manager.add_participant(
+                        str(message.from_user.id), handlers.participant_link(message.from_user), at):
+                    NEW_PARTICIPANTS.inc()
+                    stats["participants"] += 1
+                continue
+            mention = handlers.command_mention(message.text)
+            if mention is not None and mention.lower() != username:
+                # Команда другому боту в группе: обычный CommandHandler её тоже не обработал бы
+                stats["foreign"] += 1
+                continue
+            command = handlers.parse_command(message.text)
+            category = command.replace("post_", "").lower() if command.startswith("post_") else None
+            if command == "post" or (category is not None and category in message_manager.categories):
+                posts.append((update, category))
+            else:
+                passthrough.append(update)
+        if posts:
+            stats["posts"] += len(posts)
+            await coalesce_posts(application, posts, state_manager, registry, message_manager, dispatcher)
+        # Все изменения шарда — одной записью
+        await state_manager.flush()
+
+async def process_backlog(application: Application, updates: List[Update], registry: ChatRegistry,
+                          message_manager: MessageManager, dispatcher: SendDispatcher,
+                          max_age: float = BACKLOG_MAX_AGE) -> Dict[str, int]:
+    """
+    Обрабатывает накопившиеся обновления пачкой:
+    - обновления старше max_age секунд отбрасываются;
+    - команды, адресованные другому боту (/post@other_bot), пропускаются, как это
+      делает CommandHandler;
+    - новые участники и активность известных учитываются разом и сохраняются одной записью на шард;
+    - команды /post одного чата сворачиваются в одну отправку и один ответ со сводкой;
+    - остальное (/help, неизвестные команды и т.п.) проходит через обычные обработчики.
+    Ошибка в одном чате записывается в журнал и не мешает обработать остальные.
+    Returns:
+        Статистика для журнала.
+    """
+    now = datetime.now(timezone.utc)
+    stats = {"updates": len(updates), "stale": 0, "foreign": 0, "participants": 0, "posts": 0, "passed": 0,
+             "failed_chats": 0}
+    username = (application.bot.username or "").lower()
+    by_chat: "OrderedDict[int, List[Update]]" = OrderedDict()
+    passthrough: List[Update] = []
+    for update in updates:
+        if is_stale(update, now, max_age):
+            stats["stale"] += 1
+        elif update.message is not None and update.message.text and update.effective_chat:
+            by_chat.setdefault(update.effective_chat.id, []).append(update)
+        else:
+            passthrough.append(update)
+
+    for chat_id, chat_updates in by_chat.items():
+        try:
+            await process_chat(application, chat_updates, username, registry, message_manager, dispatcher,
+                               passthrough, stats)
+        except Exception as e:
+            stats["failed_chats"] += 1
+            logger.exception(f"Не удалось обработать очередь после сна для чата {chat_id}: {e}")
+
+    for update in sorted(passthrough, key=lambda u: u.update_id):
+        await application.process_update(update)
+    stats["passed"] = len(passthrough)
+    return stats
+
+async def catch_up(application: Application, registry: ChatRegistry, message_manager: MessageManager,
+                   dispatcher: SendDispatcher, webhook: bool) -> None:
+    """
+    Догоняет очередь обновлений, накопившуюся, пока машина была остановлена.
+
+    Забранные обновления подтверждаются до обработки: если обработка прервётся
+    (ошибка или остановка машины), обычный цикл не получит их снова и не
+    отправит повторно сообщения /post, уже ушедшие в чаты. Цена — обновления,
+    которые не успели обработать, теряются (как и обновления старше BACKLOG_MAX_AGE).
+    Ошибки не мешают запуску.
+    """
+    try:
+        updates = await fetch_backlog(application, webhook)
+        if not updates:
+            return
+        await confirm_backlog(application, updates)
+        stats = await process_backlog(application, updates, registry, message_manager, dispatcher)
+        logger.info(f"Очередь после сна обработана: обновлений {stats['updates']}, устаревших {stats['stale']}, "
+                    f"команд другим ботам {stats['foreign']}, новых участников {stats['participants']}, "
+                    f"команд /post {stats['posts']}, передано обработчикам {stats['passed']}, "
+                    f"чатов с ошибкой {stats['failed_chats']}.")
+    except Exception as e:
+        logger.exception(f"Не удалось обработать очередь обновлений после сна: {e}")
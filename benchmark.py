@@ -0,0 +1,405 @@
+"""
+Нагрузочный стенд для цепочки обработчиков бота.
+
+Строит объекты Update (синтетические или восстановленные из bot.log) и прогоняет
+их через track_new_users, post_command_handler (/post → post_any,
+/post_<category>) и help_command с поддельным ботом в том же процессе, без сети.
+Состояние и каталог создаются во временном каталоге и не трогают рабочие файлы.
+
+Результат — JSON: обновлений в секунду, p50/p99 задержки обработчиков, сколько
+байт записано в хранилище состояния и пиковая память. Пример:
+
+    python benchmark.py --scenario today
+    python benchmark.py --scenario large --backend sqlite --output large.json
+    python benchmark.py --replay bot.log --repeat 50
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import tracemalloc
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+# config.py требует TOKEN; для стенда подойдёт любой
+os.environ.setdefault("TOKEN", "0:benchmark")
+
+from telegram import Update
+import handlers
+from rate_limiter import RateLimiter, BucketPolicy
+from message_manager import MessageManager
+from chat_registry import ChatRegistry
+from send_dispatcher import SendDispatcher
+from storage import create_storage
+
+# Масштабы: сегодняшнее состояние (~30 участников в одном чате) и рост до 100 тыс.
+SCENARIOS: Dict[str, Dict[str, int]] = {
+    "today": {"chats": 1, "participants": 30, "categories": 3, "messages": 40, "updates": 2_000},
+    "medium": {"chats": 100, "participants": 5_000, "categories": 10, "messages": 500, "updates": 20_000},
+    "large": {"chats": 1_000, "participants": 100_000, "categories": 20, "messages": 500, "updates": 100_000},
+}
+
+# Доли типов обновлений в синтетическом трафике
+DEFAULT_MIX = "text=0.85,post=0.06,post_category=0.06,help=0.03"
+
+LOG_MESSAGE = re.compile(r"Сообщение от (\d+) \((.*)\)")
+LOG_COMMAND = re.compile(r"Получена команда: (\S+)")
+
+
+class FakeBot:
+    """
+    Бот без сети: запоминает только количество и объём отправленного.
+    latency имитирует время ответа Telegram на каждый запрос.
+    """
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.sent = 0
+        self.sent_bytes = 0
+
+    async def send_message(self, chat_id: Any, text: str, **kwargs: Any) -> None:
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        self.sent += 1
+        self.sent_bytes += len(text.encode("utf-8"))
+
+
+class FakeContext:
+    def __init__(self, bot: FakeBot) -> None:
+        self.bot = bot
+
+
+class UpdateFactory:
+    """
+    Собирает Update из минимального JSON, как их присылает Telegram.
+    """
+    def __init__(self, bot: FakeBot) -> None:
+        self.bot = bot
+        self._next_id = 1
+
+    def make(self, chat_id: int, user_id: int, first_name: str, text: str) -> Update:
+        update_id = self._next_id
+        self._next_id += 1
+        entities = ([{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+                    if text.startswith("/") else [])
+        data = {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "group"},
+                "from": {"id": user_id, "is_bot": False, "first_name": first_name},
+                "text": text,
+                "entities": entities,
+            },
+        }
+        return Update.de_json(data, self.bot)
+
+
+def parse_mix(spec: str) -> List[Tuple[str, float]]:
+    mix = []
+    for part in spec.split(","):
+        kind, weight = part.split("=")
+        mix.append((kind.strip(), float(weight)))
+    return mix
+
+def write_catalog(messages_dir: Path, names: List[str], messages: int) -> None:
+    """
+    Создаёт каталог messages_<category>.json с шаблонами сообщений.
+    """
+    messages_dir.mkdir(parents=True, exist_ok=True)
+    for name in names:
+        texts = [f"{{name}} получает сообщение №{index} из категории {name}." for index in range(messages)]
+        (messages_dir / f"messages_{name}.json").write_text(json.dumps(texts, ensure_ascii=False),
+                                                            encoding="utf-8")
+
+def chat_members(chats: int, participants: int) -> List[List[int]]:
+    """
+    Распределяет участников по чатам поровну: user_id уникальны в пределах стенда.
+    """
+    members: List[List[int]] = [[] for _ in range(chats)]
+    for user_id in range(1, participants + 1):
+        members[user_id % chats].append(user_id)
+    return members
+
+def synthetic_traffic(factory: UpdateFactory, members: List[List[int]], categories: List[str],
+                      count: int, mix: List[Tuple[str, float]], rng: random.Random) -> List[Tuple[str, Update]]:
+    kinds = [kind for kind, _ in mix]
+    weights = [weight for _, weight in mix]
+    traffic = []
+    for kind in rng.choices(kinds, weights, k=count):
+        chat_index = rng.randrange(len(members))
+        user_id = rng.choice(members[chat_index]) if members[chat_index] else 1
+        chat_id = -1_000_000 - chat_index
+        if kind == "text":
+            text = "привет"
+        elif kind == "post":
+            text = "/post"
+        elif kind == "post_category":
+            text = f"/post_{rng.choice(categories)}"
+        else:
+            text = "/help"
+        traffic.append((kind, factory.make(chat_id, user_id, f"user{user_id}", text)))
+    return traffic
+
+def parse_log(log_file: Path) -> List[Tuple[str, int, str, str]]:
+    """
+    Восстанавливает последовательность событий по bot.log: записи
+    "Сообщение от ..." становятся текстовыми сообщениями, "Получена команда: ..." —
+    командами от последнего написавшего пользователя. Команды, кроме /post,
+    /post_<category> и /help, пропускаются: их ответы («Неизвестная команда»)
+    не относятся к измеряемой цепочке и завысили бы число отправленных сообщений.
+    Returns:
+        События (вид, user_id, имя, текст).
+    """
+    events: List[Tuple[str, int, str, str]] = []
+    last_user = (1, "user1")
+    for line in log_file.read_text(encoding="utf-8", errors="replace").splitlines():
+        message = LOG_MESSAGE.search(line)
+        if message:
+            last_user = (int(message.group(1)), message.group(2))
+            events.append(("text", last_user[0], last_user[1], "привет"))
+            continue
+        command = LOG_COMMAND.search(line)
+        if command:
+            name = command.group(1)
+            if name in ("post", "help"):
+                events.append((name, last_user[0], last_user[1], f"/{name}"))
+            elif name.startswith("post_"):
+                events.append(("post_category", last_user[0], last_user[1], f"/{name}"))
+    if not events:
+        raise ValueError(f"В {log_file} не найдено записей о сообщениях и командах.")
+    return events
+
+def log_categories(events: List[Tuple[str, int, str, str]]) -> List[str]:
+    """
+    Категории из команд /post_<category> журнала (в нижнем регистре, как их
+    разбирает post_command_handler).
+    """
+    return sorted({text[len("/post_"):].lower() for kind, _, _, text in events if kind == "post_category"})
+
+def replay_traffic(factory: UpdateFactory, events: List[Tuple[str, int, str, str]], chats: int,
+                   repeat: int, rng: random.Random) -> List[Tuple[str, Update]]:
+    """
+    Превращает события журнала (см. parse_log) в обновления. Чат в журнале
+    не пишется, поэтому при нескольких чатах он выбирается случайно.
+    """
+    traffic = []
+    for _ in range(repeat):
+        for kind, user_id, first_name, text in events:
+            chat_id = -1_000_000 - rng.randrange(chats)
+            traffic.append((kind, factory.make(chat_id, user_id, first_name, text)))
+    return traffic
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def io_written() -> Optional[int]:
+    """
+    Байты, записанные процессом (wchar из /proc/self/io), или None вне Linux.
+    """
+    try:
+        with open("/proc/self/io", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def summarize(latencies: Dict[str, List[float]]) -> Dict[str, Dict[str, float]]:
+    result = {}
+    for kind, values in latencies.items():
+        values.sort()
+        result[kind] = {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 4),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 4),
+            "max_ms": round(values[-1] * 1000, 4) if values else 0.0,
+        }
+    return result
+
+async def run_phase(name: str, traffic: List[Tuple[str, Update]], registry: ChatRegistry,
+                    message_manager: MessageManager, dispatcher: SendDispatcher, bot: FakeBot,
+                    storage: Any, concurrency: int = 0) -> Dict[str, Any]:
+    """
+    Прогоняет обновления через обработчики и дожидается отправки и сохранения.
+    Как и Application с concurrent_updates, одновременно обрабатывается
+    не больше concurrency обновлений (0 — строго по одному).
+    """
+    context = FakeContext(bot)
+    latencies: Dict[str, List[float]] = {}
+    written_before = io_written()
+    sent_before = bot.sent
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    running: Set[asyncio.Task] = set()
+
+    async def handle(kind: str, update: Update) -> None:
+        handler_started = time.perf_counter()
+        try:
+            if kind == "text":
+                await handlers.track_new_users(update, registry)
+            elif kind == "help":
+                await handlers.help_command(update, context, message_manager)
+            else:
+                await handlers.post_command_handler(update, context, registry, message_manager, dispatcher)
+        finally:
+            latencies.setdefault(kind, []).append(time.perf_counter() - handler_started)
+            semaphore.release()
+
+    started = time.perf_counter()
+    for kind, update in traffic:
+        await semaphore.acquire()
+        task = asyncio.create_task(handle(kind, update))
+        running.add(task)
+        task.add_done_callback(running.discard)
+    if running:
+        await asyncio.gather(*running)
+    handled = time.perf_counter()
+    # Фаза заканчивается, когда всё отправлено и сохранено
+    while dispatcher.pending():
+        await asyncio.sleep(0)
+    await registry.flush_all()
+    finished = time.perf_counter()
+    written_after = io_written()
+    return {
+        "phase": name,
+        "updates": len(traffic),
+        "seconds": round(finished - started, 4),
+        "updates_per_sec": round(len(traffic) / (finished - started), 1) if traffic else 0.0,
+        "handler_updates_per_sec": round(len(traffic) / (handled - started), 1) if traffic else 0.0,
+        "latency": summarize(latencies),
+        "messages_sent": bot.sent - sent_before,
+        "bytes_written": (written_after - written_before
+                          if written_before is not None and written_after is not None else None),
+        "state_size_bytes": storage.size_bytes(),
+        "loaded_chats": registry.loaded_count,
+    }
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    params = dict(SCENARIOS[args.scenario])
+    for key in params:
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+
+    # Квоты ограничителя по умолчанию отклонили бы почти все /post,
+    # поэтому стенд измеряет путь отправки без них (если не задано иное)
+    handlers.rate_limiter = RateLimiter(BucketPolicy.parse(args.rate_limit), None, None)
+
+    # При воспроизведении каталог содержит категории из журнала, иначе их команды
+    # получали бы ответ «Категория не найдена» вместо сообщения
+    events = parse_log(Path(args.replay)) if args.replay else []
+    categories = log_categories(events)
+    categories += [f"cat{index}" for index in range(params["categories"] - len(categories))]
+    params["categories"] = len(categories)
+
+    with tempfile.TemporaryDirectory(prefix="gfa-bench-") as workdir:
+        root = Path(workdir)
+        write_catalog(root / "messages_lists", categories, params["messages"])
+        storage = create_storage(args.backend, root / "state", root / "state.db")
+        bot = FakeBot(args.bot_latency / 1000)
+        factory = UpdateFactory(bot)
+        members = chat_members(params["chats"], params["participants"])
+
+        if args.tracemalloc:
+            tracemalloc.start()
+        started = time.perf_counter()
+        message_manager = await MessageManager.create(root / "messages_lists")
+        catalog_seconds = time.perf_counter() - started
+        registry = ChatRegistry(storage, message_manager, max_loaded=args.max_loaded or params["chats"])
+        dispatcher = SendDispatcher(bot, queue_size=max(1, params["updates"]), global_rate=0,
+                                    chat_interval=0, backoff_base=0)
+        registry.start_autosave()
+
+        phases = []
+        # Регистрация: каждый участник пишет по сообщению, состояние растёт до целевого размера
+        registration = [("text", factory.make(-1_000_000 - chat_index, user_id, f"user{user_id}", "привет"))
+                        for chat_index, users in enumerate(members) for user_id in users]
+        phases.append(await run_phase("register", registration, registry, message_manager,
+                                      dispatcher, bot, storage, args.concurrency))
+        del registration
+
+        if args.replay:
+            traffic = replay_traffic(factory, events, params["chats"], args.repeat, rng)
+        else:
+            traffic = synthetic_traffic(factory, members, categories, params["updates"],
+                                        parse_mix(args.mix), rng)
+        phases.append(await run_phase("replay" if args.replay else "traffic", traffic, registry,
+                                      message_manager, dispatcher, bot, storage, args.concurrency))
+
+        await dispatcher.stop()
+        await registry.stop_autosave()
+        await storage.close()
+        peak_traced = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+        if args.tracemalloc:
+            tracemalloc.stop()
+
+    # ru_maxrss в Linux — килобайты, в macOS — байты
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss = max_rss if sys.platform == "darwin" else max_rss * 1024
+    return {
+        "scenario": args.scenario,
+        "params": params,
+        "backend": args.backend,
+        "replay": args.replay,
+        "seed": args.seed,
+        "concurrency": args.concurrency,
+        "bot_latency_ms": args.bot_latency,
+        "python": platform.python_version(),
+        "catalog_load_seconds": round(catalog_seconds, 4),
+        "phases": phases,
+        "peak_rss_bytes": peak_rss,
+        "peak_traced_bytes": peak_traced,
+    }
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд обработчиков бота.")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="today")
+    parser.add_argument("--chats", type=int, help="Число чатов (переопределяет сценарий).")
+    parser.add_argument("--participants", type=int, help="Всего участников во всех чатах.")
+    parser.add_argument("--categories", type=int, help="Число категорий каталога.")
+    parser.add_argument("--messages", type=int, help="Сообщений в каждой категории.")
+    parser.add_argument("--updates", type=int, help="Обновлений в синтетическом трафике.")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Доли типов обновлений (по умолчанию {DEFAULT_MIX}).")
+    parser.add_argument("--replay", help="Воспроизвести последовательность команд из журнала бота.")
+    parser.add_argument("--repeat", type=int, default=1, help="Сколько раз повторить журнал при --replay.")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--max-loaded", type=int,
+                        help="Шардов чатов в памяти (по умолчанию все чаты сценария; меньшее "
+                             "значение измеряет выгрузку и повторную загрузку шардов).")
+    parser.add_argument("--rate-limit", default="", help="Ограничение /post на чат, как RATE_LIMIT_CHAT.")
+    parser.add_argument("--concurrency", type=int, default=0,
+                        help="Сколько обновлений обрабатывать одновременно, как CONCURRENT_UPDATES.")
+    parser.add_argument("--bot-latency", type=float, default=0.0,
+                        help="Задержка каждого запроса к Telegram в миллисекундах.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="Измерять пик памяти Python через tracemalloc (замедляет прогон).")
+    parser.add_argument("--output", help="Файл для результата (по умолчанию stdout).")
+    return parser.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    # Журнал не должен влиять ни на время, ни на число записанных байт
+    logging.disable(logging.CRITICAL)
+    result = asyncio.run(run(args))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Union
+from message_manager import MessageManager
+from state_manager import StateManager
+from storage import StateStorage
+from config import STATE_FLUSH_INTERVAL, MAX_LOADED_CHATS, CHAT_IDLE_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+class ChatRegistry:
+    """
+    Реестр состояний чатов: у каждого чата свой шард (StateManager),
+    который читает и пишет своё состояние через общее хранилище StateStorage.
+
+    Шард загружается при первом обращении к чату и выгружается (с сохранением)
+    после idle_timeout секунд простоя или когда в памяти больше max_loaded шардов.
+    Поэтому память и стоимость сохранения растут с числом активных чатов,
+    а не всех чатов, которые бот когда-либо видел.
+
+    Обновления разных чатов могут обрабатываться одновременно: acquire выдаёт
+    шард под блокировкой чата, поэтому обработчики одного чата выполняются по
+    очереди, а медленная отправка в одном чате не задерживает остальные.
+    """
+    def __init__(self, storage: StateStorage, message_manager: MessageManager,
+                 max_loaded: int = MAX_LOADED_CHATS,
+                 idle_timeout: float = CHAT_IDLE_TIMEOUT,
+                 flush_interval: float = STATE_FLUSH_INTERVAL) -> None:
+        self.storage = storage
+        self.message_manager = message_manager
+        self.max_loaded = max_loaded
+        self.idle_timeout = idle_timeout
+        self.flush_interval = flush_interval
+        self._shards: "OrderedDict[str, StateManager]" = OrderedDict()  # От давно использованных к недавним
+        self._last_used: Dict[str, float] = {}
+        self._pins: Dict[str, int] = {}                                 # Шарды, которые сейчас используются
+        self._locks: Dict[str, asyncio.Lock] = {}                       # Блокировки чатов, занятых обработчиками
+        self._loading: Dict[str, "asyncio.Task[StateManager]"] = {}     # Шарды, которые сейчас загружаются
+        self._flush_requested = asyncio.Event()
+        self._autosave_task: Optional[asyncio.Task] = None
+
+    @property
+    def loaded_count(self) -> int:
+        """
+        Количество шардов, загруженных в память.
+        """
+        return len(self._shards)
+
+    def loaded_shards(self) -> List[StateManager]:
+        """
+        Шарды, загруженные в память.
+        """
+        return list(self._shards.values())
+
+    async def get(self, chat_id: Union[int, str]) -> StateManager:
+        """
+        Возвращает шард чата, загружая его при первом обращении.
+        """
+        key = str(chat_id)
+        shard = self._shards.get(key)
+        if shard is None:
+            # Одновременные обращения к незагруженному чату ждут одну и ту же загрузку,
+            # иначе второй шард затёр бы изменения первого
+            loading = self._loading.get(key)
+            if loading is None:
+                loading = self._loading[key] = asyncio.create_task(self._load(key))
+            # Отмена одного из ожидающих не должна прерывать загрузку для остальных
+            shard = await asyncio.shield(loading)
+        self._shards.move_to_end(key)
+        self._last_used[key] = time.monotonic()
+        if len(self._shards) > self.max_loaded:
+            await self._evict_over_limit()
+        return shard
+
+    async def _load(self, key: str) -> StateManager:
+        """
+        Загружает шард чата из хранилища и добавляет его в реестр.
+        """
+        try:
+            shard = StateManager(key, self.storage, flush_requested=self._flush_requested)
+            await shard.load_state(self.message_manager)
+            self._shards[key] = shard
+            logger.info(f"Загружен шард чата {key} (в памяти: {len(self._shards)}).")
+            return shard
+        finally:
+            del self._loading[key]
+
+    def pin(self, chat_id: Union[int, str]) -> None:
+        """
+        Запрещает выгрузку шарда чата до парного вызова unpin.
+        Нужен, когда шард используется дольше одного обработчика — например,
+        пока зарезервированное сообщение ждёт отправки.
+        """
+        key = str(chat_id)
+        self._pins[key] = self._pins.get(key, 0) + 1
+
+    def unpin(self, chat_id: Union[int, str]) -> None:
+        """
+        Снимает запрет на выгрузку, установленный pin.
+        """
+        key = str(chat_id)
+        self._pins[key] -= 1
+        if not self._pins[key]:
+            del self._pins[key]
+            # Блокировку держат и ждут только закреплённые чаты, значит она свободна
+            self._locks.pop(key, None)
+        self._last_used[key] = time.monotonic()
+
+    @asynccontextmanager
+    async def acquire(self, chat_id: Union[int, str]) -> AsyncIterator[StateManager]:
+        """
+        Выдаёт шард чата на время обработки обновления. Пока шард используется,
+        он не будет выгружен из памяти, а другие обработчики этого чата ждут
+        своей очереди: между await внутри обработчика (ответ пользователю,
+        загрузка шарда) состояние чата не меняется чужими обработчиками.
+        """
+        key = str(chat_id)
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self.pin(key)
+        try:
+            async with lock:
+                yield await self.get(key)
+        finally:
+            self.unpin(key)
+
+    def sync_catalog(self) -> None:
+        """
+        Согласует очереди загруженных шардов с обновлённым каталогом сообщений.
+        Невыгруженные шарды согласуются сами при следующей загрузке.
+        """
+        for shard in self._shards.values():
+            shard.sync_catalog(self.message_manager)
+
+    async def _evict(self, key: str) -> None:
+        """
+        Сохраняет шард и выгружает его из памяти.
+
+        Шард остаётся в реестре, пока идёт запись: обработчик, занявший чат
+        в это время, получит тот же шард, а не устаревшую копию из хранилища.
+        Если за время записи шард заняли или изменили, выгрузка откладывается.
+        """
+        shard = self._shards[key]
+        await shard.flush(unloading=True)
+        if self._shards.get(key) is not shard or key in self._pins or shard.is_dirty:
+            return
+        del self._shards[key]
+        self._last_used.pop(key, None)
+        self.storage.release(key)
+        logger.info(f"Шард чата {key} выгружен из памяти.")
+
+    async def _evict_over_limit(self) -> None:
+        """
+        Выгружает давно не использованные шарды, пока их больше max_loaded.
+        """
+        for key in list(self._shards):
+            if len(self._shards) <= self.max_loaded:
+                break
+            if key in self._shards and key not in self._pins:
+                await self._evict(key)
+
+    async def _evict_idle(self) -> None:
+        """
+        Выгружает шарды, простаивающие дольше idle_timeout, а у оставшихся
+        удаляет заполнившиеся корзины ограничителя частоты.
+        """
+        deadline = time.monotonic() - self.idle_timeout
+        now = time.time()
+        for key in list(self._shards):
+            if key not in self._shards:
+                continue
+            if self._last_used.get(key, 0) <= deadline and key not in self._pins:
+                await self._evict(key)
+            else:
+                self._shards[key].drop_full_buckets(now)
+
+    async def flush_all(self, unloading: bool = False) -> None:
+        """
+        Сбрасывает на диск изменения всех загруженных шардов. При остановке
+        бота (unloading) журналы шардов ещё и сворачиваются в снимки, чтобы
+        холодный старт читал по одному файлу на чат.
+        """
+        for key, shard in list(self._shards.items()):
+            if shard.is_dirty or unloading:
+                try:
+                    await shard.flush(unloading)
+                except Exception as e:
+                    logger.exception(f"Ошибка сохранения шарда чата {key}: {e}")
+
+    def start_autosave(self) -> None:
+        """
+        Запускает фоновую задачу сохранения и выгрузки простаивающих шардов.
+        """
+        if self._autosave_task is None or self._autosave_task.done():
+            self._autosave_task = asyncio.create_task(self._autosave_loop())
+
+    async def stop_autosave(self) -> None:
+        """
+        Останавливает фоновую задачу, сбрасывает оставшиеся изменения на диск
+        и сворачивает журналы шардов в снимки.
+        """
+        if self._autosave_task is not None:
+            self._autosave_task.cancel()
+            try:
+                await self._autosave_task
+            except asyncio.CancelledError:
+                pass
+            self._autosave_task = None
+        await self.flush_all(unloading=True)
+
+    async def _autosave_loop(self) -> None:
+        """
+        Раз в flush_interval секунд (или досрочно по запросу шарда) сохраняет
+        изменения и выгружает простаивающие шарды.
+        """
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            try:
+                await self.flush_all()
+                await self._evict_idle()
+            except Exception as e:
+                logger.exception(f"Ошибка фонового сохранения состояния: {e}")
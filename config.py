@@ -1,4 +1,5 @@
 import os
+import hashlib
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -6,9 +7,131 @@ from dotenv import load_dotenv
 load_dotenv()
 
 TOKEN: str | None = os.getenv('TOKEN')
+# Чат, в котором бот работал до поддержки нескольких чатов: его состояние из
+# STATE_FILE/STATE_JOURNAL_FILE переносится в отдельный шард при первом запуске.
 CHAT_ID: str | None = os.getenv('CHAT_ID_TEST')
 STATE_FILE: Path = Path('state.json')
+STATE_JOURNAL_FILE: Path = Path('state.journal')
+# Хранилище состояния чатов: 'json' — каталог STATE_DIR с парой
+# <chat_id>.json/<chat_id>.journal на чат, 'sqlite' — база STATE_DB_FILE
+STATE_BACKEND: str = os.getenv('STATE_BACKEND', 'json')
+STATE_DIR: Path = Path(os.getenv('STATE_DIR', 'state'))
+STATE_DB_FILE: Path = Path(os.getenv('STATE_DB_FILE', 'state.db'))
 MESSAGES_DIR: Path = Path('messages_lists')
+# Как часто (в секундах) проверять messages_lists на изменения; 0 — не проверять
+CATALOG_POLL_INTERVAL: float = float(os.getenv('CATALOG_POLL_INTERVAL', '30'))
+# Скомпилированный каталог: для каждого messages_<category>.json здесь хранится
+# <category>.bin с индексом смещений, который читается через mmap. Файлы
+# пересобираются автоматически при изменении исходного JSON.
+CATALOG_DIR: Path = Path(os.getenv('CATALOG_DIR', '.catalog'))
+# Сколько файлов каталога компилировать одновременно: разбор большого JSON
+# временно занимает память, поэтому параллельность ограничена
+CATALOG_COMPILE_CONCURRENCY: int = int(os.getenv('CATALOG_COMPILE_CONCURRENCY', '4'))
+# Сколько прежних версий каталога категории (<category>@<хэш>.bin) хранить:
+# по ним очереди, начавшие круг до правки JSON, находят свои сообщения.
+# Круги, начатые с более старой версии, начинаются заново
+CATALOG_KEEP_VERSIONS: int = int(os.getenv('CATALOG_KEEP_VERSIONS', '5'))
 
-if not TOKEN or not CHAT_ID:
-    raise ValueError("Необходимые переменные окружения (TOKEN или CHAT_ID) не заданы!")
+# Отложенная запись состояния: изменения копятся в памяти и сбрасываются на диск
+# не реже, чем раз в STATE_FLUSH_INTERVAL секунд, либо сразу после
+# STATE_FLUSH_MAX_CHANGES изменений.
+STATE_FLUSH_INTERVAL: float = float(os.getenv('STATE_FLUSH_INTERVAL', '5'))
+STATE_FLUSH_MAX_CHANGES: int = int(os.getenv('STATE_FLUSH_MAX_CHANGES', '50'))
+
+# Сколько шардов чатов держать в памяти одновременно и через сколько секунд
+# простоя выгружать шард. Очереди шарда не зависят от размера каталога
+# (см. shuffled_queue.SeededQueue), поэтому память шарда — это его участники
+# и счётчики, обычно единицы килобайт
+MAX_LOADED_CHATS: int = int(os.getenv('MAX_LOADED_CHATS', '200'))
+CHAT_IDLE_TIMEOUT: float = float(os.getenv('CHAT_IDLE_TIMEOUT', '1800'))
+
+# Сколько обновлений обрабатывать одновременно. Обновления одного чата всё равно
+# выполняются по очереди (блокировка шарда), параллельно идут разные чаты и /help.
+# 0 — обрабатывать все обновления строго по одному.
+CONCURRENT_UPDATES: int = int(os.getenv('CONCURRENT_UPDATES', '64'))
+
+# Выбор участника для /post: вес складывается из постоянной части
+# PARTICIPANT_BASE_WEIGHT и активности — числа сообщений участника, которое
+# затухает вдвое за PARTICIPANT_ACTIVITY_HALF_LIFE секунд. Недавно выбранный
+# участник выбирается реже: штраф затухает вдвое за PARTICIPANT_PICK_HALF_LIFE
+# секунд. Не писавшие дольше PARTICIPANT_ABSENCE_WINDOW секунд (0 — без ограничения)
+# не выбираются. Активность сохраняется не чаще раза в
+# PARTICIPANT_SEEN_PERSIST_INTERVAL секунд на участника.
+PARTICIPANT_BASE_WEIGHT: float = float(os.getenv('PARTICIPANT_BASE_WEIGHT', '1'))
+PARTICIPANT_ACTIVITY_HALF_LIFE: float = float(os.getenv('PARTICIPANT_ACTIVITY_HALF_LIFE', str(7 * 86400)))
+PARTICIPANT_PICK_HALF_LIFE: float = float(os.getenv('PARTICIPANT_PICK_HALF_LIFE', '86400'))
+PARTICIPANT_ABSENCE_WINDOW: float = float(os.getenv('PARTICIPANT_ABSENCE_WINDOW', str(90 * 86400)))
+PARTICIPANT_SEEN_PERSIST_INTERVAL: float = float(os.getenv('PARTICIPANT_SEEN_PERSIST_INTERVAL', '600'))
+
+# Публикации по расписанию (/schedule): время расписаний считается в поясе
+# SCHEDULE_TIMEZONE. Публикации, пропущенные, пока машина спала, выполняются
+# одной, если последняя из них не старше SCHEDULE_CATCH_UP_WINDOW секунд
+# (0 — выполнять независимо от давности). В чате не больше SCHEDULE_MAX_PER_CHAT расписаний.
+SCHEDULE_TIMEZONE: str = os.getenv('SCHEDULE_TIMEZONE', 'UTC')
+SCHEDULE_CATCH_UP_WINDOW: float = float(os.getenv('SCHEDULE_CATCH_UP_WINDOW', '3600'))
+SCHEDULE_MAX_PER_CHAT: int = int(os.getenv('SCHEDULE_MAX_PER_CHAT', '10'))
+
+# Ограничение частоты /post корзинами токенов в формате "<ёмкость>:<секунд на токен>".
+# Корзины считаются отдельно на чат, на пользователя в чате и на категорию команды
+# в чате; пустое значение выключает корзину. По умолчанию — одно сообщение в чат
+# раз в 15 минут.
+RATE_LIMIT_CHAT: str = os.getenv('RATE_LIMIT_CHAT', '1:900')
+RATE_LIMIT_USER: str = os.getenv('RATE_LIMIT_USER', '')
+RATE_LIMIT_CATEGORY: str = os.getenv('RATE_LIMIT_CATEGORY', '')
+
+# Очередь исходящих сообщений: не больше SEND_QUEUE_SIZE ожидающих сообщений на чат,
+# не чаще SEND_GLOBAL_RATE сообщений в секунду всего и одного сообщения в чат раз
+# в SEND_CHAT_INTERVAL секунд (лимиты Telegram — около 30/с и 20 в минуту в группу).
+# Сетевые ошибки повторяются до SEND_MAX_ATTEMPTS раз с задержкой от
+# SEND_BACKOFF_BASE до SEND_BACKOFF_MAX секунд.
+SEND_QUEUE_SIZE: int = int(os.getenv('SEND_QUEUE_SIZE', '20'))
+SEND_GLOBAL_RATE: float = float(os.getenv('SEND_GLOBAL_RATE', '25'))
+SEND_CHAT_INTERVAL: float = float(os.getenv('SEND_CHAT_INTERVAL', '3'))
+SEND_MAX_ATTEMPTS: int = int(os.getenv('SEND_MAX_ATTEMPTS', '5'))
+SEND_BACKOFF_BASE: float = float(os.getenv('SEND_BACKOFF_BASE', '1'))
+SEND_BACKOFF_MAX: float = float(os.getenv('SEND_BACKOFF_MAX', '60'))
+
+# Очередь обновлений после сна машины: при запуске накопившиеся обновления
+# забираются пачкой, команды /post каждого чата сворачиваются в одну отправку.
+# Обновления старше BACKLOG_MAX_AGE секунд отбрасываются (0 — не отбрасывать);
+# в режиме вебхука пачкой обрабатывается очередь от BACKLOG_MIN_UPDATES обновлений.
+BACKLOG_CATCH_UP: bool = os.getenv('BACKLOG_CATCH_UP', '1') not in ('0', 'false', 'False', '')
+BACKLOG_MAX_AGE: float = float(os.getenv('BACKLOG_MAX_AGE', '3600'))
+BACKLOG_MAX_UPDATES: int = int(os.getenv('BACKLOG_MAX_UPDATES', '1000'))
+BACKLOG_MIN_UPDATES: int = int(os.getenv('BACKLOG_MIN_UPDATES', '2'))
+
+# Логирование: уровень, файл журнала и окно (в секундах), в котором из частых
+# однотипных записей (каждое сообщение в чате, каждый getUpdates) пишется одна; 0 — писать все
+LOG_LEVEL: str = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FILE: Path = Path(os.getenv('LOG_FILE', 'bot.log'))
+LOG_SAMPLE_INTERVAL: float = float(os.getenv('LOG_SAMPLE_INTERVAL', '60'))
+
+# Журнал изменений шарда сворачивается в его снимок, когда превышает этот размер
+JOURNAL_COMPACT_BYTES: int = int(os.getenv('JOURNAL_COMPACT_BYTES', str(256 * 1024)))
+
+# Режим получения обновлений: 'polling' (getUpdates) или 'webhook' (HTTP на PORT).
+# В режиме вебхука Telegram сам будит остановленную машину fly.io запросом.
+BOT_MODE: str = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_LISTEN: str = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+PORT: int = int(os.getenv('PORT', '8080'))
+WEBHOOK_PATH: str = os.getenv('WEBHOOK_PATH', 'telegram')
+# Публичный адрес бота; на fly.io по умолчанию https://<app>.fly.dev
+WEBHOOK_URL: str | None = os.getenv('WEBHOOK_URL') or (
+    f"https://{os.environ['FLY_APP_NAME']}.fly.dev" if os.getenv('FLY_APP_NAME') else None
+)
+# Метрики Prometheus (/metrics) на отдельном порту; 0 — не запускать.
+# По умолчанию доступны только локально, на fly.io задаётся METRICS_LISTEN=0.0.0.0.
+METRICS_LISTEN: str = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT: int = int(os.getenv('METRICS_PORT', '9091'))
+
+if not TOKEN:
+    raise ValueError("Необходимая переменная окружения TOKEN не задана!")
+
+# Секрет вебхука не меняется между перезапусками (иначе запрос, разбудивший
+# машину, пришёл бы со старым секретом), поэтому по умолчанию выводится из токена.
+WEBHOOK_SECRET: str = os.getenv('WEBHOOK_SECRET') or hashlib.sha256(f"webhook:{TOKEN}".encode()).hexdigest()
+
+if BOT_MODE not in ('polling', 'webhook'):
+    raise ValueError(f"Неизвестный режим BOT_MODE: {BOT_MODE}")
+if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+    raise ValueError("Для режима webhook необходимо задать WEBHOOK_URL!")
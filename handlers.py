@@ -1,12 +1,16 @@
 import random
 import logging
-from datetime import datetime, timedelta
-from typing import Optional
-from telegram import Update
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Optional
+from telegram import ChatMember, Update, User
 from telegram.ext import ContextTypes
 from state_manager import StateManager
 from message_manager import MessageManager
-from config import CHAT_ID
+from chat_registry import ChatRegistry
+from rate_limiter import RateLimiter
+from send_dispatcher import SendDispatcher
+from post_scheduler import PostScheduler, parse_schedule_args
+from metrics import HANDLER_LATENCY, COMMANDS, RATE_LIMITED, NEW_PARTICIPANTS, timed
 
 logger = logging.getLogger(__name__)
 
@@ -35,183 +39,323 @@ TIRED_BOT_MESSAGES = [
     "⌛ Вернётся через {time}, но теперь он знает о вас всё. 👁️",
 ]
 
-# Параметры ограничения: N минут между отправками
-RATE_LIMIT = timedelta(minutes=15)
-last_message_time: Optional[datetime] = None  # время последней отправки сообщения
+SCHEDULE_HELP = (
+    "Публикации по расписанию (настраивают администраторы чата):\n"
+    "/schedule - Список расписаний чата\n"
+    "/schedule cron <минуты> <часы> <дни месяца> <месяцы> <дни недели> [категория] - "
+    "По расписанию cron, например: /schedule cron 0 9 * * 1-5\n"
+    "/schedule daily <N> [ЧЧ:ММ-ЧЧ:ММ] [категория] - N публикаций в день в случайное время, "
+    "например: /schedule daily 3 10:00-22:00 cool\n"
+    "/schedule remove <номер> - Удалить расписание\n"
+    "/schedule clear - Удалить все расписания чата"
+)
 
+# Ответ на команду, вызвавшую отправку; у публикации по расписанию команды нет
+Reply = Callable[[str], Awaitable[Any]]
 
-async def track_new_users(update: Update, state_manager: StateManager) -> None:
+# Ограничение частоты команд /post (настраивается через RATE_LIMIT_* в config.py)
+rate_limiter = RateLimiter.from_config()
+
+
+def participant_link(user: User) -> str:
+    """
+    Имя участника для подстановки в сообщения: ссылка на пользователя Telegram.
+    """
+    return f'<a href="tg://user?id={user.id}">{user.first_name}</a>'
+
+def parse_command(text: str) -> str:
+    """
+    Возвращает имя команды без "/" и упоминания бота: "/post_cool@bot 1" → "post_cool".
+    """
+    raw_command = text.strip().split()[0].lstrip('/')
+    return raw_command.split('@')[0]  # Удаляем упоминание бота, если есть
+
+def command_mention(text: str) -> Optional[str]:
     """
-    Отслеживает новые сообщения и добавляет пользователей в список участников,
-    если их еще нет в state.json.
+    Возвращает бота, которому адресована команда: "/post@bot 1" → "bot", без упоминания — None.
+    """
+    raw_command = text.strip().split()[0]
+    return raw_command.split('@', 1)[1] if '@' in raw_command else None
+
+@timed(HANDLER_LATENCY, "track_new_users")
+async def track_new_users(update: Update, registry: ChatRegistry) -> None:
+    """
+    Отслеживает новые сообщения: добавляет пользователей в список участников
+    чата, если их еще нет в состоянии этого чата, и учитывает активность
+    уже известных участников (от неё зависит выбор участника для /post).
     """
     user = update.message.from_user
     user_id = str(user.id)
-    user_name = f'<a href="tg://user?id={user_id}">{user.first_name}</a>'
+    user_name = participant_link(user)
 
-    # Логируем ID и имя пользователя
-    logger.info(f"Сообщение от {user_id} ({user.first_name})")
+    # Логируем ID и имя пользователя (в журнал попадает одна такая запись в LOG_SAMPLE_INTERVAL)
+    logger.info(f"Сообщение от {user_id} ({user.first_name})", extra={"sample_key": "incoming_message"})
 
-    # Проверяем, есть ли пользователь в списке участников
-    if user_id not in state_manager.participants:
-        state_manager.participants[user_id] = user_name
-        await state_manager.save_state()  # Сохраняем обновленный список участников
-        logger.info(f"Добавлен новый участник: {user_name}")
+    # Добавляем пользователя или учитываем его сообщение (изменение попадёт в журнал в фоне)
+    at = update.message.date.timestamp() if update.message.date else None
+    async with registry.acquire(update.effective_chat.id) as state_manager:
+        if state_manager.add_participant(user_id, user_name, at):
+            NEW_PARTICIPANTS.inc()
+            logger.info(f"Добавлен новый участник: {user_name}")
 
-def get_rate_limit_remaining() -> Optional[timedelta]:
+async def track_left_users(update: Update, registry: ChatRegistry) -> None:
     """
-    Возвращает оставшееся время до возможности отправки следующего сообщения,
-    или None, если ограничение снято.
+    Исключает вышедшего из чата пользователя из выбора участников для /post.
     """
-    global last_message_time
-    now = datetime.now()
-    if last_message_time is None or now - last_message_time >= RATE_LIMIT:
-        return None
-    else:
-        return RATE_LIMIT - (now - last_message_time)
+    user = update.message.left_chat_member
+    async with registry.acquire(update.effective_chat.id) as state_manager:
+        state_manager.participant_left(str(user.id))
 
-def update_last_message_time() -> None:
+def format_time_left(seconds: float) -> str:
     """
-    Обновляет время последней отправки на текущее.
+    Форматирует оставшееся время для сообщений уставшего бота.
     """
-    global last_message_time
-    last_message_time = datetime.now()
+    seconds = max(1, int(round(seconds)))
+    minutes, seconds = divmod(seconds, 60)
+    return f"{minutes} минут {seconds} секунд" if minutes else f"{seconds} секунд"
 
-async def post_message(update: Update, context: ContextTypes.DEFAULT_TYPE,
+async def post_message(chat_id: int, reply: Reply,
                        state_manager: StateManager, message_manager: MessageManager,
-                       category: str) -> None:
+                       category: str, registry: ChatRegistry, dispatcher: SendDispatcher) -> None:
     """
-    Отправляет сообщение в чат, подставляя имя участника в шаблон.
+    Ставит в очередь отправки сообщение для чата chat_id, подставляя имя
+    участника этого чата в шаблон. О неудаче сообщается через reply
+    (ответ на команду или запись в журнал для публикации по расписанию).
     
     Логика:
-    - Для выбранной категории проверяем, есть ли перемешанный список сообщений.
-    - Если список пуст, создаём его с помощью random.sample из оригинального списка.
-    - Извлекаем первое сообщение (pop(0)), подставляем имя участника и отправляем.
-    - Состояние (очередь сообщений) сохраняется после отправки.
+    - Для выбранной категории берём очередь идентификаторов сообщений.
+    - Если очередь пройдена, начинаем новый круг в случайном порядке.
+    - Резервируем первое сообщение и участника, подставляем имя и передаём
+      сообщение диспетчеру отправки; обработчик не ждёт доставки.
+    - После доставки резерв превращается в извлечение (оно записывается в журнал
+      состояния), при ошибке снимается, и сообщение будет выдано следующим.
     """
     try:
-        participant, participant_id = state_manager.get_random_participant()
+        participant, participant_id = state_manager.reserve_participant()
         if not participant:
-            await update.message.reply_text("Нет доступных участников!")
+            if participant_id is not None:
+                state_manager.release_participant(participant_id)
+            await reply("Нет доступных участников!")
             return
 
-        # Получаем очередь сообщений для выбранной категории
-        message_list = state_manager.shuffled_messages.get(category, [])
-        if not message_list:
-            original_messages = message_manager.categories.get(category, [])
-            if not original_messages:
-                await update.message.reply_text(f"Нет сообщений в категории '{category}'!")
-                return
-            state_manager.shuffled_messages[category] = random.sample(original_messages, len(original_messages))
-            message_list = state_manager.shuffled_messages[category]
-
-        message = message_list.pop(0).replace("{name}", participant)
-        await state_manager.save_state()
-        await context.bot.send_message(chat_id=CHAT_ID, text=message, parse_mode="HTML")
+        # Резервируем следующее сообщение из очереди категории
+        reserved = state_manager.reserve_message(category, message_manager)
+        if reserved is None:
+            state_manager.release_participant(participant_id)
+            await reply(f"Нет сообщений в категории '{category}'!")
+            return
+        message_id, message_template = reserved
+
+        async def on_result(delivered: bool) -> None:
+            # Вызывается диспетчером уже без блокировки чата: изменения шарда ниже
+            # выполняются без await между ними, поэтому не пересекаются с обработчиками
+            try:
+                if delivered:
+                    state_manager.commit_message(category, message_id)
+                    state_manager.commit_participant(participant_id)
+                    return
+                state_manager.release_message(category, message_id)
+                state_manager.release_participant(participant_id)
+                await reply("Не удалось отправить сообщение. Попробуйте позже.")
+            finally:
+                registry.unpin(chat_id)
+
+        message = message_template.replace("{name}", participant)
+        # Шард не должен выгружаться, пока резерв не завершён
+        registry.pin(chat_id)
+        if not dispatcher.submit(chat_id, message, on_result, parse_mode="HTML"):
+            registry.unpin(chat_id)
+            state_manager.release_message(category, message_id)
+            state_manager.release_participant(participant_id)
+            await reply("Слишком много сообщений ждут отправки. Попробуйте позже.")
     except Exception as e:
         logger.exception(f"Ошибка при отправке сообщения в категории '{category}': {e}")
-        await update.message.reply_text("Произошла ошибка при отправке сообщения. Попробуйте позже.")
+        await reply("Произошла ошибка при отправке сообщения. Попробуйте позже.")
 
-async def post_any(update: Update, context: ContextTypes.DEFAULT_TYPE,
-                   state_manager: StateManager, message_manager: MessageManager) -> None:
+async def post_any(chat_id: int, reply: Reply,
+                   state_manager: StateManager, message_manager: MessageManager,
+                   registry: ChatRegistry, dispatcher: SendDispatcher) -> None:
     """
     Отправляет случайное сообщение из случайной категории.
     """
     try:
         if not message_manager.categories:
-            await update.message.reply_text("Нет доступных категорий!")
+            await reply("Нет доступных категорий!")
             return
         category = random.choice(list(message_manager.categories.keys()))
-        await post_message(update, context, state_manager, message_manager, category)
+        await post_message(chat_id, reply, state_manager, message_manager, category,
+                           registry, dispatcher)
     except Exception as e:
         logger.exception(f"Ошибка при отправке случайного сообщения: {e}")
-        await update.message.reply_text("Произошла ошибка при отправке сообщения. Попробуйте позже.")
+        await reply("Произошла ошибка при отправке сообщения. Попробуйте позже.")
 
+@timed(HANDLER_LATENCY, "help")
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE,
                        message_manager: MessageManager) -> None:
     """
     Отправляет список доступных команд.
     """
     try:
-        commands = "/post - Отправить случайное сообщение\n"
-        for category in message_manager.categories:
-            commands += f"/post_{category} - Отправить сообщение из категории '{category}'\n"
-        commands += "/help - Показать список доступных команд"
-        await update.message.reply_text(commands)
+        # Текст собирается один раз при загрузке каталога (MessageManager.help_text)
+        await update.message.reply_text(message_manager.help_text)
     except Exception as e:
         logger.exception(f"Ошибка при обработке команды help: {e}")
         await update.message.reply_text("Произошла ошибка при обработке команды help.")
 
-def make_post_handler(category: str, state_manager: StateManager,
-                      message_manager: MessageManager):
-    """
-    Фабрика обработчиков команд для отправки сообщений из указанной категории.
-    """
-    async def handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        await post_message(update, context, state_manager, message_manager, category)
-    return handler
-
+@timed(HANDLER_LATENCY, "post")
 async def post_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE,
-                               state_manager: StateManager, message_manager: MessageManager) -> None:
+                               registry: ChatRegistry, message_manager: MessageManager,
+                               dispatcher: SendDispatcher) -> None:
     """
     Единый обработчик для команд /post и /post_<category>.
     Если команда ровно /post, вызывается post_any (случайная категория).
     Если команда имеет вид /post_<category>, отправляется сообщение из указанной категории.
     
-    Перед выполнением команды проверяется ограничение: сообщение может быть отправлено не чаще, чем раз в 1 минуту.
-    Если ограничение не позволяет, отправляется сообщение о том, что бот устал, с указанием оставшегося времени.
+    Перед выполнением команды проверяется ограничение частоты (корзины токенов на чат,
+    пользователя и категорию, см. rate_limiter). Если ограничение не позволяет,
+    отправляется сообщение о том, что бот устал, с указанием оставшегося времени.
     """
     try:
-        raw_command = update.message.text.strip().split()[0].lstrip('/')
-        command = raw_command.split('@')[0]  # Удаляем упоминание бота, если есть
+        command = parse_command(update.message.text)
 
         # Логируем полученную команду
         logger.info(f"Получена команда: {command}")
 
-        # Проверяем ограничение по времени
-        remaining = get_rate_limit_remaining()
-        if remaining is not None:
-            minutes = int(remaining.total_seconds() // 60)
-            seconds = int(remaining.total_seconds() % 60)
-            time_left = f"{minutes} минут {seconds} секунд" if minutes else f"{seconds} секунд"
-
-            logger.info(f"Команда отклонена. Осталось {minutes} мин {seconds} сек до следующей отправки.")
-
-            tired_message = random.choice(TIRED_BOT_MESSAGES).format(time=time_left)
-
-            await update.message.reply_text(tired_message)
-  
-            return
-
-        # Если ограничение прошло, обновляем время последней отправки
-        update_last_message_time()
-
-        # Логируем загруженные категории
-        logger.info(f"Доступные категории: {list(message_manager.categories.keys())}")
-
         if command == "post":
-            logger.info("Отправка случайного сообщения из любой категории.")
-            await post_any(update, context, state_manager, message_manager)
+            category = None
         elif command.startswith("post_"):
             category = command.replace("post_", "").lower()  # Приводим к нижнему регистру
 
             # Логируем выбранную категорию
             logger.info(f"Выбранная категория: {category}")
 
-            if category in message_manager.categories:
-                logger.info(f"Категория '{category}' найдена. Отправка сообщения...")
-                await post_message(update, context, state_manager, message_manager, category)
-            else:
+            if category not in message_manager.categories:
                 logger.warning(f"Категория '{category}' не найдена!")
                 await update.message.reply_text(f"Категория '{category}' не найдена.")
+                return
         else:
             logger.warning(f"Неизвестная команда: {command}")
             await update.message.reply_text("Неизвестная команда.")
+            return
+
+        COMMANDS.inc(category or "any")
+        async with registry.acquire(update.effective_chat.id) as state_manager:
+            # Проверяем ограничение частоты; при успехе токены сразу списываются
+            user_id = str(update.effective_user.id) if update.effective_user else ""
+            wait = rate_limiter.acquire(state_manager, user_id, category or "any")
+            if wait > 0:
+                RATE_LIMITED.inc()
+                time_left = format_time_left(wait)
+                logger.info(f"Команда отклонена. Осталось {time_left} до следующей отправки.")
+
+                tired_message = random.choice(TIRED_BOT_MESSAGES).format(time=time_left)
+
+                await update.message.reply_text(tired_message)
+                return
+
+            # Список категорий пишется в журнал при каждой его смене, здесь он нужен только для отладки
+            logger.debug(f"Доступные категории: {list(message_manager.categories.keys())}")
+
+            if category is None:
+                logger.info("Отправка случайного сообщения из любой категории.")
+                await post_any(update.effective_chat.id, update.message.reply_text, state_manager,
+                               message_manager, registry, dispatcher)
+            else:
+                logger.info(f"Категория '{category}' найдена. Отправка сообщения...")
+                await post_message(update.effective_chat.id, update.message.reply_text, state_manager,
+                                   message_manager, category, registry, dispatcher)
     except Exception as e:
         logger.exception(f"Ошибка в post_command_handler: {e}")
         await update.message.reply_text("Произошла ошибка при обработке команды.")
 
 
+async def scheduled_post(chat_id: str, category: Optional[str], registry: ChatRegistry,
+                         message_manager: MessageManager, dispatcher: SendDispatcher) -> None:
+    """
+    Публикация по расписанию (см. post_scheduler): то же, что /post или
+    /post_<category>, но без команды и без ограничителя частоты.
+    """
+    async def reply(text: str) -> None:
+        logger.warning(f"Публикация по расписанию в чат {chat_id} не выполнена: {text}")
+
+    async with registry.acquire(chat_id) as state_manager:
+        if category is None:
+            await post_any(int(chat_id), reply, state_manager, message_manager, registry, dispatcher)
+        elif category not in message_manager.categories:
+            await reply(f"Категория '{category}' не найдена.")
+        else:
+            await post_message(int(chat_id), reply, state_manager, message_manager, category,
+                               registry, dispatcher)
+
+async def is_chat_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """
+    Может ли автор команды менять настройки чата: в личном чате — всегда,
+    в группе — только администратор.
+    """
+    chat = update.effective_chat
+    if chat.type == chat.PRIVATE:
+        return True
+    if update.effective_user is None:
+        return False
+    member = await context.bot.get_chat_member(chat.id, update.effective_user.id)
+    return member.status in (ChatMember.ADMINISTRATOR, ChatMember.OWNER)
+
+@timed(HANDLER_LATENCY, "schedule")
+async def schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE, scheduler: PostScheduler,
+                           message_manager: MessageManager) -> None:
+    """
+    Команда /schedule: список, добавление и удаление расписаний публикаций чата
+    (см. SCHEDULE_HELP). Изменять расписания могут только администраторы.
+    """
+    chat_id = str(update.effective_chat.id)
+    args = context.args or []
+    try:
+        if not args:
+            schedules = scheduler.chat_schedules(chat_id)
+            if not schedules:
+                await update.message.reply_text(f"В этом чате нет расписаний.\n\n{SCHEDULE_HELP}")
+                return
+            lines = [f"Расписания чата (время {scheduler.tz}):"]
+            for schedule_id, spec, category, due in schedules:
+                next_post = datetime.fromtimestamp(due, scheduler.tz).strftime("%d.%m.%Y %H:%M") if due else "нет"
+                lines.append(f"{schedule_id}. {spec}, категория: {category or 'любая'}, следующая публикация: {next_post}")
+            await update.message.reply_text("\n".join(lines))
+            return
+
+        if not await is_chat_admin(update, context):
+            await update.message.reply_text("Расписания могут менять только администраторы чата.")
+            return
+
+        action = args[0].lower()
+        if action == "remove" and len(args) == 2:
+            if await scheduler.remove(chat_id, args[1]):
+                await update.message.reply_text(f"Расписание {args[1]} удалено.")
+            else:
+                await update.message.reply_text(f"Расписания {args[1]} нет.")
+            return
+        if action == "clear" and len(args) == 1:
+            removed = await scheduler.remove(chat_id)
+            await update.message.reply_text(f"Удалено расписаний: {removed}.")
+            return
+        if action not in ("cron", "daily"):
+            await update.message.reply_text(SCHEDULE_HELP)
+            return
+
+        spec, category = parse_schedule_args([action] + args[1:])
+        if category is not None and category not in message_manager.categories:
+            await update.message.reply_text(f"Категория '{category}' не найдена.")
+            return
+        schedule_id, due = await scheduler.add(chat_id, spec, category)
+        logger.info(f"В чате {chat_id} добавлено расписание {schedule_id}: {spec} ({category or 'любая категория'})")
+        next_post = datetime.fromtimestamp(due, scheduler.tz).strftime("%d.%m.%Y %H:%M") if due else "нет"
+        await update.message.reply_text(f"Расписание {schedule_id} добавлено. Следующая публикация: {next_post}.")
+    except ValueError as e:
+        await update.message.reply_text(f"{e}\n\n{SCHEDULE_HELP}")
+    except Exception as e:
+        logger.exception(f"Ошибка при обработке команды schedule: {e}")
+        await update.message.reply_text("Произошла ошибка при обработке команды schedule.")
+
+
 async def global_error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Глобальный обработчик необработанных исключений.
@@ -1,12 +1,17 @@
+import os
 import json
+import asyncio
 import logging
 from pathlib import Path
-from typing import Any
+from typing import Any, List, Optional
 import aiofiles
+import aiofiles.os
+from metrics import STATE_IO_LATENCY, timed
 
 logger = logging.getLogger(__name__)
 
-async def load_json_file(file_path: Path, default: Any) -> Any:
+@timed(STATE_IO_LATENCY, "load_json")
+async def load_json_file(file_path: Path, default: Any, create_missing: bool = True) -> Any:
     """
     Асинхронно загружает JSON-данные из файла.
     
@@ -16,6 +21,7 @@ async def load_json_file(file_path: Path, default: Any) -> Any:
     Args:
         file_path: Путь к JSON-файлу.
         default: Значение по умолчанию, которое будет возвращено и записано в файл, если его нет.
+        create_missing: Создавать ли отсутствующий файл с содержимым default.
         
     Returns:
         Загруженные данные или значение по умолчанию.
@@ -25,6 +31,8 @@ async def load_json_file(file_path: Path, default: Any) -> Any:
             contents = await f.read()
             return json.loads(contents)
     except FileNotFoundError:
+        if not create_missing:
+            return default
         logger.warning(f"Файл {file_path} не найден. Создаем файл с дефолтным значением.")
         await save_json_file(file_path, default)
         return default
@@ -32,18 +40,107 @@ async def load_json_file(file_path: Path, default: Any) -> Any:
         logger.warning(f"Файл {file_path} имеет неверный формат: {e}. Используется значение по умолчанию.")
         return default
 
-async def save_json_file(file_path: Path, data: Any) -> None:
+@timed(STATE_IO_LATENCY, "save_json")
+async def save_json_file(file_path: Path, data: Any, indent: Optional[int] = 4) -> bool:
     """
-    Асинхронно сохраняет данные в формате JSON в файл.
-    
+    Асинхронно и атомарно сохраняет данные в формате JSON в файл.
+
+    Данные сначала пишутся во временный файл рядом с целевым, сбрасываются
+    на диск (fsync) и только затем переименовываются поверх старого файла.
+    Поэтому при падении процесса на диске остаётся либо старая, либо новая
+    версия файла, но никогда не наполовину записанная.
+
     Args:
         file_path: Путь к файлу, в который необходимо сохранить данные.
         data: Данные для сохранения.
+        indent: Отступ форматирования; None — компактная запись в одну строку.
+
+    Returns:
+        True, если данные сохранены, иначе False.
     """
+    tmp_path = file_path.with_name(f".{file_path.name}.tmp")
     try:
-        async with aiofiles.open(file_path, 'w', encoding='utf-8') as f:
-            text = json.dumps(data, indent=4, ensure_ascii=False)
+        text = json.dumps(data, indent=indent, ensure_ascii=False)
+        async with aiofiles.open(tmp_path, 'w', encoding='utf-8') as f:
             await f.write(text)
-        logger.info(f"Данные успешно сохранены в {file_path}.")
+            await f.flush()
+            await asyncio.to_thread(os.fsync, f.fileno())
+        await aiofiles.os.replace(tmp_path, file_path)
+        logger.debug(f"Данные успешно сохранены в {file_path}.")
+        return True
     except Exception as e:
         logger.exception(f"Ошибка при сохранении данных в {file_path}: {e}")
+        return False
+
+@timed(STATE_IO_LATENCY, "append_journal")
+async def append_json_lines(file_path: Path, records: List[Any]) -> bool:
+    """
+    Асинхронно дописывает записи в конец файла в формате JSON Lines
+    (одна запись — одна строка) и сбрасывает их на диск.
+
+    Args:
+        file_path: Путь к файлу журнала.
+        records: Записи для добавления.
+
+    Returns:
+        True, если записи добавлены, иначе False.
+    """
+    try:
+        text = "".join(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n"
+                       for record in records)
+        async with aiofiles.open(file_path, 'a', encoding='utf-8') as f:
+            await f.write(text)
+            await f.flush()
+            await asyncio.to_thread(os.fsync, f.fileno())
+        return True
+    except Exception as e:
+        logger.exception(f"Ошибка при добавлении записей в {file_path}: {e}")
+        return False
+
+@timed(STATE_IO_LATENCY, "load_journal")
+async def load_json_lines(file_path: Path) -> List[Any]:
+    """
+    Асинхронно читает файл в формате JSON Lines.
+
+    Отсутствующий файл считается пустым. Повреждённые строки (например,
+    недописанная последняя строка после падения процесса) пропускаются.
+
+    Args:
+        file_path: Путь к файлу журнала.
+
+    Returns:
+        Список прочитанных записей.
+    """
+    try:
+        async with aiofiles.open(file_path, 'r', encoding='utf-8') as f:
+            contents = await f.read()
+    except FileNotFoundError:
+        return []
+    records: List[Any] = []
+    for line_no, line in enumerate(contents.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError as e:
+            logger.warning(f"Пропущена повреждённая строка {line_no} в {file_path}: {e}")
+    return records
+
+async def truncate_file(file_path: Path) -> bool:
+    """
+    Асинхронно очищает файл (создаёт пустой, если его не было).
+
+    Args:
+        file_path: Путь к файлу.
+
+    Returns:
+        True, если файл очищен, иначе False.
+    """
+    try:
+        async with aiofiles.open(file_path, 'w', encoding='utf-8') as f:
+            await f.flush()
+            await asyncio.to_thread(os.fsync, f.fileno())
+        return True
+    except Exception as e:
+        logger.exception(f"Ошибка при очистке файла {file_path}: {e}")
+        return False
@@ -0,0 +1,118 @@
+import re
+import time
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, List, Optional, Tuple
+from config import TOKEN, LOG_LEVEL, LOG_FILE, LOG_SAMPLE_INTERVAL
+
+# Токен бота в адресах API: https://api.telegram.org/bot<id>:<secret>/getUpdates
+TOKEN_PATTERN = re.compile(r"bot(\d+):[A-Za-z0-9_-]+")
+
+def redact(text: str) -> str:
+    """
+    Скрывает токен бота в строке, оставляя его числовой идентификатор.
+    """
+    text = TOKEN_PATTERN.sub(r"bot\1:***", text)
+    if TOKEN and TOKEN in text:
+        text = text.replace(TOKEN, "***")
+    return text
+
+
+class RedactingFormatter(logging.Formatter):
+    """
+    Форматтер, который скрывает токен бота во всей итоговой строке,
+    включая аргументы сообщения и трассировку исключения.
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        return redact(super().format(record))
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Прореживает однотипные частые записи: из записей с одним ключом за
+    interval секунд пропускается только первая, а следующая после окна
+    сообщает, сколько похожих записей было опущено.
+
+    Ключ записи задаётся в месте вызова через extra={"sample_key": ...},
+    а для журнала httpx вычисляется из метода API и кода ответа, поэтому
+    успешные getUpdates/sendMessage сворачиваются, а ошибки проходят все.
+    Записи уровня WARNING и выше не прореживаются.
+    """
+    def __init__(self, interval: float) -> None:
+        super().__init__()
+        self.interval = interval
+        self._windows: Dict[Tuple[str, str], List[float]] = {}  # {ключ: [начало окна, опущено]}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _sample_key(record: logging.LogRecord) -> Optional[str]:
+        key = getattr(record, "sample_key", None)
+        if key is not None:
+            return key
+        if record.name == "httpx" and isinstance(record.args, tuple) and len(record.args) == 5:
+            _, url, _, status, _ = record.args
+            if 200 <= status < 300:
+                return f"{str(url).rsplit('/', 1)[-1]} {status}"
+        return None
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.interval <= 0 or record.levelno >= logging.WARNING:
+            return True
+        key = self._sample_key(record)
+        if key is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get((record.name, key))
+            if window is not None and now - window[0] < self.interval:
+                window[1] += 1
+                return False
+            self._windows[(record.name, key)] = [now, 0]
+        if window is not None and window[1]:
+            record.msg = f"{record.msg} (ещё {int(window[1])} подобных за {now - window[0]:.0f} с)"
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Кладёт запись в очередь как есть: форматирование (и скрытие токена)
+    выполняется в потоке QueueListener, а не в цикле событий.
+    Записи не покидают процесс, поэтому готовить их к сериализации не нужно.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging() -> QueueListener:
+    """
+    Настраивает логирование: вызовы логгеров только кладут запись в очередь,
+    а вывод в консоль и в файл с ротацией выполняет фоновый поток.
+    Частые однотипные записи прореживаются (LOG_SAMPLE_INTERVAL), токен бота
+    скрывается до записи. Возвращает запущенный QueueListener; он останавливается
+    (с выводом оставшихся записей) при завершении процесса.
+    """
+    formatter = RedactingFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    # Консольный обработчик
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(formatter)
+
+    # Файловый обработчик с ротацией
+    file_handler = RotatingFileHandler(LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=2, encoding='utf-8')
+    file_handler.setFormatter(formatter)
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_INTERVAL))
+
+    logger = logging.getLogger()
+    logger.setLevel(LOG_LEVEL)
+    logger.addHandler(queue_handler)
+
+    listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,266 @@
+import os
+import sys
+import json
+import mmap
+import struct
+import hashlib
+import logging
+from array import array
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Формат файла: заголовок, тексты в UTF-8 подряд (с выравниванием до 8), смещения
+# текстов (N + 1 чисел uint64), идентификаторы сообщений (по ID_SIZE байт,
+# с выравниванием до 8) и хэш-таблица идентификатор → номер сообщения
+# (uint32, номер + 1, 0 — пусто). Тексты идут первыми, чтобы при сборке
+# писать их сразу, не держа в памяти.
+# Числа записаны в порядке байтов машины: файл собирается и читается на ней же,
+# а файл с другим порядком байтов просто пересобирается.
+MAGIC = b"GFACAT1" + (b"<" if sys.byteorder == "little" else b">")
+# magic, хэш исходного JSON, mtime_ns и размер исходного файла, число сообщений,
+# размер хэш-таблицы, размер текстов
+HEADER = struct.Struct("=8s16sqqIIQ")
+ID_SIZE = 6
+
+def make_message_id(message: str) -> str:
+    """
+    Возвращает стабильный идентификатор сообщения — короткий хэш его текста.
+    Одинаковый текст всегда даёт одинаковый идентификатор, поэтому очереди
+    в состоянии переживают перезапуск и правку соседних сообщений.
+    """
+    return hashlib.blake2b(message.encode('utf-8'), digest_size=ID_SIZE).hexdigest()
+
+def _aligned(size: int) -> int:
+    return (size + 7) & ~7
+
+def _table_size(count: int) -> int:
+    # Заполнение не больше половины: поиск почти всегда укладывается в одну-две пробы
+    size = 1
+    while size < 2 * count:
+        size <<= 1
+    return size
+
+
+class MessageCatalog:
+    """
+    Сообщения одной категории в скомпилированном файле, открытом через mmap.
+
+    В памяти процесса хранится только отображение файла: текст сообщения
+    декодируется по номеру в момент отправки, а очереди чатов хранят номера
+    сообщений. Поэтому потребление памяти почти не зависит от размера каталога.
+    """
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < HEADER.size:
+            raise ValueError(f"{path}: файл каталога обрезан")
+        magic, digest, mtime_ns, size, count, table_size, text_size = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"{path}: неизвестный формат каталога")
+        self.digest = digest.hex()                        # Хэш исходного JSON
+        self.signature: Tuple[int, int] = (mtime_ns, size)  # Отпечаток исходного JSON
+        self._count = count
+        self._text_start = HEADER.size
+        offsets_start = self._text_start + _aligned(text_size)
+        ids_start = offsets_start + 8 * (count + 1)
+        table_start = ids_start + _aligned(ID_SIZE * count)
+        table_end = table_start + 4 * table_size
+        if table_size & (table_size - 1) or len(self._mmap) != table_end:
+            raise ValueError(f"{path}: файл каталога повреждён")
+        view = memoryview(self._mmap)
+        self._offsets = view[offsets_start:ids_start].cast('Q')
+        self._ids = view[ids_start:ids_start + ID_SIZE * count]
+        self._table = view[table_start:table_end].cast('I')
+        if self._offsets[count] != text_size:
+            raise ValueError(f"{path}: файл каталога повреждён")
+
+    def __len__(self) -> int:
+        return self._count
+
+    def message(self, index: int) -> str:
+        """
+        Декодирует текст сообщения по его номеру.
+        """
+        start = self._text_start + self._offsets[index]
+        end = self._text_start + self._offsets[index + 1]
+        return self._mmap[start:end].decode('utf-8')
+
+    def message_id(self, index: int) -> str:
+        """
+        Возвращает стабильный идентификатор сообщения по его номеру.
+        """
+        return self._ids[ID_SIZE * index:ID_SIZE * (index + 1)].hex()
+
+    def ids_of(self, indices: Iterable[int]) -> List[str]:
+        """
+        Переводит номера сообщений в идентификаторы (для сохранения состояния).
+        """
+        ids = self._ids
+        return [ids[ID_SIZE * index:ID_SIZE * (index + 1)].hex() for index in indices]
+
+    def _find(self, key: bytes) -> Optional[int]:
+        table = self._table
+        mask = len(table) - 1
+        slot = int.from_bytes(key[:4], 'little') & mask
+        while True:
+            entry = table[slot]
+            if not entry:
+                return None
+            if self._ids[ID_SIZE * (entry - 1):ID_SIZE * entry] == key:
+                return entry - 1
+            slot = (slot + 1) & mask
+
+    def index_of(self, message_id: str) -> Optional[int]:
+        """
+        Возвращает номер сообщения по идентификатору или None, если его нет в каталоге.
+        """
+        try:
+            key = bytes.fromhex(message_id)
+        except (TypeError, ValueError):
+            return None
+        if len(key) != ID_SIZE or not self._count:
+            return None
+        return self._find(key)
+
+    def index_in(self, index: int, other: "MessageCatalog") -> Optional[int]:
+        """
+        Возвращает номер сообщения index этого каталога в каталоге other
+        или None, если в other его нет.
+        """
+        if not len(other):
+            return None
+        return other._find(bytes(self._ids[ID_SIZE * index:ID_SIZE * (index + 1)]))
+
+    def remap_to(self, other: "MessageCatalog") -> array:
+        """
+        Таблица перевода номеров этого каталога в номера каталога other:
+        элемент i — номер того же сообщения в other плюс один (0 — сообщение удалено).
+        """
+        remap = array('I', bytes(4 * self._count))
+        if not len(other):
+            return remap
+        for index in range(self._count):
+            found = other._find(bytes(self._ids[ID_SIZE * index:ID_SIZE * (index + 1)]))
+            if found is not None:
+                remap[index] = found + 1
+        return remap
+
+
+def version_path(target: Path, digest: str) -> Path:
+    """
+    Путь прежней версии скомпилированного каталога с хэшем исходного JSON digest.
+    """
+    return target.with_name(f"{target.stem}@{digest}{target.suffix}")
+
+def open_catalog(path: Path, signature: Tuple[int, int]) -> Optional[MessageCatalog]:
+    """
+    Открывает скомпилированный каталог, если он собран из файла с этим отпечатком.
+    """
+    try:
+        catalog = MessageCatalog(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Скомпилированный каталог {path} не прочитан: {e}")
+        return None
+    return catalog if catalog.signature == signature else None
+
+def write_catalog(path: Path, messages: List[str], digest: bytes, signature: Tuple[int, int]) -> None:
+    """
+    Атомарно записывает скомпилированный каталог. Тексты пишутся в файл сразу,
+    в памяти копятся только смещения и идентификаторы. Повторяющиеся тексты
+    (с одинаковым идентификатором) сохраняются один раз.
+    """
+    offsets = array('Q', [0])
+    ids = bytearray()
+    seen = set()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(bytes(HEADER.size))  # Заголовок пишется последним, когда известны размеры
+        for message in messages:
+            data = message.encode('utf-8')
+            key = hashlib.blake2b(data, digest_size=ID_SIZE).digest()
+            if key in seen:
+                continue
+            seen.add(key)
+            ids += key
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+        count = len(offsets) - 1
+        text_size = offsets[-1]
+        table = array('I', bytes(4 * _table_size(count)))
+        mask = len(table) - 1
+        for index in range(count):
+            slot = int.from_bytes(ids[ID_SIZE * index:ID_SIZE * index + 4], 'little') & mask
+            while table[slot]:
+                slot = (slot + 1) & mask
+            table[slot] = index + 1
+        f.write(bytes(_aligned(text_size) - text_size))
+        f.write(offsets.tobytes())
+        f.write(ids)
+        f.write(bytes(_aligned(len(ids)) - len(ids)))
+        f.write(table.tobytes())
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, digest, signature[0], signature[1], count, len(table), text_size))
+    os.replace(tmp_path, path)
+
+def compile_catalog(source: Path, target: Path) -> Optional[MessageCatalog]:
+    """
+    Собирает скомпилированный каталог из messages_<category>.json.
+
+    Если содержимое JSON не изменилось (файл только тронули), в готовом
+    каталоге обновляется лишь отпечаток исходного файла. Иначе прежний файл
+    остаётся рядом под именем version_path: по нему очереди, начавшие круг
+    до правки, находят свои сообщения. Выполняется
+    в отдельном потоке: большой JSON разбирается здесь целиком один раз.
+    Returns:
+        Открытый каталог или None, если файл не читается или имеет неверный формат.
+    """
+    try:
+        with open(source, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            raw = f.read()
+    except OSError as e:
+        logger.warning(f"Файл {source} не прочитан: {e}")
+        return None
+    signature = (stat.st_mtime_ns, stat.st_size)
+    digest = hashlib.blake2b(raw, digest_size=16).digest()
+
+    try:
+        existing = MessageCatalog(target)
+    except (OSError, ValueError):
+        existing = None
+    if existing is not None and existing.digest == digest.hex():
+        try:
+            with open(target, 'r+b') as f:
+                f.write(HEADER.pack(MAGIC, digest, signature[0], signature[1],
+                                    len(existing), len(existing._table), existing._offsets[len(existing)]))
+            return MessageCatalog(target)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Не удалось обновить отпечаток каталога {target}: {e}")
+    elif existing is not None:
+        previous = version_path(target, existing.digest)
+        try:
+            if not previous.exists():
+                os.link(target, previous)
+        except OSError as e:
+            logger.warning(f"Прежняя версия каталога {target} не сохранена: {e}")
+
+    try:
+        messages = json.loads(raw.decode('utf-8'))
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        messages = None
+    if not isinstance(messages, list) or not all(isinstance(m, str) for m in messages):
+        logger.warning(f"Файл {source} не содержит список сообщений и пропущен.")
+        return None
+    del raw
+    try:
+        write_catalog(target, messages, digest, signature)
+        return MessageCatalog(target)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Не удалось собрать каталог {target} из {source}: {e}")
+        return None
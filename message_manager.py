@@ -1,32 +1,278 @@
-import random
+import glob
+import asyncio
 import logging
+from array import array
 from pathlib import Path
-from typing import Dict, List
-from json_utils import load_json_file
+from typing import Dict, List, Optional, Tuple
+from message_catalog import MessageCatalog, compile_catalog, open_catalog, version_path
+from metrics import STATE_IO_LATENCY, timed
+from config import CATALOG_COMPILE_CONCURRENCY, CATALOG_KEEP_VERSIONS
 
 logger = logging.getLogger(__name__)
 
+def file_signature(file: Path) -> Tuple[int, int]:
+    """
+    Возвращает отпечаток файла (mtime в наносекундах и размер) для отслеживания изменений.
+    """
+    stat = file.stat()
+    return stat.st_mtime_ns, stat.st_size
+
+def category_of(file: Path) -> str:
+    """
+    Возвращает имя категории по имени файла messages_<category>.json.
+    """
+    return file.stem.replace("messages_", "")
+
 class MessageManager:
     """
     Класс для загрузки и хранения сообщений по категориям.
+
+    Сообщения пишутся в messages_<category>.json, а бот читает их из
+    скомпилированных файлов catalog_dir/<category>.bin (см. message_catalog):
+    файл открывается через mmap, и текст декодируется только у выбранного
+    сообщения. Скомпилированный файл пересобирается, когда меняется JSON,
+    а прежняя версия остаётся рядом как <category>@<хэш>.bin (см. version).
+
+    Каталог можно перечитывать на лету (reload): пересобираются только
+    изменившиеся файлы, а словарь категорий подменяется целиком, поэтому
+    обработчики никогда не видят наполовину обновлённый каталог.
     """
-    def __init__(self, messages_dir: Path, categories: Dict[str, List[str]]) -> None:
+    def __init__(self, messages_dir: Path, categories: Dict[str, MessageCatalog],
+                 catalog_dir: Optional[Path] = None,
+                 signatures: Optional[Dict[str, Tuple[int, int]]] = None) -> None:
         self.messages_dir = messages_dir
+        self.catalog_dir = catalog_dir if catalog_dir is not None else messages_dir / ".catalog"
         self.categories = categories
+        self._signatures: Dict[str, Tuple[int, int]] = signatures or {}  # {category: отпечаток файла}
+        self._rejected: Dict[str, Tuple[int, int]] = {}                  # Отпечатки неразобранных файлов
+        # {category: (прежний каталог, текущий каталог, таблица перевода номеров)}
+        self._remaps: Dict[str, Tuple[MessageCatalog, MessageCatalog, array]] = {}
+        # {(category, хэш JSON): каталог} — открытые прежние версии
+        self._versions: Dict[Tuple[str, str], MessageCatalog] = {}
+        # {(category, хэши версий): номера сообщений последней версии, которых нет в предыдущих}
+        self._added: Dict[Tuple[str, Tuple[str, ...]], array] = {}
+        self.help_text = self._build_help()
+
+    def _build_help(self) -> str:
+        """
+        Собирает текст /help по текущему списку категорий.
+        """
+        lines = ["/post - Отправить случайное сообщение"]
+        for category in self.categories:
+            lines.append(f"/post_{category} - Отправить сообщение из категории '{category}'")
+        lines.append("/schedule - Публикации по расписанию")
+        lines.append("/help - Показать список доступных команд")
+        return "\n".join(lines)
+
+    def remap(self, category: str, previous: MessageCatalog) -> Optional[array]:
+        """
+        Таблица перевода номеров сообщений прежнего каталога категории в номера
+        текущего (см. MessageCatalog.remap_to). Таблица считается один раз
+        и используется всеми шардами, согласующими очереди после reload.
+        Returns:
+            Таблица или None, если категории больше нет.
+        """
+        current = self.categories.get(category)
+        if current is None:
+            return None
+        cached = self._remaps.get(category)
+        if cached is not None and cached[0] is previous and cached[1] is current:
+            return cached[2]
+        remap = previous.remap_to(current)
+        self._remaps[category] = (previous, current, remap)
+        return remap
+
+    def version(self, category: str, digest: Optional[str]) -> Optional[MessageCatalog]:
+        """
+        Каталог категории в версии с хэшем исходного JSON digest: текущий
+        или сохранённый при пересборке. Открытые версии общие для всех шардов.
+        Returns:
+            Каталог или None, если категории или этой версии больше нет.
+        """
+        current = self.categories.get(category)
+        if current is None or digest is None:
+            return None
+        if current.digest == digest:
+            return current
+        catalog = self._versions.get((category, digest))
+        if catalog is None:
+            try:
+                catalog = MessageCatalog(version_path(self._target(category), digest))
+            except (OSError, ValueError):
+                return None
+            self._versions[(category, digest)] = catalog
+        return catalog
+
+    def added(self, category: str, versions: List[MessageCatalog]) -> array:
+        """
+        Номера сообщений последней из версий каталога versions, которых нет
+        ни в одной из предыдущих. Версии неизменны, поэтому список считается
+        один раз и используется всеми шардами с той же цепочкой версий.
+        """
+        key = (category, tuple(version.digest for version in versions))
+        added = self._added.get(key)
+        if added is None:
+            last, earlier = versions[-1], versions[:-1]
+            added = array('I', (index for index in range(len(last))
+                                if all(last.index_in(index, version) is None for version in earlier)))
+            self._added[key] = added
+        return added
+
+    def _prune_versions(self, category: str) -> None:
+        """
+        Удаляет прежние версии каталога категории сверх CATALOG_KEEP_VERSIONS
+        последних: круги, начатые с них, начнутся заново.
+        """
+        versions = []
+        for path in self.catalog_dir.glob(f"{glob.escape(category)}@*.bin"):
+            try:
+                versions.append((path.stat().st_mtime_ns, path))
+            except FileNotFoundError:
+                continue
+        versions.sort(reverse=True)
+        for _, path in versions[max(0, CATALOG_KEEP_VERSIONS):]:
+            path.unlink(missing_ok=True)
+            digest = path.stem.partition("@")[2]
+            self._versions.pop((category, digest), None)
+            for key in [key for key in self._added if key[0] == category and digest in key[1]]:
+                del self._added[key]
+
+    def _target(self, category: str) -> Path:
+        return self.catalog_dir / f"{category}.bin"
+
+    def _remove_compiled(self, categories: List[str]) -> None:
+        """
+        Удаляет скомпилированные файлы категорий, которых больше нет в messages_dir,
+        вместе с их прежними версиями. Уже открытые каталоги остаются читаемыми.
+        """
+        for compiled in self.catalog_dir.glob("*.bin"):
+            # Прежние версии называются <category>@<хэш>.bin
+            category = compiled.stem.partition("@")[0]
+            if category in categories:
+                compiled.unlink(missing_ok=True)
+                self._versions.pop((category, compiled.stem.partition("@")[2]), None)
+        for key in [key for key in self._added if key[0] in categories]:
+            del self._added[key]
+
+    async def _compile(self, files: Dict[str, Path]) -> List[Optional[MessageCatalog]]:
+        """
+        Компилирует файлы категорий в фоновых потоках, не больше
+        CATALOG_COMPILE_CONCURRENCY одновременно: разбор большого JSON временно
+        занимает память, и неограниченная параллельная сборка сложила бы все эти пики.
+        Returns:
+            Каталоги в порядке files.
+        """
+        semaphore = asyncio.Semaphore(max(1, CATALOG_COMPILE_CONCURRENCY))
+
+        async def compile_one(category: str, file: Path) -> Optional[MessageCatalog]:
+            async with semaphore:
+                return await asyncio.to_thread(compile_catalog, file, self._target(category))
+
+        return await asyncio.gather(*(compile_one(category, file) for category, file in files.items()))
+
+    @timed(STATE_IO_LATENCY, "reload_catalog")
+    async def reload(self) -> Tuple[List[str], List[str], List[str]]:
+        """
+        Перечитывает изменившиеся файлы messages_*.json.
+
+        Файлы с прежним отпечатком (mtime и размер) не читаются, изменившиеся
+        компилируются параллельно в фоновых потоках. Если изменённый файл
+        не удалось разобрать (например, его сохраняют прямо сейчас), категория
+        остаётся прежней и будет перечитана при следующей проверке.
+        Скомпилированные файлы удалённых категорий удаляются.
+
+        Returns:
+            Списки добавленных, удалённых и изменённых категорий.
+        """
+        files = {category_of(file): file for file in self.messages_dir.glob("messages_*.json")
+                 if file.is_file()}
+        categories = dict(self.categories)
+        signatures = dict(self._signatures)
+        added: List[str] = []
+        changed: List[str] = []
+        removed = [category for category in self.categories if category not in files]
+
+        for category in removed:
+            del categories[category]
+            signatures.pop(category, None)
+            self._remaps.pop(category, None)
+        if removed:
+            self._remove_compiled(removed)
+
+        pending: Dict[str, Tuple[int, int]] = {}
+        for category, file in files.items():
+            try:
+                signature = file_signature(file)
+            except FileNotFoundError:
+                continue
+            if signature not in (signatures.get(category), self._rejected.get(category)):
+                pending[category] = signature
+        results = await self._compile({category: files[category] for category in pending})
+
+        for (category, signature), catalog in zip(pending.items(), results):
+            if catalog is None:
+                # Не предупреждаем повторно, пока файл снова не изменится
+                self._rejected[category] = signature
+                continue
+            self._rejected.pop(category, None)
+            signatures[category] = signature
+            current = categories.get(category)
+            if current is not None and current.digest == catalog.digest:
+                # Файл тронули (например, git checkout), но содержимое прежнее
+                continue
+            (changed if category in categories else added).append(category)
+            categories[category] = catalog
+            self._prune_versions(category)
+
+        self._signatures = signatures
+        if added or removed or changed:
+            # Подменяем словарь целиком: читатели видят либо старый, либо новый каталог
+            self.categories = {category: categories[category] for category in sorted(categories)}
+            self.help_text = self._build_help()
+            logger.info(f"Каталог сообщений обновлён: добавлены {added}, удалены {removed}, изменены {changed}")
+        return added, removed, changed
 
     @classmethod
-    async def create(cls, messages_dir: Path) -> "MessageManager":
+    @timed(STATE_IO_LATENCY, "load_catalog")
+    async def create(cls, messages_dir: Path, catalog_dir: Optional[Path] = None) -> "MessageManager":
         """
         Фабричный метод для асинхронного создания экземпляра MessageManager,
         загружая все файлы вида messages_*.json из указанной директории.
+
+        Файлы, отпечаток которых совпадает со скомпилированным каталогом в catalog_dir,
+        не читаются вовсе: каталог просто отображается в память. Остальные
+        компилируются параллельно в фоновых потоках, а скомпилированные файлы
+        удалённых категорий (со всеми прежними версиями) удаляются.
         """
-        categories: Dict[str, List[str]] = {}
-        for file in messages_dir.glob("messages_*.json"):
-            if file.is_file():
-                category = file.stem.replace("messages_", "")
-                messages = await load_json_file(file, default=[])
-                # Если сообщения присутствуют, перемешиваем их
-                if messages:
-                    messages = random.sample(messages, len(messages))
-                categories[category] = messages
-        return cls(messages_dir, categories)
+        manager = cls(messages_dir, {}, catalog_dir)
+        files = {category_of(file): file for file in messages_dir.glob("messages_*.json") if file.is_file()}
+        categories: Dict[str, MessageCatalog] = {}
+        signatures: Dict[str, Tuple[int, int]] = {}
+        pending: List[str] = []
+        for category, file in files.items():
+            signatures[category] = file_signature(file)
+            catalog = open_catalog(manager._target(category), signatures[category])
+            if catalog is not None:
+                categories[category] = catalog
+            else:
+                pending.append(category)
+
+        results = await manager._compile({category: files[category] for category in pending})
+        for category, catalog in zip(pending, results):
+            if catalog is None:
+                del signatures[category]
+                continue
+            categories[category] = catalog
+
+        for category in pending:
+            manager._prune_versions(category)
+        compiled = {path.stem.partition("@")[0] for path in manager.catalog_dir.glob("*.bin")}
+        manager._remove_compiled([category for category in compiled if category not in files])
+
+        # Порядок категорий не зависит от порядка, в котором файлы скомпилировались
+        manager.categories = {category: categories[category] for category in sorted(categories)}
+        manager._signatures = signatures
+        manager.help_text = manager._build_help()
+        logger.info(f"Каталог загружен: категорий {len(categories)}, "
+                    f"готовых {len(files) - len(pending)}, скомпилировано файлов {len(pending)}.")
+        return manager
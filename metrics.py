@@ -0,0 +1,219 @@
+import time
+import bisect
+import functools
+from abc import ABC, abstractmethod
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+LabelValues = Tuple[str, ...]
+
+# Границы корзин гистограмм задержки, в секундах
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric(ABC):
+    """
+    Базовый класс метрики: имя, описание и имена меток.
+    """
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        """
+        Строки значений метрики в текстовом формате Prometheus.
+        """
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """
+    Монотонно растущий счётчик.
+    """
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values: str) -> float:
+        return self._values.get(label_values, 0)
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labels, values)} {_format_value(value)}"
+                for values, value in self._values.items()]
+
+
+class Gauge(Metric):
+    """
+    Текущее значение, которое вычисляется функцией collect в момент чтения метрик.
+    collect возвращает {значения меток: значение}; так счётчики очередей и размеры
+    файлов ничего не стоят между запросами метрик.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 collect: Optional[Callable[[], Dict[LabelValues, float]]] = None) -> None:
+        super().__init__(name, documentation, labels)
+        self.collect = collect
+
+    def samples(self) -> List[str]:
+        if self.collect is None:
+            return []
+        return [f"{self.name}{_format_labels(self.labels, values)} {_format_value(value)}"
+                for values, value in self.collect().items()]
+
+
+class Histogram(Metric):
+    """
+    Гистограмма с фиксированными корзинами: наблюдение — это бинарный поиск
+    и два сложения, поэтому её можно держать включённой постоянно.
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._counts: Dict[LabelValues, List[int]] = {}  # Не накопительные счётчики по корзинам (+Inf последняя)
+        self._sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        counts = self._counts.get(label_values)
+        if counts is None:
+            counts = self._counts[label_values] = [0] * (len(self.buckets) + 1)
+            self._sums[label_values] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[label_values] += value
+
+    def count(self, *label_values: str) -> int:
+        return sum(self._counts.get(label_values, ()))
+
+    def samples(self) -> List[str]:
+        lines = []
+        for values, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, values, le)} {cumulative}")
+            labels = _format_labels(self.labels, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(self._sums[values])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Набор метрик процесса и их вывод в текстовом формате Prometheus.
+    """
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def gauge(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+              collect: Optional[Callable[[], Dict[LabelValues, float]]] = None) -> Gauge:
+        return self.register(Gauge(name, documentation, labels, collect))
+
+    def render(self) -> str:
+        """
+        Возвращает все метрики в текстовом формате Prometheus 0.0.4.
+        """
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+HANDLER_LATENCY = REGISTRY.histogram(
+    "bot_handler_duration_seconds", "Время обработки обновления обработчиком.", ("handler",))
+STATE_IO_LATENCY = REGISTRY.histogram(
+    "bot_state_io_duration_seconds", "Время операций чтения и записи состояния и каталога.", ("operation",))
+COMMANDS = REGISTRY.counter(
+    "bot_commands_total", "Команды /post по категориям (any — случайная категория).", ("category",))
+RATE_LIMITED = REGISTRY.counter(
+    "bot_rate_limited_total", "Команды, отклонённые ограничителем частоты.")
+SEND_FAILURES = REGISTRY.counter(
+    "bot_send_failures_total", "Сообщения, которые не удалось доставить.", ("reason",))
+SEND_RETRIES = REGISTRY.counter(
+    "bot_send_retries_total", "Повторные попытки отправки.", ("reason",))
+NEW_PARTICIPANTS = REGISTRY.counter(
+    "bot_new_participants_total", "Новые участники чатов.")
+SCHEDULED_POSTS = REGISTRY.counter(
+    "bot_scheduled_posts_total", "Публикации по расписанию (posted, failed, missed — пропущена за время сна).",
+    ("result",))
+
+def timed(histogram: Histogram, *label_values: str) -> Callable[[Callable[..., Awaitable[T]]],
+                                                               Callable[..., Awaitable[T]]]:
+    """
+    Декоратор асинхронной функции: записывает время её выполнения в гистограмму
+    (в том числе, если функция завершилась исключением).
+    """
+    def decorator(func: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> T:
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, *label_values)
+        return wrapper
+    return decorator
+
+def register_state_gauges(chat_registry: Any, storage: Any, dispatcher: Any) -> None:
+    """
+    Регистрирует метрики текущего состояния бота. Значения считаются только
+    при запросе /metrics и только по шардам, загруженным в память.
+    """
+    def queue_lengths() -> Dict[LabelValues, float]:
+        lengths: Dict[LabelValues, float] = {}
+        for shard in chat_registry.loaded_shards():
+            for category, queue in shard.message_queues.items():
+                lengths[(category,)] = lengths.get((category,), 0) + len(queue)
+        return lengths
+
+    REGISTRY.gauge("bot_message_queue_remaining",
+                   "Сообщения, оставшиеся в текущем круге очередей категорий (загруженные чаты).",
+                   ("category",), queue_lengths)
+    REGISTRY.gauge("bot_participants", "Участники загруженных чатов.", (),
+                   lambda: {(): sum(len(shard.participants) for shard in chat_registry.loaded_shards())})
+    REGISTRY.gauge("bot_loaded_chats", "Шарды чатов в памяти.", (),
+                   lambda: {(): chat_registry.loaded_count})
+    REGISTRY.gauge("bot_send_queue_length", "Сообщения, ожидающие отправки.", (),
+                   lambda: {(): dispatcher.pending()})
+    REGISTRY.gauge("bot_state_size_bytes", "Размер сохранённого состояния на диске.", (),
+                   lambda: {(): storage.size_bytes()})
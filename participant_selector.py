@@ -0,0 +1,283 @@
+import math
+import random
+from typing import Dict, Iterable, List, Optional, Set
+from config import (PARTICIPANT_BASE_WEIGHT, PARTICIPANT_ACTIVITY_HALF_LIFE, PARTICIPANT_PICK_HALF_LIFE,
+                    PARTICIPANT_ABSENCE_WINDOW)
+
+# Сколько кандидатов отбраковать штрафом за недавний выбор, прежде чем взять
+# лучшего из них (когда недавно выбирали почти всех)
+MAX_ATTEMPTS = 32
+# Показатель экспоненты масштаба активности, после которого начало отсчёта
+# переносится и веса пересчитываются (задолго до переполнения float)
+MAX_EXPONENT = 500.0
+
+
+class FenwickTree:
+    """
+    Дерево Фенвика над неотрицательными весами: изменение веса, добавление
+    элемента и поиск элемента по префиксной сумме — O(log n).
+    """
+    def __init__(self, weights: Iterable[float] = ()) -> None:
+        self.rebuild(weights)
+
+    def __len__(self) -> int:
+        return len(self._weights)
+
+    def rebuild(self, weights: Iterable[float]) -> None:
+        """
+        Строит дерево заново за O(n); заодно сбрасывает накопленную ошибку округления.
+        """
+        self._weights: List[float] = list(weights)
+        tree = [0.0] + self._weights
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+        self._updates = 0
+
+    def weight(self, index: int) -> float:
+        return self._weights[index]
+
+    @property
+    def total(self) -> float:
+        total = 0.0
+        i = len(self._weights)
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def append(self, weight: float) -> int:
+        """
+        Добавляет элемент в конец и возвращает его номер.
+        """
+        self._weights.append(weight)
+        i = len(self._weights)
+        value = weight
+        # Узел i покрывает элементы (i - lowbit(i), i]: собираем уже готовые поддеревья
+        j, stop = i - 1, i - (i & -i)
+        while j > stop:
+            value += self._tree[j]
+            j -= j & -j
+        self._tree.append(value)
+        return i - 1
+
+    def set(self, index: int, weight: float) -> None:
+        """
+        Меняет вес элемента.
+        """
+        delta = weight - self._weights[index]
+        if not delta:
+            return
+        self._weights[index] = weight
+        i = index + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+        self._updates += 1
+        if self._updates > 4 * len(self._weights) + 1024:
+            # Пересборка раз в O(n) изменений не даёт ошибкам округления накапливаться
+            self.rebuild(self._weights)
+
+    def find(self, value: float) -> int:
+        """
+        Возвращает номер элемента, на котором префиксная сумма весов превышает value.
+        """
+        count = len(self._weights)
+        position = 0
+        step = 1 << (count.bit_length() - 1) if count else 0
+        while step:
+            following = position + step
+            if following <= count and self._tree[following] <= value:
+                position = following
+                value -= self._tree[following]
+            step >>= 1
+        return min(position, count - 1)
+
+
+class ParticipantSelector:
+    """
+    Взвешенный выбор участника чата для /post.
+
+    Вес участника — (base_weight + активность) × штраф за недавний выбор:
+    - активность — число его сообщений, затухающее вдвое за activity_half_life секунд;
+    - штраф 1 - 2^(-t / pick_half_life), где t — время с последнего выбора;
+    - вышедшие из чата, зарезервированные и не писавшие дольше absence_window
+      секунд (0 — не исключать) участники не выбираются.
+
+    Постоянная часть и активность лежат в двух деревьях Фенвика, причём
+    активность — в масштабе exp((t - origin) / τ): общее затухание сокращается
+    и не требует пересчёта весов, поэтому выбор и обновление веса — O(log n).
+    Штраф учитывается отбраковкой кандидата (распределение при этом точное),
+    а отсутствующий кандидат сразу убирается из деревьев.
+
+    Статистика участника хранится как [активность, её время, последнее сообщение,
+    последний выбор]; время последнего сообщения 0 означает, что участник вышел из чата.
+    """
+    def __init__(self, base_weight: float = PARTICIPANT_BASE_WEIGHT,
+                 activity_half_life: float = PARTICIPANT_ACTIVITY_HALF_LIFE,
+                 pick_half_life: float = PARTICIPANT_PICK_HALF_LIFE,
+                 absence_window: float = PARTICIPANT_ABSENCE_WINDOW) -> None:
+        self.base_weight = base_weight
+        self.tau = max(activity_half_life, 1.0) / math.log(2)
+        self.pick_half_life = pick_half_life
+        self.absence_window = absence_window
+        self.stats: Dict[str, List[float]] = {}
+        self._ids: List[str] = []            # Номер в деревьях → participant_id
+        self._slots: Dict[str, int] = {}     # participant_id → номер в деревьях
+        self._reserved: Set[str] = set()
+        self._origin = 0.0
+        self._base = FenwickTree()
+        self._activity = FenwickTree()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def load(self, stats: Dict[str, List[float]], participants: Iterable[str], now: float) -> None:
+        """
+        Восстанавливает статистику за O(n). Участникам без статистики (состояние
+        прежнего формата) последним сообщением считается now.
+        """
+        self.stats = {participant_id: [float(value) for value in stats[participant_id]]
+                      if participant_id in stats else [0.0, now, now, 0.0]
+                      for participant_id in participants}
+        self._ids = list(self.stats)
+        self._slots = {participant_id: slot for slot, participant_id in enumerate(self._ids)}
+        self._reserved = set()
+        self._origin = now
+        self._rebuild(now)
+
+    def _rebuild(self, now: float) -> None:
+        self._base.rebuild(self._base_weight(participant_id, now) for participant_id in self._ids)
+        self._activity.rebuild(self._scaled(participant_id, now) for participant_id in self._ids)
+
+    def _absent(self, participant_id: str, now: float) -> bool:
+        seen = self.stats[participant_id][2]
+        return seen <= 0 or (self.absence_window > 0 and seen < now - self.absence_window)
+
+    def _eligible(self, participant_id: str, now: float) -> bool:
+        return participant_id not in self._reserved and not self._absent(participant_id, now)
+
+    def _base_weight(self, participant_id: str, now: float) -> float:
+        return 1.0 if self._eligible(participant_id, now) else 0.0
+
+    def _scaled(self, participant_id: str, now: float) -> float:
+        if not self._eligible(participant_id, now):
+            return 0.0
+        activity, at = self.stats[participant_id][:2]
+        return activity * math.exp((at - self._origin) / self.tau) if activity else 0.0
+
+    def _refresh(self, participant_id: str, now: float) -> None:
+        """
+        Пересчитывает веса участника в деревьях, O(log n).
+        """
+        if (now - self._origin) / self.tau > MAX_EXPONENT:
+            self._origin = now
+            self._rebuild(now)
+            return
+        slot = self._slots[participant_id]
+        self._base.set(slot, self._base_weight(participant_id, now))
+        self._activity.set(slot, self._scaled(participant_id, now))
+
+    def add(self, participant_id: str, at: float) -> None:
+        """
+        Добавляет участника, только что написавшего сообщение.
+        """
+        if participant_id in self._slots:
+            self.seen(participant_id, at)
+            return
+        self.stats[participant_id] = [1.0, at, at, 0.0]
+        self._slots[participant_id] = len(self._ids)
+        self._ids.append(participant_id)
+        self._base.append(0.0)
+        self._activity.append(0.0)
+        self._refresh(participant_id, at)
+
+    def seen(self, participant_id: str, at: float) -> None:
+        """
+        Учитывает сообщение участника: активность растёт на единицу.
+        """
+        stats = self.stats[participant_id]
+        activity, activity_at = stats[0], stats[1]
+        latest = max(activity_at, at)
+        # Сообщения могут прийти не по порядку (очередь после сна), поэтому
+        # обе части приводятся к более позднему времени
+        stats[0] = activity * math.exp((activity_at - latest) / self.tau) + math.exp((at - latest) / self.tau)
+        stats[1] = latest
+        stats[2] = max(stats[2], at)
+        self._refresh(participant_id, at)
+
+    def set_activity(self, participant_id: str, activity: float, at: float) -> None:
+        """
+        Устанавливает сохранённое значение активности (операция participant_seen).
+        """
+        stats = self.stats[participant_id]
+        stats[0], stats[1], stats[2] = activity, at, max(stats[2], at)
+        self._refresh(participant_id, at)
+
+    def picked(self, participant_id: str, at: float) -> None:
+        """
+        Запоминает время выбора участника (для штрафа за недавний выбор).
+        """
+        self.stats[participant_id][3] = at
+
+    def left(self, participant_id: str, now: float) -> None:
+        """
+        Исключает участника, вышедшего из чата, до его следующего сообщения.
+        """
+        self.stats[participant_id][2] = 0.0
+        self._refresh(participant_id, now)
+
+    def reserve(self, participant_id: str, now: float) -> None:
+        self._reserved.add(participant_id)
+        self._refresh(participant_id, now)
+
+    def release(self, participant_id: str, now: float) -> None:
+        if participant_id in self._reserved:
+            self._reserved.discard(participant_id)
+            self._refresh(participant_id, now)
+
+    def _pick_factor(self, participant_id: str, now: float) -> float:
+        picked = self.stats[participant_id][3]
+        if picked <= 0 or self.pick_half_life <= 0:
+            return 1.0
+        return 1.0 - 2.0 ** (-max(now - picked, 0.0) / self.pick_half_life)
+
+    def choose(self, now: float, rng: random.Random = random) -> Optional[str]:
+        """
+        Выбирает участника с вероятностью, пропорциональной его весу.
+        Returns:
+            participant_id или None, если выбрать некого.
+        """
+        best: Optional[str] = None
+        best_factor = -1.0
+        attempts = 0
+        while attempts < MAX_ATTEMPTS:
+            base_total = self._base.total * self.base_weight
+            decay = math.exp((self._origin - now) / self.tau)
+            total = base_total + self._activity.total * decay
+            if total <= 1e-12:
+                break
+            value = rng.random() * total
+            if value < base_total:
+                tree, value = self._base, value / self.base_weight
+            else:
+                tree, value = self._activity, (value - base_total) / decay
+            slot = tree.find(value)
+            if tree.weight(slot) <= 0:
+                # Погрешность округления на границе — просто повторяем
+                attempts += 1
+                continue
+            participant_id = self._ids[slot]
+            if self._absent(participant_id, now):
+                # Давно не писал: убираем из деревьев до следующего сообщения
+                self._refresh(participant_id, now)
+                continue
+            attempts += 1
+            factor = self._pick_factor(participant_id, now)
+            if rng.random() < factor:
+                return participant_id
+            if factor > best_factor:
+                best, best_factor = participant_id, factor
+        return best
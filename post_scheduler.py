@@ -0,0 +1,412 @@
+import re
+import time
+import heapq
+import random
+import asyncio
+import logging
+import itertools
+from datetime import date, datetime, timedelta, timezone, tzinfo
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple, Union
+from zoneinfo import ZoneInfo
+from telegram.ext import ContextTypes, Job, JobQueue
+from storage import StateStorage, ScheduleChanges
+from metrics import SCHEDULED_POSTS
+from config import SCHEDULE_TIMEZONE, SCHEDULE_CATCH_UP_WINDOW, SCHEDULE_MAX_PER_CHAT
+
+logger = logging.getLogger(__name__)
+
+# Публикация по расписанию: (chat_id, категория или None — случайная категория)
+PostCallback = Callable[[str, Optional[str]], Awaitable[None]]
+
+# Сколько публикаций по расписанию выполнять одновременно (остальные ждут)
+MAX_CONCURRENT_POSTS = 32
+# Через сколько секунд повторить срабатывание, если last не удалось сохранить
+SAVE_RETRY_DELAY = 30.0
+# Больше публикаций в день расписанию daily не нужно
+MAX_DAILY_POSTS = 48
+# Насколько далеко искать срабатывание cron: "0 0 30 2 *" не сработает никогда
+CRON_SEARCH_DAYS = 366 * 8
+WINDOW_PATTERN = re.compile(r"^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$")
+# Поля cron: название для сообщения об ошибке, минимум и максимум
+CRON_FIELDS = (("минуты", 0, 59), ("часы", 0, 23), ("дни месяца", 1, 31), ("месяцы", 1, 12), ("дни недели", 0, 7))
+
+
+def schedule_timezone(name: str) -> tzinfo:
+    """
+    Часовой пояс расписаний; UTC не требует базы часовых поясов в системе.
+    """
+    return timezone.utc if name.upper() == "UTC" else ZoneInfo(name)
+
+def _parse_cron_field(text: str, name: str, low: int, high: int) -> List[int]:
+    values: Set[int] = set()
+    for part in text.split(","):
+        body, _, step_text = part.partition("/")
+        try:
+            step = int(step_text) if step_text else 1
+            if body == "*":
+                start, end = low, high
+            elif "-" in body:
+                start_text, end_text = body.split("-", 1)
+                start, end = int(start_text), int(end_text)
+            else:
+                start = int(body)
+                end = high if step_text else start
+        except ValueError:
+            raise ValueError(f"Неверное поле cron ({name}): {part}")
+        if step < 1 or start < low or end > high or start > end:
+            raise ValueError(f"Неверное поле cron ({name}): {part}")
+        values.update(range(start, end + 1, step))
+    return sorted(values)
+
+
+class CronSchedule:
+    """
+    Расписание cron: "<минуты> <часы> <дни месяца> <месяцы> <дни недели>"
+    (*, списки, диапазоны и шаг; воскресенье — 0 или 7). Как и в cron, если
+    заданы и дни месяца, и дни недели, подходит любой из них.
+    """
+    def __init__(self, fields: List[str], tz: tzinfo) -> None:
+        if len(fields) != 5:
+            raise ValueError("Расписание cron состоит из пяти полей: минуты, часы, дни месяца, месяцы, дни недели.")
+        minutes, hours, days, months, weekdays = (
+            _parse_cron_field(text, *spec) for text, spec in zip(fields, CRON_FIELDS))
+        self.minutes, self.hours = minutes, hours
+        self.days, self.months = set(days), set(months)
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+        self.any_day, self.any_weekday = fields[2] == "*", fields[4] == "*"
+        self.tz = tz
+
+    def _day_matches(self, day: datetime) -> bool:
+        in_month = day.day in self.days
+        in_week = (day.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return in_month and in_week
+        return in_month or in_week
+
+    def next_after(self, moment: float) -> Optional[float]:
+        """
+        Первое срабатывание строго после moment или None, если его нет.
+        Перебор идёт скачками по месяцам, дням, часам и минутам.
+        """
+        local = datetime.fromtimestamp(moment, self.tz).replace(tzinfo=None, second=0, microsecond=0)
+        local += timedelta(minutes=1)
+        limit = local + timedelta(days=CRON_SEARCH_DAYS)
+        while local < limit:
+            if local.month not in self.months:
+                local = (local.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+                continue
+            if not self._day_matches(local):
+                local = local.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
+            hour = next((hour for hour in self.hours if hour >= local.hour), None)
+            if hour is None:
+                local = local.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
+            if hour != local.hour:
+                local = local.replace(hour=hour, minute=0)
+            minute = next((minute for minute in self.minutes if minute >= local.minute), None)
+            if minute is None:
+                local = local.replace(minute=0) + timedelta(hours=1)
+                continue
+            local = local.replace(minute=minute)
+            fire_at = local.replace(tzinfo=self.tz).timestamp()
+            # При переводе часов назад местное время повторяется — срабатываем один раз
+            if fire_at > moment:
+                return fire_at
+            local += timedelta(minutes=1)
+        return None
+
+
+class DailySchedule:
+    """
+    count публикаций в день в случайное время внутри окна "ЧЧ:ММ-ЧЧ:ММ"
+    (окно может переходить через полночь). Время выбирается детерминированно
+    по ключу расписания и дате, поэтому после перезапуска публикации дня
+    приходятся на то же время.
+    """
+    def __init__(self, count: int, window: str, key: str, tz: tzinfo) -> None:
+        if not 1 <= count <= MAX_DAILY_POSTS:
+            raise ValueError(f"Число публикаций в день должно быть от 1 до {MAX_DAILY_POSTS}.")
+        match = WINDOW_PATTERN.match(window)
+        if not match:
+            raise ValueError(f"Неверное окно времени: {window} (нужно ЧЧ:ММ-ЧЧ:ММ).")
+        start_hour, start_minute, end_hour, end_minute = (int(group) for group in match.groups())
+        if start_hour > 24 or end_hour > 24 or start_minute > 59 or end_minute > 59:
+            raise ValueError(f"Неверное окно времени: {window}.")
+        self.start = (start_hour * 60 + start_minute) * 60
+        self.end = (end_hour * 60 + end_minute) * 60
+        if self.end <= self.start:
+            self.end += 24 * 3600
+        self.count = count
+        self.key = key
+        self.tz = tz
+
+    def _day_slots(self, day: date) -> List[float]:
+        rng = random.Random(f"{self.key}:{day.isoformat()}")
+        midnight = datetime(day.year, day.month, day.day)
+        offsets = sorted(self.start + rng.random() * (self.end - self.start) for _ in range(self.count))
+        return [(midnight + timedelta(seconds=offset)).replace(tzinfo=self.tz).timestamp() for offset in offsets]
+
+    def next_after(self, moment: float) -> Optional[float]:
+        """
+        Первая публикация строго после moment. Окно вчерашнего дня может
+        заходить на сегодня, а завтрашний день всегда даёт публикацию позже moment.
+        """
+        day = datetime.fromtimestamp(moment, self.tz).date() - timedelta(days=1)
+        for _ in range(3):
+            for fire_at in self._day_slots(day):
+                if fire_at > moment:
+                    return fire_at
+            day += timedelta(days=1)
+        return None
+
+
+Schedule = Union[CronSchedule, DailySchedule]
+
+def parse_schedule(spec: str, key: str, tz: tzinfo) -> Schedule:
+    """
+    Разбирает сохранённое описание расписания: "cron <5 полей>" или "daily <N> <окно>".
+    """
+    words = spec.split()
+    if words and words[0] == "cron":
+        return CronSchedule(words[1:], tz)
+    if len(words) == 3 and words[0] == "daily" and words[1].isdigit():
+        return DailySchedule(int(words[1]), words[2], key, tz)
+    raise ValueError(f"Неизвестное расписание: {spec}")
+
+def parse_schedule_args(args: List[str]) -> Tuple[str, Optional[str]]:
+    """
+    Разбирает аргументы команды /schedule:
+    - cron <минуты> <часы> <дни месяца> <месяцы> <дни недели> [категория]
+    - daily <N> [ЧЧ:ММ-ЧЧ:ММ] [категория]
+    Returns:
+        (описание расписания, категория или None — случайная категория)
+    """
+    if args and args[0] == "cron":
+        if len(args) not in (6, 7):
+            raise ValueError("Расписание cron состоит из пяти полей: минуты, часы, дни месяца, месяцы, дни недели.")
+        return " ".join(args[:6]), (args[6].lower() if len(args) == 7 else None)
+    if args and args[0] == "daily":
+        rest = args[1:]
+        if not rest or not rest[0].isdigit():
+            raise ValueError("Укажите число публикаций в день: /schedule daily 3 10:00-22:00")
+        count = rest.pop(0)
+        window = rest.pop(0) if rest and WINDOW_PATTERN.match(rest[0]) else "00:00-24:00"
+        if len(rest) > 1:
+            raise ValueError("Лишние аргументы после категории.")
+        return f"daily {count} {window}", (rest[0].lower() if rest else None)
+    raise ValueError("Неизвестный вид расписания: нужен cron или daily.")
+
+
+class _Entry:
+    """
+    Расписание чата в планировщике. due — ближайшая публикация (None — не запланирована).
+    """
+    __slots__ = ("chat_id", "schedule_id", "record", "schedule", "due")
+
+    def __init__(self, chat_id: str, schedule_id: str, record: Dict[str, Any], schedule: Schedule) -> None:
+        self.chat_id = chat_id
+        self.schedule_id = schedule_id
+        self.record = record       # {"spec", "category", "last"} — как в хранилище
+        self.schedule = schedule
+        self.due: Optional[float] = None
+
+
+class PostScheduler:
+    """
+    Публикации по расписанию во всех чатах на одной куче (heapq) и одном таймере
+    JobQueue, заведённом на ближайшую публикацию: число заданий JobQueue не зависит
+    от числа чатов, а добавление, удаление и срабатывание расписания стоят O(log n).
+    Удалённые расписания не ищутся в куче, а отбрасываются, когда оказываются наверху.
+
+    Расписания хранятся в хранилище состояния (StateStorage.load_schedules) отдельно
+    от шардов, чтобы при запуске не загружать состояние всех чатов. Время последней
+    отработки (last) записывается до публикации, поэтому после перезапуска
+    расписание не срабатывает повторно. Пропущенные за время сна публикации
+    выполняются одной, если последняя из них не старше catch_up_window секунд;
+    результат зависит только от last и текущего времени.
+    """
+    def __init__(self, storage: StateStorage, post: PostCallback, tz: Optional[tzinfo] = None,
+                 catch_up_window: float = SCHEDULE_CATCH_UP_WINDOW,
+                 max_per_chat: int = SCHEDULE_MAX_PER_CHAT) -> None:
+        self.storage = storage
+        self.post = post
+        self.tz = tz or schedule_timezone(SCHEDULE_TIMEZONE)
+        self.catch_up_window = catch_up_window
+        self.max_per_chat = max_per_chat
+        self._chats: Dict[str, Dict[str, _Entry]] = {}
+        self._heap: List[Tuple[float, int, _Entry]] = []
+        self._counter = itertools.count()   # Порядок записей кучи с одинаковым временем
+        self._job_queue: Optional[JobQueue] = None
+        self._job: Optional[Job] = None
+        self._armed: Optional[float] = None  # Время, на которое заведён таймер
+        self._posting: Set[asyncio.Task] = set()
+        self._semaphore = asyncio.Semaphore(MAX_CONCURRENT_POSTS)
+
+    def __len__(self) -> int:
+        return sum(len(entries) for entries in self._chats.values())
+
+    async def start(self, job_queue: JobQueue) -> None:
+        """
+        Загружает расписания всех чатов и заводит таймер. Публикации, пропущенные
+        за время остановки, сработают сразу (см. _on_timer).
+        """
+        self._job_queue = job_queue
+        for chat_id, records in (await self.storage.load_schedules()).items():
+            for schedule_id, record in records.items():
+                try:
+                    self._register(chat_id, schedule_id, record)
+                except (KeyError, TypeError, ValueError) as e:
+                    logger.warning(f"Расписание {schedule_id} чата {chat_id} пропущено: {e}")
+        self._arm()
+        logger.info(f"Загружено расписаний публикаций: {len(self)}")
+
+    async def stop(self) -> None:
+        """
+        Останавливает таймер и дожидается начатых публикаций.
+        """
+        if self._job is not None:
+            self._job.schedule_removal()
+            self._job = None
+        self._armed = None
+        self._job_queue = None
+        if self._posting:
+            await asyncio.gather(*self._posting, return_exceptions=True)
+
+    def _register(self, chat_id: str, schedule_id: str, record: Dict[str, Any]) -> _Entry:
+        schedule = parse_schedule(record["spec"], f"{chat_id}:{schedule_id}", self.tz)
+        entry = _Entry(chat_id, schedule_id, record, schedule)
+        self._chats.setdefault(chat_id, {})[schedule_id] = entry
+        self._push(entry, schedule.next_after(float(record["last"])))
+        return entry
+
+    def _push(self, entry: _Entry, due: Optional[float]) -> None:
+        entry.due = due
+        if due is not None:
+            heapq.heappush(self._heap, (due, next(self._counter), entry))
+
+    def _arm(self) -> None:
+        """
+        Переводит таймер на ближайшую публикацию, если она изменилась.
+        """
+        heap = self._heap
+        while heap and heap[0][2].due != heap[0][0]:
+            heapq.heappop(heap)  # Расписание удалено или перенесено
+        due = heap[0][0] if heap else None
+        if due == self._armed or self._job_queue is None:
+            return
+        if self._job is not None:
+            self._job.schedule_removal()
+            self._job = None
+        self._armed = due
+        if due is not None:
+            # Без ограничения опоздания: после сна машины таймер всё равно должен сработать
+            self._job = self._job_queue.run_once(self._on_timer, when=max(0.0, due - time.time()),
+                                                 name="scheduled_posts",
+                                                 job_kwargs={"misfire_grace_time": None})
+
+    async def _on_timer(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        self._job = None
+        self._armed = None
+        now = time.time()
+        due_entries: List[Tuple[_Entry, bool, Any]] = []  # (расписание, публиковать ли, прежний last)
+        changes: ScheduleChanges = []
+        while self._heap and self._heap[0][0] <= now:
+            due, _, entry = heapq.heappop(self._heap)
+            if entry.due != due:
+                continue
+            due_entries.append((entry, self._should_fire(entry, now), entry.record["last"]))
+            entry.record["last"] = now
+            changes.append((entry.chat_id, entry.schedule_id, dict(entry.record)))
+            self._push(entry, entry.schedule.next_after(now))
+        # Сначала сохраняем last, потом публикуем: после сбоя публикация не повторится
+        if changes and not await self.storage.save_schedules(changes):
+            # Без сохранённого last публикация повторилась бы после перезапуска:
+            # откатываем last и пробуем снова через SAVE_RETRY_DELAY
+            logger.warning(f"Не удалось сохранить срабатывание расписаний ({len(changes)}), "
+                           f"повтор через {SAVE_RETRY_DELAY:.0f} с.")
+            for entry, _, last in due_entries:
+                if self._chats.get(entry.chat_id, {}).get(entry.schedule_id) is entry:
+                    entry.record["last"] = last
+                    self._push(entry, now + SAVE_RETRY_DELAY)
+            self._arm()
+            return
+        for entry, fire, _ in due_entries:
+            if not fire:
+                SCHEDULED_POSTS.inc("missed")
+                logger.info(f"Пропущенная публикация по расписанию {entry.schedule_id} чата {entry.chat_id} "
+                            f"слишком старая и не выполнена.")
+                continue
+            task = asyncio.create_task(self._post(entry.chat_id, entry.record.get("category")))
+            self._posting.add(task)
+            task.add_done_callback(self._posting.discard)
+        self._arm()
+
+    def _should_fire(self, entry: _Entry, now: float) -> bool:
+        """
+        Выполнять ли публикацию: хотя бы одна из пропущенных с last публикаций
+        должна быть не старше catch_up_window.
+        """
+        if self.catch_up_window <= 0:
+            return True
+        latest = entry.schedule.next_after(max(float(entry.record["last"]), now - self.catch_up_window))
+        return latest is not None and latest <= now
+
+    async def _post(self, chat_id: str, category: Optional[str]) -> None:
+        async with self._semaphore:
+            try:
+                await self.post(chat_id, category)
+                SCHEDULED_POSTS.inc("posted")
+            except Exception as e:
+                SCHEDULED_POSTS.inc("failed")
+                logger.exception(f"Ошибка публикации по расписанию в чат {chat_id}: {e}")
+
+    async def add(self, chat_id: str, spec: str, category: Optional[str]) -> Tuple[str, Optional[float]]:
+        """
+        Добавляет расписание чата.
+        Returns:
+            (номер расписания, время первой публикации)
+        Raises:
+            ValueError: неверное расписание или в чате уже слишком много расписаний.
+        """
+        entries = self._chats.get(chat_id, {})
+        if len(entries) >= self.max_per_chat:
+            raise ValueError(f"В чате уже {len(entries)} расписаний — это максимум.")
+        schedule_id = str(max((int(existing) for existing in entries), default=0) + 1)
+        record = {"spec": spec, "category": category, "last": time.time()}
+        parse_schedule(spec, f"{chat_id}:{schedule_id}", self.tz)  # Проверяем до записи
+        if not await self.storage.save_schedules([(chat_id, schedule_id, record)]):
+            raise ValueError("Не удалось сохранить расписание.")
+        entry = self._register(chat_id, schedule_id, dict(record))
+        self._arm()
+        return schedule_id, entry.due
+
+    async def remove(self, chat_id: str, schedule_id: Optional[str] = None) -> int:
+        """
+        Удаляет расписание чата (или все расписания, если schedule_id не указан).
+        Returns:
+            Количество удалённых расписаний.
+        Raises:
+            ValueError: удаление не удалось сохранить (расписания остаются в силе).
+        """
+        entries = self._chats.get(chat_id, {})
+        removed = list(entries) if schedule_id is None else [schedule_id] if schedule_id in entries else []
+        if not removed:
+            return 0
+        if not await self.storage.save_schedules([(chat_id, removed_id, None) for removed_id in removed]):
+            # Иначе удалённое расписание вернулось бы после перезапуска
+            raise ValueError("Не удалось удалить расписание.")
+        for removed_id in removed:
+            entries.pop(removed_id).due = None
+        if not entries:
+            self._chats.pop(chat_id, None)
+        self._arm()
+        return len(removed)
+
+    def chat_schedules(self, chat_id: str) -> List[Tuple[str, str, Optional[str], Optional[float]]]:
+        """
+        Расписания чата: (номер, описание, категория, время следующей публикации).
+        """
+        entries = self._chats.get(chat_id, {})
+        return [(entry.schedule_id, entry.record["spec"], entry.record.get("category"), entry.due)
+                for entry in sorted(entries.values(), key=lambda entry: int(entry.schedule_id))]
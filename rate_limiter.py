@@ -0,0 +1,134 @@
+import math
+import time
+import logging
+from typing import TYPE_CHECKING, List, Optional, Tuple
+from config import RATE_LIMIT_CHAT, RATE_LIMIT_USER, RATE_LIMIT_CATEGORY
+
+if TYPE_CHECKING:
+    from state_manager import StateManager
+
+logger = logging.getLogger(__name__)
+
+class BucketPolicy:
+    """
+    Параметры корзины токенов: не больше capacity токенов, один токен
+    восстанавливается за refill_seconds секунд.
+    """
+    def __init__(self, capacity: float, refill_seconds: float) -> None:
+        self.capacity = capacity
+        self.refill_seconds = refill_seconds
+
+    @classmethod
+    def parse(cls, spec: str, name: str = "RATE_LIMIT") -> Optional["BucketPolicy"]:
+        """
+        Разбирает строку вида "<capacity>:<refill_seconds>", например "1:900".
+        Пустая строка или нулевая ёмкость означают, что ограничение выключено.
+        Raises:
+            ValueError: строка не в этом формате или refill_seconds не больше нуля
+                (name — имя настройки для сообщения об ошибке).
+        """
+        if not spec or not spec.strip():
+            return None
+        try:
+            capacity, refill_seconds = (float(part) for part in spec.split(":"))
+        except ValueError:
+            raise ValueError(f"Неверное значение {name}: {spec!r}, ожидается \"<ёмкость>:<секунд на токен>\", "
+                             f"например \"1:900\".")
+        if not math.isfinite(capacity) or not math.isfinite(refill_seconds):
+            raise ValueError(f"Неверное значение {name}: {spec!r}, числа должны быть конечными.")
+        if capacity <= 0:
+            return None
+        if refill_seconds <= 0:
+            raise ValueError(f"Неверное значение {name}: {spec!r}, время восстановления токена "
+                             f"должно быть больше нуля.")
+        return cls(capacity, refill_seconds)
+
+    def tokens_at(self, bucket: Optional[List[float]], now: float) -> float:
+        """
+        Количество токенов в корзине на момент now.
+        """
+        if bucket is None:
+            return self.capacity
+        tokens, updated, _ = bucket
+        return min(self.capacity, tokens + (now - updated) / self.refill_seconds)
+
+    def wait_time(self, bucket: Optional[List[float]], now: float) -> float:
+        """
+        Сколько секунд ждать до появления целого токена (0 — токен уже есть).
+        """
+        tokens = self.tokens_at(bucket, now)
+        if tokens >= 1:
+            return 0.0
+        return (1 - tokens) * self.refill_seconds
+
+    def take(self, bucket: Optional[List[float]], now: float) -> List[float]:
+        """
+        Возвращает состояние корзины после списания одного токена:
+        [токены, время обновления, время, когда корзина снова станет полной].
+        """
+        tokens = self.tokens_at(bucket, now) - 1
+        full_at = now + (self.capacity - tokens) * self.refill_seconds
+        return [tokens, now, full_at]
+
+
+class RateLimiter:
+    """
+    Ограничение частоты команд корзинами токенов: отдельно на чат, на
+    пользователя в чате и на категорию команды в чате.
+
+    Корзины хранятся в шарде чата (StateManager.buckets), поэтому проверка — это
+    несколько обращений к словарю, а квоты переживают перезапуск. Полные корзины
+    ничем не отличаются от отсутствующих и удаляются пачкой
+    (StateManager.drop_full_buckets).
+    """
+    def __init__(self, chat: Optional[BucketPolicy], user: Optional[BucketPolicy],
+                 category: Optional[BucketPolicy]) -> None:
+        self.chat = chat
+        self.user = user
+        self.category = category
+
+    @classmethod
+    def from_config(cls) -> "RateLimiter":
+        """
+        Создаёт ограничитель по настройкам RATE_LIMIT_* из config.py.
+        """
+        return cls(BucketPolicy.parse(RATE_LIMIT_CHAT, "RATE_LIMIT_CHAT"),
+                   BucketPolicy.parse(RATE_LIMIT_USER, "RATE_LIMIT_USER"),
+                   BucketPolicy.parse(RATE_LIMIT_CATEGORY, "RATE_LIMIT_CATEGORY"))
+
+    def _buckets(self, user_id: str, category: str) -> List[Tuple[str, BucketPolicy]]:
+        buckets = []
+        if self.chat:
+            buckets.append(("chat", self.chat))
+        if self.user:
+            buckets.append((f"user:{user_id}", self.user))
+        if self.category:
+            buckets.append((f"category:{category}", self.category))
+        return buckets
+
+    def time_until_allowed(self, state_manager: "StateManager", user_id: str, category: str,
+                           now: Optional[float] = None) -> float:
+        """
+        Сколько секунд осталось до того, как команда будет разрешена (0 — можно сейчас).
+        """
+        now = time.time() if now is None else now
+        return max((policy.wait_time(state_manager.buckets.get(key), now)
+                    for key, policy in self._buckets(user_id, category)), default=0.0)
+
+    def acquire(self, state_manager: "StateManager", user_id: str, category: str,
+                now: Optional[float] = None) -> float:
+        """
+        Пытается списать по токену из всех корзин команды.
+        Returns:
+            0, если команда разрешена (токены списаны), иначе сколько секунд ждать.
+        """
+        now = time.time() if now is None else now
+        buckets = self._buckets(user_id, category)
+        wait = max((policy.wait_time(state_manager.buckets.get(key), now)
+                    for key, policy in buckets), default=0.0)
+        if wait > 0:
+            return wait
+        # Списываем только если разрешают все корзины, иначе отказ съел бы чужую квоту
+        for key, policy in buckets:
+            state_manager.set_bucket(key, policy.take(state_manager.buckets.get(key), now))
+        return 0.0
@@ -0,0 +1,205 @@
+import random
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Union
+from telegram.error import BadRequest, ChatMigrated, Forbidden, NetworkError, RetryAfter
+from config import (SEND_QUEUE_SIZE, SEND_GLOBAL_RATE, SEND_CHAT_INTERVAL, SEND_MAX_ATTEMPTS,
+                    SEND_BACKOFF_BASE, SEND_BACKOFF_MAX)
+from metrics import SEND_FAILURES, SEND_RETRIES
+
+logger = logging.getLogger(__name__)
+
+ChatId = Union[int, str]
+# Вызывается один раз по итогам отправки: True — сообщение доставлено
+ResultCallback = Callable[[bool], Awaitable[None]]
+
+class OutboundMessage:
+    """
+    Исходящее сообщение в очереди отправки.
+    """
+    def __init__(self, chat_id: ChatId, text: str, on_result: Optional[ResultCallback],
+                 send_kwargs: Dict[str, Any]) -> None:
+        self.chat_id = chat_id
+        self.text = text
+        self.on_result = on_result
+        self.send_kwargs = send_kwargs
+        self.attempts = 0
+
+
+class SendDispatcher:
+    """
+    Асинхронная отправка сообщений с учётом ограничений Telegram.
+
+    У каждого чата своя ограниченная очередь и свой обработчик, поэтому порядок
+    сообщений внутри чата сохраняется, а медленный чат не задерживает остальные.
+    Между отправками в один чат выдерживается chat_interval секунд, общий поток
+    ограничен global_rate сообщениями в секунду. На RetryAfter (429) чат
+    ставится на паузу ровно на retry_after секунд, сетевые ошибки повторяются
+    с экспоненциальной задержкой и случайным разбросом.
+
+    О результате сообщает колбэк on_result: обработчик команды не ждёт отправки
+    и может завершить извлечение сообщения из очереди только после доставки.
+    Для проверки вместо Bot подойдёт любой объект с асинхронным send_message.
+    """
+    def __init__(self, bot: Any, queue_size: int = SEND_QUEUE_SIZE,
+                 global_rate: float = SEND_GLOBAL_RATE, chat_interval: float = SEND_CHAT_INTERVAL,
+                 max_attempts: int = SEND_MAX_ATTEMPTS, backoff_base: float = SEND_BACKOFF_BASE,
+                 backoff_max: float = SEND_BACKOFF_MAX) -> None:
+        self.bot = bot
+        self.queue_size = queue_size
+        self.global_interval = 1 / global_rate if global_rate > 0 else 0.0
+        self.chat_interval = chat_interval
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._queues: Dict[ChatId, Deque[OutboundMessage]] = {}
+        self._workers: Dict[ChatId, asyncio.Task] = {}
+        self._chat_ready_at: Dict[ChatId, float] = {}  # Когда в чат снова можно писать (loop.time())
+        self._next_global_slot = 0.0
+        self._closed = False
+
+    def pending(self, chat_id: Optional[ChatId] = None) -> int:
+        """
+        Количество сообщений, ожидающих отправки (в чат или всего).
+        """
+        if chat_id is not None:
+            return len(self._queues.get(chat_id, ()))
+        return sum(len(queue) for queue in self._queues.values())
+
+    def submit(self, chat_id: ChatId, text: str, on_result: Optional[ResultCallback] = None,
+               **send_kwargs: Any) -> bool:
+        """
+        Ставит сообщение в очередь чата.
+        Returns:
+            False, если очередь чата переполнена или диспетчер остановлен
+            (on_result в этом случае не вызывается).
+        """
+        if self._closed:
+            return False
+        queue = self._queues.setdefault(chat_id, deque())
+        if len(queue) >= self.queue_size:
+            logger.warning(f"Очередь отправки в чат {chat_id} переполнена ({len(queue)}).")
+            return False
+        queue.append(OutboundMessage(chat_id, text, on_result, send_kwargs))
+        self._prune_ready_at()
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._chat_worker(chat_id))
+        return True
+
+    def _prune_ready_at(self) -> None:
+        """
+        Забывает паузы чатов, которые уже истекли. Пауза переживает опустевшую
+        очередь чата (иначе следующее сообщение ушло бы сразу, нарушив интервал
+        чата или retry_after), поэтому словарь чистится здесь: полный проход
+        выполняется, только когда записей заметно больше, чем активных чатов,
+        и в среднем стоит O(1) на сообщение.
+        """
+        if len(self._chat_ready_at) <= 2 * len(self._workers) + 1024:
+            return
+        now = asyncio.get_running_loop().time()
+        self._chat_ready_at = {chat_id: ready_at for chat_id, ready_at in self._chat_ready_at.items()
+                               if ready_at > now or chat_id in self._workers}
+
+    async def _wait_for_slot(self, chat_id: ChatId) -> None:
+        """
+        Ждёт, пока отправка в чат не нарушит ни ограничение чата, ни общее.
+        """
+        loop = asyncio.get_running_loop()
+        chat_delay = self._chat_ready_at.get(chat_id, 0.0) - loop.time()
+        if chat_delay > 0:
+            await asyncio.sleep(chat_delay)
+        now = loop.time()
+        slot = max(now, self._next_global_slot)
+        self._next_global_slot = slot + self.global_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def _backoff(self, attempt: int) -> float:
+        """
+        Экспоненциальная задержка с разбросом ±50%.
+        """
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+        return delay * random.uniform(0.5, 1.5)
+
+    async def _send(self, message: OutboundMessage) -> bool:
+        """
+        Отправляет сообщение с повторами.
+        Returns:
+            True, если сообщение доставлено.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wait_for_slot(message.chat_id)
+            message.attempts += 1
+            try:
+                await self.bot.send_message(chat_id=message.chat_id, text=message.text,
+                                            **message.send_kwargs)
+                self._chat_ready_at[message.chat_id] = loop.time() + self.chat_interval
+                return True
+            except RetryAfter as e:
+                # Флуд-контроль: Telegram сам говорит, сколько ждать
+                logger.warning(f"Флуд-контроль для чата {message.chat_id}: пауза {e.retry_after} с.")
+                self._chat_ready_at[message.chat_id] = loop.time() + e.retry_after
+                SEND_RETRIES.inc("retry_after")
+            except (BadRequest, Forbidden, ChatMigrated) as e:
+                # Повтор не поможет: неверный запрос, бота удалили из чата и т.п.
+                logger.error(f"Сообщение в чат {message.chat_id} не может быть доставлено: {e}")
+                SEND_FAILURES.inc("rejected")
+                return False
+            except NetworkError as e:
+                delay = self._backoff(message.attempts)
+                logger.warning(f"Сетевая ошибка при отправке в чат {message.chat_id} "
+                               f"(попытка {message.attempts}): {e}. Повтор через {delay:.1f} с.")
+                self._chat_ready_at[message.chat_id] = loop.time() + delay
+                SEND_RETRIES.inc("network")
+            except Exception as e:
+                logger.exception(f"Ошибка при отправке сообщения в чат {message.chat_id}: {e}")
+                SEND_FAILURES.inc("error")
+                return False
+            if message.attempts >= self.max_attempts:
+                logger.error(f"Сообщение в чат {message.chat_id} не доставлено за {message.attempts} попыток.")
+                SEND_FAILURES.inc("exhausted")
+                return False
+
+    async def _chat_worker(self, chat_id: ChatId) -> None:
+        """
+        Отправляет сообщения чата по одному, пока его очередь не опустеет.
+        """
+        queue = self._queues[chat_id]
+        try:
+            while queue:
+                message = queue[0]
+                delivered = await self._send(message)
+                queue.popleft()
+                if message.on_result is not None:
+                    try:
+                        await message.on_result(delivered)
+                    except Exception as e:
+                        logger.exception(f"Ошибка в обработчике результата отправки в чат {chat_id}: {e}")
+        finally:
+            self._workers.pop(chat_id, None)
+            if not queue:
+                # Паузу чата (_chat_ready_at) не сбрасываем: она действует и для следующих сообщений
+                self._queues.pop(chat_id, None)
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """
+        Перестаёт принимать сообщения и даёт очередям до timeout секунд
+        на отправку. Неотправленные после этого сообщения считаются недоставленными.
+        """
+        self._closed = True
+        workers = list(self._workers.values())
+        if not workers:
+            return
+        _, still_running = await asyncio.wait(workers, timeout=timeout)
+        for task in still_running:
+            task.cancel()
+        await asyncio.gather(*still_running, return_exceptions=True)
+        for chat_id, queue in list(self._queues.items()):
+            while queue:
+                message = queue.popleft()
+                SEND_FAILURES.inc("shutdown")
+                if message.on_result is not None:
+                    await message.on_result(False)
+            self._queues.pop(chat_id, None)
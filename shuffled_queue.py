@@ -0,0 +1,352 @@
+import random
+import hashlib
+from array import array
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+# Порядок очереди: список идентификаторов или компактный массив номеров (array('I'))
+Order = Union[List[Any], array]
+# Перестановки элементов очереди: пары позиций, которые меняются местами по порядку
+Swaps = List[List[int]]
+
+
+class ShuffledQueue:
+    """
+    Очередь идентификаторов в случайном порядке с курсором.
+
+    Вместо list.pop(0) курсор просто сдвигается вперёд, поэтому извлечение
+    стоит O(1). Пройденная часть очереди сохраняется до следующего
+    перемешивания, чтобы при правке каталога не выдавать повторно то,
+    что уже было в текущем круге.
+
+    Элемент можно сначала зарезервировать (reserve), а извлечь окончательно
+    только после успешной отправки. Зарезервированные элементы образуют окно
+    order[cursor:cursor + reserved]; резерв живёт только в памяти и не сохраняется.
+
+    Очередь сообщений хранит номера сообщений каталога в array('I') — четыре
+    байта на сообщение вместо объекта строки; все операции сохраняют тип order.
+    """
+    def __init__(self, order: Optional[Order] = None, cursor: int = 0, reserved: int = 0) -> None:
+        self.order: Order = order if order is not None else []
+        self.cursor = min(cursor, len(self.order))
+        self.reserved = min(reserved, len(self.order) - self.cursor)
+
+    def __len__(self) -> int:
+        """
+        Количество элементов, доступных для резервирования.
+        """
+        return len(self.order) - self.cursor - self.reserved
+
+    def copy(self) -> "ShuffledQueue":
+        """
+        Возвращает независимую копию очереди того же типа.
+        """
+        return ShuffledQueue(self.order[:], self.cursor, self.reserved)
+
+    def window(self) -> List[Any]:
+        """
+        Зарезервированные элементы по порядку.
+        """
+        return list(self.order[self.cursor:self.cursor + self.reserved])
+
+    def is_reserved(self, item: Any) -> bool:
+        """
+        Зарезервирован ли item.
+        """
+        return item in self.order[self.cursor:self.cursor + self.reserved]
+
+    def advance(self) -> None:
+        """
+        Окончательно извлекает элемент под курсором (первый из зарезервированных).
+        """
+        if self.cursor < len(self.order):
+            self.cursor += 1
+            self.reserved = max(0, self.reserved - 1)
+
+    def reserve(self) -> Optional[Any]:
+        """
+        Резервирует следующий доступный элемент.
+        """
+        if not len(self):
+            return None
+        item = self.order[self.cursor + self.reserved]
+        self.reserved += 1
+        return item
+
+    def swap(self, swaps: Iterable[Sequence[int]]) -> None:
+        """
+        Меняет местами элементы на парах позиций swaps (по порядку).
+        """
+        order = self.order
+        for first, second in swaps:
+            order[first], order[second] = order[second], order[first]
+
+    def commit_swaps(self, item: Any) -> Swaps:
+        """
+        Перестановки, которые ставят зарезервированный item под курсор перед
+        его извлечением (advance). Обычно item уже там, и перестановок нет.
+        """
+        window = self.order[self.cursor:self.cursor + max(self.reserved, 1)]
+        if item not in window or window[0] == item:
+            return []
+        return [[self.cursor, self.cursor + window.index(item)]]
+
+    def release_swaps(self, item: Any) -> Swaps:
+        """
+        Перестановки, которые ставят item сразу за остальными зарезервированными
+        элементами: после снятия резерва (reserved - 1) он будет выдан следующим.
+        Остальные зарезервированные элементы сдвигаются на его место по одному.
+        """
+        window = self.order[self.cursor:self.cursor + self.reserved]
+        if item not in window:
+            return []
+        # После нового круга элемент может встретиться в окне дважды;
+        # снимается последний (самый поздний) резерв
+        position = self.cursor + len(window) - 1 - window[::-1].index(item)
+        return [[index, index + 1] for index in range(position, self.cursor + self.reserved - 1)]
+
+    def sync(self, items: Iterable[Any]) -> bool:
+        """
+        Согласует очередь с актуальным набором элементов без полного перемешивания:
+        исчезнувшие элементы убираются из оставшейся части, новые вставляются
+        в неё на случайные позиции. Зарезервированные элементы не трогаются.
+
+        Returns:
+            True, если очередь изменилась.
+        """
+        items = list(items)
+        valid = set(items)
+        known = set(self.order)
+        start = self.cursor + self.reserved
+        remaining = [item for item in self.order[start:] if item in valid]
+        added = [item for item in items if item not in known]
+        if not added and len(remaining) == len(self):
+            return False
+        for item in added:
+            remaining.insert(random.randint(0, len(remaining)), item)
+        order = self.order[:start]
+        order.extend(remaining)
+        self.order = order
+        return True
+
+    def remapped(self, remap: array) -> "ShuffledQueue":
+        """
+        Возвращает очередь номеров, переведённых таблицей remap (номер + 1, 0 — удалён;
+        см. MessageCatalog.remap_to). Удалённые элементы исчезают, курсор и окно
+        резерва сдвигаются на число удалённых перед ними.
+        """
+        order = self.order[:0]
+        cursor = reserved = 0
+        for position, item in enumerate(self.order):
+            mapped = remap[item] if item < len(remap) else 0
+            if not mapped:
+                continue
+            if position < self.cursor:
+                cursor += 1
+            elif position < self.cursor + self.reserved:
+                reserved += 1
+            order.append(mapped - 1)
+        return ShuffledQueue(order, cursor, reserved)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Компактное представление очереди для сохранения.
+        """
+        return {"order": list(self.order), "cursor": self.cursor}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ShuffledQueue":
+        """
+        Восстанавливает очередь из представления to_dict.
+        """
+        return cls(list(data.get("order", [])), data.get("cursor", 0))
+
+
+class Permutation:
+    """
+    Псевдослучайная перестановка номеров range(size), заданная seed.
+
+    Элемент на любой позиции вычисляется за O(1) сетью Фейстеля с обходом
+    цикла, поэтому перестановку не нужно ни строить, ни хранить целиком.
+    """
+    ROUNDS = 4
+    MASK64 = (1 << 64) - 1
+
+    def __init__(self, size: int, seed: int) -> None:
+        self.size = size
+        # Сеть переставляет числа из 2 * half бит — ближайшую сверху чётную степень двойки
+        self._half = max(1, ((size - 1).bit_length() + 1) // 2)
+        self._mask = (1 << self._half) - 1
+        digest = hashlib.blake2b(seed.to_bytes(8, 'little'), digest_size=8 * self.ROUNDS).digest()
+        self._keys = [int.from_bytes(digest[8 * i:8 * (i + 1)], 'little') for i in range(self.ROUNDS)]
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, position: int) -> int:
+        if not 0 <= position < self.size:
+            raise IndexError(position)
+        value = position
+        # Обход цикла: значения за пределами size шифруются повторно,
+        # пока не попадут в диапазон, — так сеть остаётся перестановкой range(size)
+        while True:
+            value = self._encrypt(value)
+            if value < self.size:
+                return value
+
+    def _encrypt(self, value: int) -> int:
+        half, mask = self._half, self._mask
+        left, right = value >> half, value & mask
+        for key in self._keys:
+            # Раундовая функция — перемешивание splitmix64 с ключом раунда
+            x = (right + key) & self.MASK64
+            x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & self.MASK64
+            x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & self.MASK64
+            left, right = right, left ^ ((x ^ (x >> 31)) & mask)
+        return (left << half) | right
+
+
+# Часть круга: число позиций и перевод номера в перестановке в номер сообщения
+# текущего каталога (None — номер уже текущий; результат None — сообщение удалено)
+Segment = Tuple[int, Optional[Callable[[int], Optional[int]]]]
+
+
+class SeededQueue:
+    """
+    Круг по сообщениям каталога в псевдослучайном порядке, заданном seed, без
+    списка порядка: в памяти только seed, курсор, перестановки позиций и
+    сообщения, перенесённые из прошлого круга. Сообщение на позиции вычисляется
+    при резервировании, поэтому очередь занимает O(1) памяти независимо от
+    размера каталога, а восстановление из seed и курсора ничего не стоит.
+
+    Позиции круга: сначала head (резерв прошлого круга), затем части круга
+    (segments) подряд, каждая в своей перестановке Permutation. Первая часть —
+    сообщения каталога, с которым начат круг, следующие — сообщения, добавленные
+    в каталог позже (см. StateManager._bind). Размер части не меняется, поэтому
+    позиции, курсор и перестановки остаются верными при любой правке каталога;
+    позиции удалённых сообщений (None) пропускаются.
+
+    Интерфейс резерва тот же, что у ShuffledQueue.
+    """
+    def __init__(self, seed: int, segments: Sequence[Segment], head: Sequence[Optional[int]] = (),
+                 cursor: int = 0, swaps: Iterable[Sequence[int]] = (), reserved: int = 0) -> None:
+        self.seed = seed
+        self._moved: Dict[int, int] = {}  # Позиция → исходная позиция после перестановок
+        self._permutations: List[Permutation] = []
+        self.cursor = self.reserved = 0
+        self.rebind(head, segments)
+        self.cursor = min(cursor, self.length)
+        self.reserved = min(reserved, self.length - self.cursor)
+        self.swap(swaps)
+
+    @property
+    def length(self) -> int:
+        """
+        Число позиций в круге, включая пройденные.
+        """
+        return len(self.head) + sum(len(permutation) for permutation in self._permutations)
+
+    def __len__(self) -> int:
+        """
+        Количество позиций, доступных для резервирования.
+        """
+        return self.length - self.cursor - self.reserved
+
+    def rebind(self, head: Sequence[Optional[int]], segments: Sequence[Segment]) -> None:
+        """
+        Переводит очередь на другой каталог: номера перенесённых сообщений
+        и переводы номеров заменяются, новые части круга добавляются в конец.
+        Курсор, резерв и перестановки остаются прежними.
+        """
+        self.head = list(head)
+        self._lookups = [lookup for _, lookup in segments]
+        for number, (size, _) in enumerate(segments[len(self._permutations):], len(self._permutations)):
+            self._permutations.append(Permutation(size, self.seed + number))
+
+    def item(self, position: int) -> Optional[int]:
+        """
+        Номер сообщения текущего каталога на позиции position или None, если сообщение удалено.
+        """
+        source = self._moved.get(position, position)
+        if source < len(self.head):
+            return self.head[source]
+        source -= len(self.head)
+        for permutation, lookup in zip(self._permutations, self._lookups):
+            if source < len(permutation):
+                index = permutation[source]
+                return index if lookup is None else lookup(index)
+            source -= len(permutation)
+        return None
+    def window(self) -> List[Optional[int]]:
+        """
+        Зарезервированные позиции по порядку (None — сообщение удалено).
+        """
+        return [self.item(position) for position in range(self.cursor, self.cursor + self.reserved)]
+
+    def is_reserved(self, item: int) -> bool:
+        """
+        Зарезервирован ли item.
+        """
+        return item in self.window()
+
+    def advance(self) -> None:
+        """
+        Окончательно извлекает элемент под курсором (первый из зарезервированных).
+        Удалённые сообщения, стоящие в резерве следом, извлекаются вместе с ним.
+        """
+        if self.cursor < self.length:
+            self.cursor += 1
+            self.reserved = max(0, self.reserved - 1)
+        while self.reserved and self.item(self.cursor) is None:
+            self.cursor += 1
+            self.reserved -= 1
+
+    def reserve(self) -> Optional[int]:
+        """
+        Резервирует следующее доступное сообщение. Удалённые сообщения под
+        курсором пропускаются, а за ним — попадают в окно резерва и
+        извлекаются вместе с соседями (см. advance).
+        """
+        while self.cursor + self.reserved < self.length:
+            item = self.item(self.cursor + self.reserved)
+            if item is None and not self.reserved:
+                self.cursor += 1
+                continue
+            self.reserved += 1
+            if item is not None:
+                return item
+        return None
+
+    def swap(self, swaps: Iterable[Sequence[int]]) -> None:
+        """
+        Меняет местами элементы на парах позиций swaps (по порядку).
+        """
+        moved = self._moved
+        for first, second in swaps:
+            source_first = moved.get(first, first)
+            source_second = moved.get(second, second)
+            for position, source in ((first, source_second), (second, source_first)):
+                if position == source:
+                    moved.pop(position, None)
+                else:
+                    moved[position] = source
+
+    def commit_swaps(self, item: int) -> Swaps:
+        """
+        Перестановки, которые ставят зарезервированный item под курсор перед
+        его извлечением (advance). Обычно item уже там, и перестановок нет.
+        """
+        window = [self.item(position) for position in range(self.cursor, self.cursor + max(self.reserved, 1))]
+        if item not in window or window[0] == item:
+            return []
+        return [[self.cursor, self.cursor + window.index(item)]]
+
+    def release_swaps(self, item: int) -> Swaps:
+        """
+        Перестановки, которые ставят item сразу за остальными зарезервированными
+        элементами: после снятия резерва (reserved - 1) он будет выдан следующим.
+        """
+        window = self.window()
+        if item not in window:
+            return []
+        position = self.cursor + len(window) - 1 - window[::-1].index(item)
+        return [[index, index + 1] for index in range(position, self.cursor + self.reserved - 1)]
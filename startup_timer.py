@@ -0,0 +1,49 @@
+import time
+import logging
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+class StartupTimer:
+    """
+    Замеряет этапы запуска бота: от старта процесса до готовности принимать
+    обновления и до первого обработанного обновления. На fly.io машина
+    останавливается при простое, поэтому именно это время ждёт пользователь,
+    разбудивший бота командой.
+    """
+    def __init__(self, started: Optional[float] = None) -> None:
+        self.started = time.perf_counter() if started is None else started
+        self._last = self.started
+        self.phases: Dict[str, float] = {}  # {этап: длительность в секундах}
+        self.first_update: Optional[float] = None
+
+    def mark(self, phase: str) -> float:
+        """
+        Завершает этап: его длительность — время с конца предыдущего этапа.
+        """
+        now = time.perf_counter()
+        self.phases[phase] = now - self._last
+        self._last = now
+        return self.phases[phase]
+
+    @property
+    def elapsed(self) -> float:
+        """
+        Секунд с начала запуска.
+        """
+        return time.perf_counter() - self.started
+
+    def report(self) -> None:
+        """
+        Пишет в журнал длительности этапов запуска.
+        """
+        phases = ", ".join(f"{phase} {duration:.3f} с" for phase, duration in self.phases.items())
+        logger.info(f"Бот готов через {self._last - self.started:.3f} с после старта процесса ({phases}).")
+
+    def mark_first_update(self) -> None:
+        """
+        Отмечает первое обработанное обновление (один раз за запуск).
+        """
+        if self.first_update is None:
+            self.first_update = self.elapsed
+            logger.info(f"Первое обновление обработано через {self.first_update:.3f} с после старта процесса.")
@@ -1,63 +1,652 @@
+import time
 import random
+import asyncio
 import logging
-from pathlib import Path
-from typing import Dict, List, Tuple, Optional, Any
-from json_utils import load_json_file, save_json_file
+from array import array
+from typing import Callable, Dict, List, Tuple, Optional, Any, Union
+from message_catalog import MessageCatalog, make_message_id
 from message_manager import MessageManager
+from shuffled_queue import SeededQueue, ShuffledQueue
+from participant_selector import ParticipantSelector
+from storage import StateStorage, Snapshot, Operations
+from metrics import STATE_IO_LATENCY, timed
+from config import STATE_FLUSH_MAX_CHANGES, PARTICIPANT_SEEN_PERSIST_INTERVAL
 
 logger = logging.getLogger(__name__)
 
 class StateManager:
     """
-    Класс для управления состоянием: участниками и очередями сообщений.
+    Класс для управления состоянием одного чата: участниками и очередями сообщений.
+
+    В памяти очереди сообщений выдают номера сообщений скомпилированного каталога
+    (см. message_catalog), а в снимке и журнале хранятся их стабильные
+    идентификаторы (см. make_message_id). Поэтому состояние не дублирует
+    каталог и не зависит от порядка сообщений в файле.
+
+    Круг очереди задаётся seed перестановки и версиями каталога (хэшами его JSON),
+    которые он застал, и хранится курсором и редкими перестановками
+    (см. shuffled_queue.SeededQueue): сообщение на позиции вычисляется по seed,
+    поэтому ни в памяти, ни в состоянии нет списка порядка, а загрузка шарда
+    не зависит от размера каталога. Если каталог изменился посреди круга,
+    сообщения прежних версий находятся по их сохранённым файлам (см.
+    MessageManager.version), а добавленные идут в конце круга. Явный список
+    идентификаторов (messages_sync) остался только у очередей прежнего формата.
+
+    Участник для /post выбирается взвешенно по его активности (см. participant_selector).
+
+    Каждое изменение — добавление участника, его сообщение или выбор, извлечение
+    сообщения, перемешивание очереди — описывается короткой операцией журнала. Операции
+    передаются в хранилище (см. storage.StateStorage) пачками фоновой задачей
+    владельца (см. ChatRegistry); хранилище само решает, когда свернуть их
+    в новый снимок.
     """
-    def __init__(self, state_file: Path) -> None:
-        self.state_file = state_file
+    def __init__(self, chat_id: str, storage: StateStorage,
+                 flush_requested: Optional[asyncio.Event] = None,
+                 flush_max_changes: int = STATE_FLUSH_MAX_CHANGES) -> None:
+        self.chat_id = chat_id
+        self.storage = storage
         self.participants: Dict[str, str] = {}           # {participant_id: participant_name}
-        self.shuffled_messages: Dict[str, List[str]] = {}  # {category: [message1, message2, ...]}
-        self.shuffled_participants: List[str] = []         # Список participant_id в случайном порядке
+        # {category: очередь номеров сообщений}
+        self.message_queues: Dict[str, Union[SeededQueue, ShuffledQueue]] = {}
+        # Каталоги, к номерам которых относятся очереди; очередь категории без
+        # каталога только что восстановлена и ещё хранит идентификаторы
+        self._catalogs: Dict[str, MessageCatalog] = {}
+        self._synced: Dict[str, MessageCatalog] = {}         # Каталоги, с которыми очереди согласованы
+        # Версии каталога (хэш JSON), с которыми согласованы сохранённые явные очереди
+        self._digests: Dict[str, str] = {}
+        # Круги очередей, заданные seed: {category: {"seed", "digests", "head", "swaps"}};
+        # у круга, очередь которого ещё не построена по каталогу, есть и "cursor"
+        self._rounds: Dict[str, Dict[str, Any]] = {}
+        self.selector = ParticipantSelector()                # Статистика и выбор участников
+        self._seen_persisted: Dict[str, float] = {}          # Когда активность участника записана в журнал
+        # Корзины ограничителя частоты: {key: [токены, время обновления, время заполнения]}
+        self.buckets: Dict[str, List[float]] = {}
 
+        self.flush_max_changes = flush_max_changes
+        self._seq = 0                                      # Номер последней операции журнала
+        self._journal: Operations = []                     # Операции, ещё не переданные в хранилище
+        # Событие, по которому владелец (ChatRegistry) досрочно сбрасывает изменения
+        self._flush_requested = flush_requested or asyncio.Event()
+        self._save_lock = asyncio.Lock()
+
+    @timed(STATE_IO_LATENCY, "load_state")
     async def load_state(self, message_manager: MessageManager) -> None:
         """
-        Загружает состояние из файла и обновляет очереди сообщений, если это необходимо.
+        Загружает состояние чата из хранилища и обновляет очереди сообщений,
+        если это необходимо.
+        """
+        snapshot, ops = await self.storage.load(self.chat_id)
+        self.restore(snapshot, ops)
+
+        self.sync_catalog(message_manager)
+
+    def sync_catalog(self, message_manager: MessageManager) -> None:
+        """
+        Согласует очереди с текущим каталогом: новые сообщения добавляются,
+        удалённые исчезают, а уже пройденная часть круга не повторяется.
+        Очереди удалённых категорий отбрасываются. Круг, заданный seed, лишь
+        привязывается к каталогу за O(1), а явная очередь, сохранённая с той же
+        версией каталога, не пересогласуется.
+        """
+        for category in message_manager.categories:
+            self._sync_category(category, message_manager)
+
+        for category in list(dict.fromkeys([*self.message_queues, *self._rounds])):
+            if category not in message_manager.categories:
+                self._record({"op": "messages_drop", "category": category})
+
+    def _sync_category(self, category: str, message_manager: MessageManager) -> None:
+        """
+        Переводит очередь категории на номера текущего каталога и согласует её с ним.
+        """
+        catalog = message_manager.categories[category]
+        if category in self._rounds:
+            if self._catalogs.get(category) is not catalog:
+                self._bind(category, catalog, message_manager)
+            queue = self.message_queues.get(category)
+            if queue is None or (not queue and len(catalog)):
+                self.shuffle_messages(category, catalog)
+            return
+        queue = self.message_queues.get(category)
+        numbered = self._catalogs.get(category)
+        if queue is not None and numbered is not catalog:
+            if numbered is None:
+                # Очередь из хранилища: идентификаторы → номера (пропавшие сообщения отбрасываются)
+                renumbered = self._numbered(queue, catalog)
+                if self._digests.pop(category, None) == catalog.digest:
+                    self._synced[category] = catalog
+            else:
+                # Каталог пересобран: номера прежнего каталога → номера нового
+                renumbered = queue.remapped(message_manager.remap(category, numbered))
+            self._catalogs[category] = catalog
+            if len(renumbered.order) != len(queue.order):
+                # Сохранённый порядок должен совпадать с порядком в памяти,
+                # иначе извлечения из журнала сдвинутся при следующей загрузке
+                self._record_queue("messages_sync", category, renumbered)
+            else:
+                self.message_queues[category] = renumbered
+            queue = renumbered
+        if queue is None or (not queue and len(catalog)):
+            self.shuffle_messages(category, catalog)
+        elif self._synced.get(category) is not catalog:
+            self.sync_messages(category)
+
+    def _bind(self, category: str, catalog: MessageCatalog, message_manager: MessageManager) -> None:
+        """
+        Привязывает круг, заданный seed, к текущему каталогу. Номера сообщений
+        версий, которые застал круг, переводятся в номера текущего каталога
+        по мере выдачи, удалённые сообщения пропускаются. Если каталог изменился
+        после начала круга, его версия добавляется в круг (messages_extend):
+        сообщения, которых не было в прежних версиях, идут в конце круга.
+        Курсор и перестановки при этом не меняются. Если файла одной из версий
+        круга уже нет, круг отбрасывается.
+        """
+        seeded = self._rounds[category]
+        versions = [message_manager.version(category, digest) for digest in seeded["digests"]]
+        if not versions or None in versions:
+            logger.info(f"Версия каталога категории '{category}', с которой начат круг, "
+                        f"не сохранилась: начинается новый круг.")
+            self._rounds.pop(category)
+            self.message_queues.pop(category, None)
+            self._catalogs.pop(category, None)
+            return
+        if versions[-1] is not catalog:
+            self._record({"op": "messages_extend", "category": category, "digest": catalog.digest})
+            versions.append(catalog)
+
+        def lookup(version: MessageCatalog, added: Optional[array] = None) -> Optional[Callable[[int], Optional[int]]]:
+            if added is not None:
+                return lambda index: version.index_in(added[index], catalog)
+            return None if version is catalog else lambda index: version.index_in(index, catalog)
+
+        segments = [(len(versions[0]), lookup(versions[0]))]
+        for number in range(1, len(versions)):
+            added = message_manager.added(category, versions[:number + 1])
+            segments.append((len(added), lookup(versions[number], added)))
+        head = [catalog.index_of(message_id) for message_id in seeded["head"]]
+        queue = self.message_queues.get(category)
+        if isinstance(queue, SeededQueue):
+            queue.rebind(head, segments)
+        else:
+            self.message_queues[category] = SeededQueue(seeded["seed"], segments, head, seeded.pop("cursor", 0),
+                                                        seeded["swaps"])
+        self._catalogs[category] = catalog
+
+    @staticmethod
+    def _seeded(data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Круг очереди, заданный seed, из снимка или операции messages_round.
+        """
+        return {"seed": data["seed"], "digests": list(data.get("digests", [])), "head": list(data.get("head", [])),
+                "swaps": [list(swap) for swap in data.get("swaps", [])], "cursor": data.get("cursor", 0)}
+
+    @staticmethod
+    def _numbered(queue: ShuffledQueue, catalog: MessageCatalog) -> ShuffledQueue:
+        """
+        Переводит очередь идентификаторов в очередь номеров каталога.
+        Курсор сдвигается на число пропавших сообщений перед ним.
+        """
+        order = array('I')
+        cursor = 0
+        for position, message_id in enumerate(queue.order):
+            index = catalog.index_of(message_id)
+            if index is None:
+                continue
+            if position < queue.cursor:
+                cursor += 1
+            order.append(index)
+        return ShuffledQueue(order, cursor)
+
+    def restore(self, state: Snapshot, ops: Operations) -> None:
+        """
+        Восстанавливает состояние из снимка и применяет операции журнала,
+        записанные после него.
         """
-        state: Dict[str, Any] = await load_json_file(self.state_file, default={})
         self.participants = state.get("participants", {})
-        self.shuffled_messages = state.get("shuffled_messages", {})
-        self.shuffled_participants = state.get("shuffled_participants", [])
-
-        # Для каждой категории проверяем очередь сообщений
-        for category, messages in message_manager.categories.items():
-            if category not in self.shuffled_messages or not self.shuffled_messages[category]:
-                if messages:
-                    self.shuffled_messages[category] = random.sample(messages, len(messages))
+        self._rounds = {}
+        self._digests = {}
+        if "shuffled_messages" in state:
+            # Старый формат: очереди хранили полные тексты сообщений
+            self.message_queues = {
+                category: ShuffledQueue([make_message_id(message) for message in messages])
+                for category, messages in state["shuffled_messages"].items()
+            }
+        else:
+            self.message_queues = {}
+            for category, queue in state.get("message_queues", {}).items():
+                if "seed" in queue:
+                    self._rounds[category] = self._seeded(queue)
                 else:
-                    self.shuffled_messages[category] = []
+                    self.message_queues[category] = ShuffledQueue.from_dict(queue)
+                    if "digest" in queue:
+                        self._digests[category] = queue["digest"]
+        self._catalogs = {}
+        self._synced = {}
+        self.buckets = state.get("buckets", {})
+        self._seq = state.get("journal_seq", 0)
+        # Снимки прежнего формата хранили очередь участников вместо статистики:
+        # участники без статистики считаются писавшими только что
+        self.selector.load(state.get("participant_stats", {}), self.participants, time.time())
+        self._seen_persisted = {participant_id: stats[1] for participant_id, stats in self.selector.stats.items()}
 
-        if not self.shuffled_participants and self.participants:
-            self.shuffled_participants = random.sample(list(self.participants.keys()), len(self.participants))
+        # Повторяем операции, которые были записаны после снимка
+        replayed = 0
+        for op in ops:
+            if op.get("seq", 0) <= self._seq:
+                continue
+            self._apply(op)
+            self._seq = op["seq"]
+            replayed += 1
+        if replayed:
+            logger.info(f"Для чата {self.chat_id} применено операций журнала: {replayed}")
 
-    async def save_state(self) -> None:
+    def snapshot(self) -> Snapshot:
         """
-        Сохраняет состояние в файл.
+        Возвращает полный снимок состояния чата.
         """
-        state = {
-            "participants": self.participants,
-            "shuffled_messages": self.shuffled_messages,
-            "shuffled_participants": self.shuffled_participants
+        message_queues = {category: self._queue_dict(category, queue)
+                          for category, queue in self.message_queues.items()}
+        for category, seeded in self._rounds.items():
+            if category not in message_queues:
+                # Очередь ещё не восстановлена по каталогу: сохраняем круг как есть
+                message_queues[category] = self._seeded(seeded)
+        return {
+            "participants": dict(self.participants),
+            "message_queues": message_queues,
+            "participant_stats": {participant_id: list(stats)
+                                  for participant_id, stats in self.selector.stats.items()},
+            "buckets": dict(self.buckets),
+            "journal_seq": self._seq
         }
-        await save_json_file(self.state_file, state)
 
-    def get_random_participant(self) -> Tuple[Optional[str], Optional[str]]:
+    def _queue_dict(self, category: str, queue: Union[SeededQueue, ShuffledQueue]) -> Dict[str, Any]:
+        """
+        Представление очереди сообщений для сохранения: seed круга с курсором
+        или, если порядок им не задан, идентификаторы вместо номеров вместе
+        с версией каталога, с которой очередь согласована.
+        """
+        seeded = self._rounds.get(category)
+        if seeded is not None:
+            return self._seeded({**seeded, "cursor": queue.cursor})
+        catalog = self._catalogs.get(category)
+        if catalog is None:
+            data = queue.to_dict()
+            if category in self._digests:
+                data["digest"] = self._digests[category]
+            return data
+        data = {"order": catalog.ids_of(queue.order), "cursor": queue.cursor}
+        if self._synced.get(category) is catalog:
+            data["digest"] = catalog.digest
+        return data
+
+    def _apply(self, op: Dict[str, Any], reserved: int = 0) -> None:
+        """
+        Применяет одну операцию журнала к состоянию в памяти.
+        Используется как при обычной работе, так и при восстановлении из журнала.
+
+        reserved — размер окна резерва для операций, заменяющих очередь целиком
+        (резерв живёт только в памяти, поэтому при восстановлении он нулевой).
+        """
+        kind = op["op"]
+        if kind == "participant_add":
+            self.participants[op["id"]] = op["name"]
+            # В журнале прежнего формата времени нет — участник считается писавшим сейчас
+            self.selector.add(op["id"], op.get("at", time.time()))
+        elif kind == "participant_seen":
+            if op["id"] in self.participants:
+                self.selector.set_activity(op["id"], op["activity"], op["at"])
+        elif kind == "participant_pick":
+            if op["id"] in self.participants:
+                self.selector.picked(op["id"], op["at"])
+        elif kind == "participant_left":
+            if op["id"] in self.participants:
+                self.selector.left(op["id"], op["at"])
+        elif kind in ("participant_pop", "participants_shuffle", "participants_set"):
+            # Операции прежней очереди участников: выбор теперь взвешенный, очереди нет
+            pass
+        elif kind == "message_pop":
+            # swaps — сообщение доставлено не в порядке резервирования, cursor —
+            # курсор после извлечения вместе с пропущенными удалёнными сообщениями
+            # (см. commit_message); в журнале прежнего формата курсора нет
+            self._swap(op["category"], op.get("swaps", []))
+            queue = self.message_queues.get(op["category"])
+            if queue is not None:
+                queue.advance()
+                if "cursor" in op:
+                    queue.cursor = op["cursor"]
+            elif op["category"] in self._rounds:
+                seeded = self._rounds[op["category"]]
+                seeded["cursor"] = op.get("cursor", seeded["cursor"] + 1)
+        elif kind == "messages_swap":
+            self._swap(op["category"], op["swaps"])
+        elif kind == "messages_extend":
+            # Каталог изменился посреди круга (см. _bind)
+            if op["category"] in self._rounds:
+                self._rounds[op["category"]]["digests"].append(op["digest"])
+        elif kind == "messages_round":
+            # Очередь восстановит по seed sync_catalog (во время работы см. shuffle_messages)
+            self._rounds[op["category"]] = self._seeded(op)
+            self.message_queues.pop(op["category"], None)
+            self._catalogs.pop(op["category"], None)
+        elif kind == "messages_shuffle":
+            # Прежний формат нового круга: полный список идентификаторов; номера
+            # назначит sync_catalog
+            self.message_queues[op["category"]] = ShuffledQueue(list(op["order"]), 0, reserved)
+            self._catalogs.pop(op["category"], None)
+            self._rounds.pop(op["category"], None)
+        elif kind == "messages_sync":
+            # Операции с явным порядком хранят идентификаторы (во время работы см. _record_queue)
+            self.message_queues[op["category"]] = ShuffledQueue(list(op["order"]), op["cursor"], reserved)
+            self._catalogs.pop(op["category"], None)
+            self._rounds.pop(op["category"], None)
+            self._digests.pop(op["category"], None)
+            if "digest" in op:
+                self._digests[op["category"]] = op["digest"]
+        elif kind == "messages_drop":
+            self.message_queues.pop(op["category"], None)
+            self._catalogs.pop(op["category"], None)
+            self._synced.pop(op["category"], None)
+            self._rounds.pop(op["category"], None)
+            self._digests.pop(op["category"], None)
+        elif kind == "bucket":
+            self.buckets[op["key"]] = op["value"]
+        elif kind == "buckets_drop":
+            for key in op["keys"]:
+                self.buckets.pop(key, None)
+        else:
+            logger.warning(f"Неизвестная операция журнала: {kind}")
+
+    def _swap(self, category: str, swaps: List[List[int]]) -> None:
+        """
+        Переставляет элементы очереди категории и запоминает перестановки
+        в круге, заданном seed, чтобы повторить их при восстановлении.
+        """
+        queue = self.message_queues.get(category)
+        if queue is not None:
+            queue.swap(swaps)
+        seeded = self._rounds.get(category)
+        if seeded is not None:
+            seeded["swaps"].extend(list(swap) for swap in swaps)
+
+    def _record(self, op: Dict[str, Any], reserved: int = 0) -> None:
+        """
+        Применяет операцию и ставит её в очередь на запись в журнал.
+        """
+        self._apply(op, reserved)
+        self._append(op)
+
+    def _record_queue(self, kind: str, category: str, queue: ShuffledQueue) -> None:
+        """
+        Устанавливает очередь номеров сообщений категории и записывает её в журнал
+        (messages_sync) идентификаторами: номера действительны только для
+        текущего каталога. Порядок такой очереди уже не задаётся seed.
+        """
+        self.message_queues[category] = queue
+        self._rounds.pop(category, None)
+        # До записи операция держит копию номеров и каталог, к которому они относятся
+        # (каталог неизменен, даже если его уже пересобрали): в идентификаторы
+        # номера переводятся только при передаче в хранилище (см. _encoded)
+        catalog = self._catalogs[category]
+        op = {"op": kind, "category": category, "order": queue.order[:], "catalog": catalog}
+        if kind == "messages_sync":
+            op["cursor"] = queue.cursor
+            if self._synced.get(category) is catalog:
+                op["digest"] = catalog.digest
+        self._append(op)
+
+    @staticmethod
+    def _encoded(op: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Представление операции для хранилища: номера сообщений → идентификаторы.
+        """
+        catalog = op.get("catalog")
+        if catalog is None:
+            return op
+        encoded = {key: value for key, value in op.items() if key != "catalog"}
+        encoded["order"] = catalog.ids_of(op["order"])
+        return encoded
+
+    def _append(self, op: Dict[str, Any]) -> None:
+        """
+        Ставит уже применённую операцию в очередь на запись в журнал.
+        """
+        self._seq += 1
+        op["seq"] = self._seq
+        self._journal.append(op)
+        self.mark_dirty()
+
+    def add_participant(self, participant_id: str, participant_name: str, at: Optional[float] = None) -> bool:
+        """
+        Добавляет участника, если его ещё нет, иначе учитывает его сообщение
+        (см. participant_seen). at — время сообщения, по умолчанию текущее.
+        Returns:
+            True, если участник был добавлен.
+        """
+        at = time.time() if at is None else at
+        if participant_id in self.participants:
+            self.participant_seen(participant_id, at)
+            return False
+        self._record({"op": "participant_add", "id": participant_id, "name": participant_name, "at": at})
+        self._seen_persisted[participant_id] = at
+        return True
+
+    def participant_seen(self, participant_id: str, at: Optional[float] = None) -> None:
+        """
+        Учитывает сообщение участника в его активности, O(log n). Активность
+        пишется в журнал не чаще раза в PARTICIPANT_SEEN_PERSIST_INTERVAL секунд
+        на участника: после сбоя теряются лишь последние сообщения.
+        """
+        if participant_id not in self.participants:
+            return
+        at = time.time() if at is None else at
+        self.selector.seen(participant_id, at)
+        stats = self.selector.stats[participant_id]
+        if stats[1] - self._seen_persisted.get(participant_id, 0.0) >= PARTICIPANT_SEEN_PERSIST_INTERVAL:
+            self._seen_persisted[participant_id] = stats[1]
+            self._append({"op": "participant_seen", "id": participant_id, "activity": stats[0], "at": stats[1]})
+
+    def participant_left(self, participant_id: str) -> None:
+        """
+        Исключает вышедшего из чата участника из выбора до его следующего сообщения.
+        """
+        if participant_id in self.participants:
+            self._record({"op": "participant_left", "id": participant_id, "at": time.time()})
+
+    def shuffle_messages(self, category: str, catalog: MessageCatalog) -> None:
         """
-        Выбирает участника без повторов, пока не пройдут все.
+        Начинает новый случайный круг по сообщениям категории. Порядок не
+        строится: в журнал пишется только seed, версия каталога и
+        зарезервированные сообщения прежнего круга, которые остаются в начале.
+        """
+        queue = self.message_queues.get(category)
+        head = []
+        if queue is not None and self._catalogs.get(category) is catalog:
+            head = [index for index in queue.window() if index is not None]
+        seed = random.getrandbits(63)
+        self.message_queues[category] = SeededQueue(seed, [(len(catalog), None)], head, reserved=len(head))
+        self._catalogs[category] = catalog
+        self._synced.pop(category, None)
+        self._digests.pop(category, None)
+        ids = catalog.ids_of(head)
+        self._rounds[category] = {"seed": seed, "digests": [catalog.digest], "head": ids, "swaps": []}
+        self._append({"op": "messages_round", "category": category, "seed": seed, "digests": [catalog.digest],
+                      "head": list(ids), "swaps": [], "cursor": 0})
+
+    def sync_messages(self, category: str) -> None:
+        """
+        Согласует очередь категории с изменившимся каталогом без перемешивания.
+        """
+        catalog = self._catalogs[category]
+        queue = self.message_queues[category].copy()
+        self._synced[category] = catalog
+        if queue.sync(range(len(catalog))):
+            logger.info(f"Очередь категории '{category}' согласована с каталогом.")
+            self._record_queue("messages_sync", category, queue)
+
+    def reserve_message(self, category: str,
+                        message_manager: MessageManager) -> Optional[Tuple[str, str]]:
+        """
+        Резервирует следующее сообщение категории. Если доступных сообщений нет,
+        начинает новый круг по всем сообщениям категории. Декодируется только
+        текст выбранного сообщения.
+
+        Резерв нужно завершить commit_message после доставки
+        или release_message, если сообщение отправить не удалось.
+        Returns:
+            (message_id, шаблон сообщения) или None, если в категории нет сообщений.
+        """
+        catalog = message_manager.categories.get(category)
+        if catalog is None or not len(catalog):
+            return None
+        self._sync_category(category, message_manager)
+        index = self.message_queues[category].reserve()
+        if index is None:
+            # В круге остались только позиции удалённых сообщений
+            self.shuffle_messages(category, catalog)
+            index = self.message_queues[category].reserve()
+            if index is None:
+                return None
+        return catalog.message_id(index), catalog.message(index)
+
+    def _reserved_index(self, category: str, message_id: str) -> Optional[int]:
+        """
+        Номер зарезервированного сообщения в текущем каталоге. Пока сообщение
+        ждало отправки, каталог мог быть пересобран, поэтому резерв ищется
+        по стабильному идентификатору.
+        """
+        queue = self.message_queues.get(category)
+        catalog = self._catalogs.get(category)
+        if queue is None or catalog is None:
+            return None
+        index = catalog.index_of(message_id)
+        return index if index is not None and queue.is_reserved(index) else None
+
+    def commit_message(self, category: str, message_id: str) -> None:
+        """
+        Окончательно извлекает зарезервированное сообщение (после доставки).
+        """
+        index = self._reserved_index(category, message_id)
+        if index is None:
+            # Категорию или сообщение удалили из каталога, пока оно отправлялось
+            return
+        queue = self.message_queues[category]
+        swaps = queue.commit_swaps(index)
+        self._swap(category, swaps)
+        queue.advance()
+        op: Dict[str, Any] = {"op": "message_pop", "category": category, "cursor": queue.cursor}
+        if swaps:
+            # Сообщения доставлены не в порядке резервирования — сохраняем перестановку
+            op["swaps"] = swaps
+        self._append(op)
+
+    def release_message(self, category: str, message_id: str) -> None:
+        """
+        Снимает резерв с сообщения, которое не удалось отправить:
+        оно будет выдано следующим.
+        """
+        index = self._reserved_index(category, message_id)
+        if index is None:
+            return
+        swaps = self.message_queues[category].release_swaps(index)
+        if swaps:
+            self._record({"op": "messages_swap", "category": category, "swaps": swaps})
+        self.message_queues[category].reserved -= 1
+
+    def set_bucket(self, key: str, value: List[float]) -> None:
+        """
+        Сохраняет состояние корзины ограничителя частоты (см. rate_limiter).
+        """
+        self._record({"op": "bucket", "key": key, "value": value})
+
+    def drop_full_buckets(self, now: float) -> int:
+        """
+        Удаляет корзины, которые к моменту now снова заполнились: полная корзина
+        равносильна отсутствующей. Все удаления записываются одной операцией.
+        Returns:
+            Количество удалённых корзин.
+        """
+        keys = [key for key, (_, _, full_at) in self.buckets.items() if full_at <= now]
+        if keys:
+            self._record({"op": "buckets_drop", "keys": keys})
+        return len(keys)
+
+    @property
+    def is_dirty(self) -> bool:
+        """
+        Есть ли изменения, которые ещё не записаны на диск.
+        """
+        return bool(self._journal)
+
+    def mark_dirty(self) -> None:
+        """
+        Сообщает о новом изменении. Запись произойдёт в фоне: по таймеру
+        или досрочно, если накопилось flush_max_changes изменений.
+        """
+        if len(self._journal) >= self.flush_max_changes:
+            self._flush_requested.set()
+
+    @timed(STATE_IO_LATENCY, "save_state")
+    async def save_state(self) -> None:
+        """
+        Немедленно сохраняет полный снимок состояния и очищает журнал.
+        """
+        async with self._save_lock:
+            await self._compact()
+
+    async def _compact(self) -> None:
+        # Снимок берём синхронно: всё, что изменится во время записи,
+        # попадёт в журнал уже после него.
+        pending = self._journal
+        self._journal = []
+        if not await self.storage.write_snapshot(self.chat_id, self.snapshot()):
+            # Запись не удалась — возвращаем операции в очередь до следующей попытки
+            self._journal = pending + self._journal
+
+    @timed(STATE_IO_LATENCY, "flush")
+    async def flush(self, unloading: bool = False) -> None:
+        """
+        Передаёт накопленные операции в хранилище и при необходимости
+        сворачивает их в новый снимок. unloading — шард выгружается
+        или бот останавливается (см. StateStorage.wants_snapshot).
+        """
+        async with self._save_lock:
+            if self._journal:
+                pending = self._journal
+                self._journal = []
+                if not await self.storage.append(self.chat_id, [self._encoded(op) for op in pending]):
+                    self._journal = pending + self._journal
+                    return
+            if self.storage.wants_snapshot(self.chat_id, unloading):
+                await self._compact()
+
+    def reserve_participant(self) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Резервирует участника, выбранного взвешенно по активности (O(log n)).
+        Пока резерв не снят, участник не выбирается повторно. Резерв нужно
+        завершить commit_participant или release_participant.
         Returns:
             Tuple[participant_name, participant_id]
         """
-        if not self.shuffled_participants:
-            if self.participants:
-                self.shuffled_participants = random.sample(list(self.participants.keys()), len(self.participants))
-            else:
-                return None, None
-        chosen_id = self.shuffled_participants.pop(0)
+        now = time.time()
+        chosen_id = self.selector.choose(now)
+        if chosen_id is None:
+            return None, None
+        self.selector.reserve(chosen_id, now)
         return self.participants.get(chosen_id), chosen_id
+
+    def commit_participant(self, participant_id: str) -> None:
+        """
+        Снимает резерв и запоминает выбор участника (после доставки):
+        недавно выбранный участник какое-то время выбирается реже.
+        """
+        now = time.time()
+        self.selector.release(participant_id, now)
+        if participant_id in self.participants:
+            self._record({"op": "participant_pick", "id": participant_id, "at": now})
+
+    def release_participant(self, participant_id: str) -> None:
+        """
+        Снимает резерв с участника, если сообщение отправить не удалось.
+        """
+        if participant_id in self.participants:
+            self.selector.release(participant_id, time.time())
@@ -0,0 +1,588 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple, TypeVar, Union
+from json_utils import load_json_file, save_json_file, append_json_lines, load_json_lines, truncate_file
+from config import JOURNAL_COMPACT_BYTES
+
+if TYPE_CHECKING:
+    import sqlite3
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Снимок состояния чата и операции журнала, которые нужно применить поверх него
+Snapshot = Dict[str, Any]
+Operations = List[Dict[str, Any]]
+# Расписания публикаций всех чатов: {chat_id: {schedule_id: запись}} (см. post_scheduler)
+# и их изменения: (chat_id, schedule_id, запись или None — расписание удалено)
+Schedules = Dict[str, Dict[str, Dict[str, Any]]]
+ScheduleChanges = List[Tuple[str, str, Optional[Dict[str, Any]]]]
+
+class StateStorage(ABC):
+    """
+    Интерфейс хранилища состояния чатов, с которым работает StateManager.
+
+    Состояние чата описывается снимком (см. StateManager.snapshot) и потоком
+    мелких операций журнала (см. StateManager._apply). Хранилище решает само,
+    как их хранить: JSON-файлы со снимком и журналом или строки SQLite.
+    """
+
+    @abstractmethod
+    async def load(self, chat_id: str) -> Tuple[Snapshot, Operations]:
+        """
+        Возвращает снимок состояния чата и операции, записанные после него.
+        """
+
+    @abstractmethod
+    async def append(self, chat_id: str, ops: Operations) -> bool:
+        """
+        Сохраняет новые операции чата.
+        Returns:
+            True, если операции сохранены.
+        """
+
+    @abstractmethod
+    async def write_snapshot(self, chat_id: str, snapshot: Snapshot) -> bool:
+        """
+        Полностью заменяет сохранённое состояние чата снимком.
+        Returns:
+            True, если снимок сохранён.
+        """
+
+    def wants_snapshot(self, chat_id: str, unloading: bool = False) -> bool:
+        """
+        Нужно ли свернуть накопленные операции чата в новый снимок.
+        unloading — шард выгружается из памяти (или бот останавливается):
+        свёрнутый журнал избавит следующую загрузку чата от его чтения и повтора.
+        """
+        return False
+
+    def release(self, chat_id: str) -> None:
+        """
+        Сообщает, что шард чата выгружен из памяти.
+        """
+
+    async def list_chats(self) -> List[str]:
+        """
+        Возвращает идентификаторы всех чатов, для которых есть состояние.
+        """
+        return []
+
+    async def load_schedules(self) -> Schedules:
+        """
+        Возвращает расписания публикаций всех чатов. Они хранятся отдельно
+        от шардов: планировщику при запуске не нужно загружать состояние чатов.
+        """
+        return {}
+
+    async def save_schedules(self, changes: ScheduleChanges) -> bool:
+        """
+        Сохраняет изменения расписаний.
+        Returns:
+            True, если изменения сохранены.
+        """
+        return True
+
+    def size_bytes(self) -> int:
+        """
+        Размер сохранённого состояния на диске, в байтах.
+        """
+        return 0
+
+    async def close(self) -> None:
+        """
+        Освобождает ресурсы хранилища.
+        """
+
+
+class JsonStateStorage(StateStorage):
+    """
+    Хранилище на JSON-файлах: для каждого чата снимок <chat_id>.json и журнал
+    операций <chat_id>.journal в каталоге state_dir. Журнал сворачивается
+    в снимок, когда превышает compact_bytes, и при выгрузке шарда: после
+    остановки бота каждый чат загружается одним чтением снимка, без повтора
+    журнала. Расписания всех чатов хранятся
+    так же — в паре schedules.json/schedules.journal.
+    """
+    SCHEDULES = "schedules"
+
+    def __init__(self, state_dir: Path, compact_bytes: int = JOURNAL_COMPACT_BYTES) -> None:
+        self.state_dir = state_dir
+        self.compact_bytes = compact_bytes
+        self._journal_sizes: Dict[str, int] = {}  # Размеры журналов загруженных чатов
+        self._schedules: Optional[Schedules] = None  # Расписания после load_schedules
+
+    def shard_paths(self, chat_id: str) -> Tuple[Path, Path]:
+        """
+        Возвращает пути к снимку и журналу чата.
+        """
+        return self.state_dir / f"{chat_id}.json", self.state_dir / f"{chat_id}.journal"
+
+    def adopt_legacy_state(self, chat_id: str, state_file: Path, journal_file: Path) -> None:
+        """
+        Переносит состояние из старого единого state.json (и его журнала)
+        в шард указанного чата, если шарда ещё нет.
+        """
+        shard_file, shard_journal = self.shard_paths(chat_id)
+        if not state_file.exists() or shard_file.exists():
+            return
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        if journal_file.exists():
+            os.replace(journal_file, shard_journal)
+        os.replace(state_file, shard_file)
+        logger.info(f"Состояние {state_file} перенесено в шард чата {chat_id}.")
+
+    async def load(self, chat_id: str) -> Tuple[Snapshot, Operations]:
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        state_file, journal_file = self.shard_paths(chat_id)
+        # Пустой снимок не создаётся: чат без сохранённых изменений не оставляет файлов
+        snapshot = await load_json_file(state_file, default={}, create_missing=False)
+        ops = await load_json_lines(journal_file)
+        self._journal_sizes[chat_id] = journal_file.stat().st_size if journal_file.exists() else 0
+        return snapshot, ops
+
+    async def append(self, chat_id: str, ops: Operations) -> bool:
+        _, journal_file = self.shard_paths(chat_id)
+        if not await append_json_lines(journal_file, ops):
+            return False
+        self._journal_sizes[chat_id] = journal_file.stat().st_size
+        return True
+
+    async def write_snapshot(self, chat_id: str, snapshot: Snapshot) -> bool:
+        state_file, journal_file = self.shard_paths(chat_id)
+        if not await save_json_file(state_file, snapshot, indent=None):
+            return False
+        # Снимок уже содержит все операции журнала; если процесс упадёт до очистки,
+        # они будут пропущены при загрузке по номеру journal_seq.
+        if await truncate_file(journal_file):
+            self._journal_sizes[chat_id] = 0
+        logger.info(f"Журнал чата {chat_id} свёрнут в снимок (seq={snapshot.get('journal_seq')}).")
+        return True
+
+    def wants_snapshot(self, chat_id: str, unloading: bool = False) -> bool:
+        size = self._journal_sizes.get(chat_id, 0)
+        return size >= self.compact_bytes or (unloading and size > 0)
+
+    def release(self, chat_id: str) -> None:
+        self._journal_sizes.pop(chat_id, None)
+
+    async def list_chats(self) -> List[str]:
+        if not self.state_dir.exists():
+            return []
+        # У чата может быть только журнал, если снимок ещё ни разу не записывался
+        chats = {path.stem for pattern in ("*.json", "*.journal") for path in self.state_dir.glob(pattern)}
+        chats.discard(self.SCHEDULES)
+        return sorted(chats)
+
+    @staticmethod
+    def _apply_schedule_change(schedules: Schedules, chat_id: str, schedule_id: str,
+                               record: Optional[Dict[str, Any]]) -> None:
+        if record is not None:
+            schedules.setdefault(chat_id, {})[schedule_id] = dict(record)
+        elif schedule_id in schedules.get(chat_id, {}):
+            del schedules[chat_id][schedule_id]
+            if not schedules[chat_id]:
+                del schedules[chat_id]
+
+    async def load_schedules(self) -> Schedules:
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        snapshot_file, journal_file = self.shard_paths(self.SCHEDULES)
+        schedules = await load_json_file(snapshot_file, default={}, create_missing=False)
+        for change in await load_json_lines(journal_file):
+            self._apply_schedule_change(schedules, change["chat"], change["id"], change.get("schedule"))
+        self._schedules = schedules
+        return {chat_id: {schedule_id: dict(record) for schedule_id, record in records.items()}
+                for chat_id, records in schedules.items()}
+
+    async def save_schedules(self, changes: ScheduleChanges) -> bool:
+        if self._schedules is None:
+            await self.load_schedules()
+        snapshot_file, journal_file = self.shard_paths(self.SCHEDULES)
+        if not await append_json_lines(journal_file, [{"chat": chat_id, "id": schedule_id, "schedule": record}
+                                                      for chat_id, schedule_id, record in changes]):
+            return False
+        for chat_id, schedule_id, record in changes:
+            self._apply_schedule_change(self._schedules, chat_id, schedule_id, record)
+        # Изменения идемпотентны: если процесс упадёт до очистки журнала, повтор ничего не испортит
+        if journal_file.stat().st_size > self.compact_bytes:
+            if await save_json_file(snapshot_file, self._schedules, indent=None):
+                await truncate_file(journal_file)
+        return True
+
+    def size_bytes(self) -> int:
+        if not self.state_dir.exists():
+            return 0
+        with os.scandir(self.state_dir) as entries:
+            return sum(entry.stat().st_size for entry in entries if entry.is_file())
+
+
+class SqliteStateStorage(StateStorage):
+    """
+    Хранилище на SQLite (режим WAL). Каждая операция журнала превращается
+    в однострочный upsert или update по первичному ключу, поэтому стоимость
+    сохранения не зависит от размера состояния.
+
+    Все обращения к базе выполняются в отдельном потоке, чтобы не блокировать
+    цикл событий.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS participants (
+            chat_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            activity REAL,
+            activity_at REAL,
+            seen REAL,
+            picked REAL,
+            PRIMARY KEY (chat_id, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS queues (
+            chat_id TEXT NOT NULL,
+            queue TEXT NOT NULL,
+            item_order TEXT NOT NULL,
+            cursor INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, queue)
+        );
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            chat_id TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (chat_id, key)
+        );
+        CREATE TABLE IF NOT EXISTS schedules (
+            chat_id TEXT NOT NULL,
+            schedule_id TEXT NOT NULL,
+            spec TEXT NOT NULL,
+            category TEXT,
+            last REAL NOT NULL,
+            PRIMARY KEY (chat_id, schedule_id)
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+    # Статистика участника для взвешенного выбора (см. participant_selector);
+    # в базах прежней версии эти столбцы добавляются при подключении
+    PARTICIPANT_STATS = ("activity", "activity_at", "seen", "picked")
+    MESSAGE_QUEUE_PREFIX = "messages:"
+
+    def __init__(self, db_file: Path) -> None:
+        self.db_file = db_file
+        # Один поток: соединение SQLite используется строго последовательно
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-state")
+        self._conn: Optional["sqlite3.Connection"] = None
+
+    async def _run(self, func: Callable[..., T], *args: Any) -> T:
+        """
+        Выполняет функцию в потоке базы данных.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _connect(self) -> "sqlite3.Connection":
+        if self._conn is None:
+            # sqlite3 нужен только этому хранилищу, поэтому не замедляет запуск с JSON
+            import sqlite3
+            self.db_file.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.db_file, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(self.SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(participants)")}
+            with conn:
+                for column in self.PARTICIPANT_STATS:
+                    if column not in columns:
+                        conn.execute(f"ALTER TABLE participants ADD COLUMN {column} REAL")
+            self._conn = conn
+        return self._conn
+
+    def _load(self, chat_id: str) -> Snapshot:
+        conn = self._connect()
+        participants: Dict[str, str] = {}
+        participant_stats: Dict[str, List[float]] = {}
+        for user_id, name, *stats in conn.execute(
+                f"SELECT user_id, name, {', '.join(self.PARTICIPANT_STATS)} FROM participants WHERE chat_id = ?",
+                (chat_id,)):
+            participants[user_id] = name
+            if None not in stats:
+                participant_stats[user_id] = stats
+        message_queues: Dict[str, Any] = {}
+        # Строка очереди участников прежней версии пропускается и удалится со следующим снимком
+        for queue, item_order, cursor in conn.execute(
+                "SELECT queue, item_order, cursor FROM queues WHERE chat_id = ?", (chat_id,)):
+            if queue.startswith(self.MESSAGE_QUEUE_PREFIX):
+                order = json.loads(item_order)
+                # Очередь круга, заданного seed, хранится словарём (см. StateManager.shuffle_messages)
+                message_queues[queue[len(self.MESSAGE_QUEUE_PREFIX):]] = (
+                    {**order, "cursor": cursor} if isinstance(order, dict) else {"order": order, "cursor": cursor})
+        buckets = {
+            key: json.loads(value) for key, value in conn.execute(
+                "SELECT key, value FROM rate_limits WHERE chat_id = ?", (chat_id,))
+        }
+        return {
+            "participants": participants,
+            "message_queues": message_queues,
+            "participant_stats": participant_stats,
+            "buckets": buckets,
+        }
+
+    def _set_queue(self, conn: "sqlite3.Connection", chat_id: str, queue: str,
+                   order: Union[List[Any], Dict[str, Any]], cursor: int) -> None:
+        conn.execute(
+            "INSERT INTO queues (chat_id, queue, item_order, cursor) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (chat_id, queue) DO UPDATE SET item_order = excluded.item_order, cursor = excluded.cursor",
+            (chat_id, queue, json.dumps(order, ensure_ascii=False), cursor))
+
+    def _swap_queue(self, conn: "sqlite3.Connection", chat_id: str, queue: str,
+                    swaps: List[List[int]]) -> None:
+        row = conn.execute("SELECT item_order FROM queues WHERE chat_id = ? AND queue = ?",
+                           (chat_id, queue)).fetchone()
+        if row is None:
+            return
+        order = json.loads(row[0])
+        if isinstance(order, dict):
+            # Круг, заданный seed: перестановки повторяются при восстановлении очереди
+            order["swaps"].extend(swaps)
+        else:
+            for first, second in swaps:
+                order[first], order[second] = order[second], order[first]
+        conn.execute("UPDATE queues SET item_order = ? WHERE chat_id = ? AND queue = ?",
+                     (json.dumps(order, ensure_ascii=False), chat_id, queue))
+
+    def _extend_queue(self, conn: "sqlite3.Connection", chat_id: str, queue: str, digest: str) -> None:
+        row = conn.execute("SELECT item_order FROM queues WHERE chat_id = ? AND queue = ?",
+                           (chat_id, queue)).fetchone()
+        if row is None:
+            return
+        order = json.loads(row[0])
+        if isinstance(order, dict):
+            order.setdefault("digests", []).append(digest)
+            conn.execute("UPDATE queues SET item_order = ? WHERE chat_id = ? AND queue = ?",
+                         (json.dumps(order, ensure_ascii=False), chat_id, queue))
+
+    def _advance_queue(self, conn: "sqlite3.Connection", chat_id: str, queue: str,
+                       cursor: Optional[int] = None) -> None:
+        if cursor is None:
+            # Журнал прежнего формата: извлечение сдвигает курсор на одну позицию
+            conn.execute("UPDATE queues SET cursor = cursor + 1 WHERE chat_id = ? AND queue = ?",
+                         (chat_id, queue))
+        else:
+            conn.execute("UPDATE queues SET cursor = ? WHERE chat_id = ? AND queue = ?",
+                         (cursor, chat_id, queue))
+
+    @staticmethod
+    def _round_of(queue: Dict[str, Any]) -> Dict[str, Any]:
+        # Курсор круга хранится в отдельном столбце, как и у очереди с явным порядком
+        return {"seed": queue["seed"], "digests": queue.get("digests", []), "head": queue.get("head", []),
+                "swaps": queue.get("swaps", [])}
+
+    def _set_value(self, conn: "sqlite3.Connection", chat_id: str, key: str, value: Any) -> None:
+        conn.execute(
+            "INSERT INTO rate_limits (chat_id, key, value) VALUES (?, ?, ?) "
+            "ON CONFLICT (chat_id, key) DO UPDATE SET value = excluded.value",
+            (chat_id, key, json.dumps(value)))
+
+    def _apply_op(self, conn: "sqlite3.Connection", chat_id: str, op: Dict[str, Any]) -> None:
+        """
+        Переводит одну операцию журнала в изменение строк базы.
+        """
+        kind = op["op"]
+        if kind == "participant_add":
+            at = op.get("at")
+            conn.execute(
+                "INSERT INTO participants (chat_id, user_id, name, activity, activity_at, seen, picked) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (chat_id, user_id) DO UPDATE SET name = excluded.name",
+                (chat_id, op["id"], op["name"], None if at is None else 1.0, at, at, None if at is None else 0.0))
+        elif kind == "participant_seen":
+            conn.execute(
+                "UPDATE participants SET activity = ?, activity_at = ?, seen = MAX(COALESCE(seen, 0), ?), "
+                "picked = COALESCE(picked, 0) WHERE chat_id = ? AND user_id = ?",
+                (op["activity"], op["at"], op["at"], chat_id, op["id"]))
+        elif kind == "participant_pick":
+            conn.execute("UPDATE participants SET picked = ? WHERE chat_id = ? AND user_id = ?",
+                         (op["at"], chat_id, op["id"]))
+        elif kind == "participant_left":
+            conn.execute("UPDATE participants SET seen = 0 WHERE chat_id = ? AND user_id = ?",
+                         (chat_id, op["id"]))
+        elif kind == "message_pop":
+            if op.get("swaps"):
+                self._swap_queue(conn, chat_id, self.MESSAGE_QUEUE_PREFIX + op["category"], op["swaps"])
+            self._advance_queue(conn, chat_id, self.MESSAGE_QUEUE_PREFIX + op["category"], op.get("cursor"))
+        elif kind == "messages_swap":
+            self._swap_queue(conn, chat_id, self.MESSAGE_QUEUE_PREFIX + op["category"], op["swaps"])
+        elif kind == "messages_extend":
+            self._extend_queue(conn, chat_id, self.MESSAGE_QUEUE_PREFIX + op["category"], op["digest"])
+        elif kind == "messages_round":
+            self._set_queue(conn, chat_id, self.MESSAGE_QUEUE_PREFIX + op["category"],
+                            self._round_of(op), op["cursor"])
+        elif kind == "messages_shuffle":
+            self._set_queue(conn, chat_id, self.MESSAGE_QUEUE_PREFIX + op["category"], op["order"], 0)
+        elif kind == "messages_sync":
+            self._set_queue(conn, chat_id, self.MESSAGE_QUEUE_PREFIX + op["category"],
+                            op["order"], op["cursor"])
+        elif kind == "messages_drop":
+            conn.execute("DELETE FROM queues WHERE chat_id = ? AND queue = ?",
+                         (chat_id, self.MESSAGE_QUEUE_PREFIX + op["category"]))
+        elif kind == "bucket":
+            self._set_value(conn, chat_id, op["key"], op["value"])
+        elif kind == "buckets_drop":
+            conn.executemany("DELETE FROM rate_limits WHERE chat_id = ? AND key = ?",
+                             [(chat_id, key) for key in op["keys"]])
+        else:
+            logger.warning(f"Неизвестная операция журнала: {kind}")
+
+    def _append(self, chat_id: str, ops: Operations) -> None:
+        conn = self._connect()
+        with conn:
+            for op in ops:
+                self._apply_op(conn, chat_id, op)
+
+    def _write_snapshot(self, chat_id: str, snapshot: Snapshot) -> None:
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM participants WHERE chat_id = ?", (chat_id,))
+            conn.execute("DELETE FROM queues WHERE chat_id = ?", (chat_id,))
+            conn.execute("DELETE FROM rate_limits WHERE chat_id = ?", (chat_id,))
+            stats = snapshot.get("participant_stats", {})
+            conn.executemany(
+                "INSERT INTO participants (chat_id, user_id, name, activity, activity_at, seen, picked) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(chat_id, user_id, name, *stats.get(user_id, (None,) * len(self.PARTICIPANT_STATS)))
+                 for user_id, name in snapshot.get("participants", {}).items()])
+            for category, queue in snapshot.get("message_queues", {}).items():
+                self._set_queue(conn, chat_id, self.MESSAGE_QUEUE_PREFIX + category,
+                                self._round_of(queue) if "seed" in queue else queue.get("order", []),
+                                queue.get("cursor", 0))
+            for key, value in snapshot.get("buckets", {}).items():
+                self._set_value(conn, chat_id, key, value)
+
+    def _list_chats(self) -> List[str]:
+        conn = self._connect()
+        rows = conn.execute(
+            "SELECT chat_id FROM participants UNION SELECT chat_id FROM queues "
+            "UNION SELECT chat_id FROM rate_limits")
+        return sorted(chat_id for (chat_id,) in rows)
+
+    def _load_schedules(self) -> Schedules:
+        schedules: Schedules = {}
+        for chat_id, schedule_id, spec, category, last in self._connect().execute(
+                "SELECT chat_id, schedule_id, spec, category, last FROM schedules"):
+            schedules.setdefault(chat_id, {})[schedule_id] = {"spec": spec, "category": category, "last": last}
+        return schedules
+
+    def _save_schedules(self, changes: ScheduleChanges) -> None:
+        conn = self._connect()
+        with conn:
+            for chat_id, schedule_id, record in changes:
+                if record is None:
+                    conn.execute("DELETE FROM schedules WHERE chat_id = ? AND schedule_id = ?",
+                                 (chat_id, schedule_id))
+                else:
+                    conn.execute(
+                        "INSERT INTO schedules (chat_id, schedule_id, spec, category, last) VALUES (?, ?, ?, ?, ?) "
+                        "ON CONFLICT (chat_id, schedule_id) DO UPDATE SET spec = excluded.spec, "
+                        "category = excluded.category, last = excluded.last",
+                        (chat_id, schedule_id, record["spec"], record.get("category"), record["last"]))
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        row = self._connect().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value: str) -> None:
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    async def load(self, chat_id: str) -> Tuple[Snapshot, Operations]:
+        return await self._run(self._load, chat_id), []
+
+    async def append(self, chat_id: str, ops: Operations) -> bool:
+        try:
+            await self._run(self._append, chat_id, ops)
+            return True
+        except Exception as e:
+            logger.exception(f"Ошибка записи операций чата {chat_id} в {self.db_file}: {e}")
+            return False
+
+    async def write_snapshot(self, chat_id: str, snapshot: Snapshot) -> bool:
+        try:
+            await self._run(self._write_snapshot, chat_id, snapshot)
+            return True
+        except Exception as e:
+            logger.exception(f"Ошибка записи снимка чата {chat_id} в {self.db_file}: {e}")
+            return False
+
+    async def list_chats(self) -> List[str]:
+        return await self._run(self._list_chats)
+
+    async def load_schedules(self) -> Schedules:
+        return await self._run(self._load_schedules)
+
+    async def save_schedules(self, changes: ScheduleChanges) -> bool:
+        try:
+            await self._run(self._save_schedules, changes)
+            return True
+        except Exception as e:
+            logger.exception(f"Ошибка записи расписаний в {self.db_file}: {e}")
+            return False
+
+    async def migrate_from(self, source: StateStorage) -> int:
+        """
+        Однократно переносит состояние и расписания всех чатов из другого
+        хранилища (например, из JSON-файлов прежнего формата).
+
+        Returns:
+            Количество перенесённых чатов (0, если перенос уже выполнялся).
+        """
+        if await self._run(self._get_meta, "migrated_from") is not None:
+            return 0
+        # Импорт здесь, чтобы не создавать циклической зависимости модулей
+        from state_manager import StateManager
+        migrated = 0
+        for chat_id in await source.list_chats():
+            shard = StateManager(chat_id, source)
+            shard.restore(*(await source.load(chat_id)))
+            if await self.write_snapshot(chat_id, shard.snapshot()):
+                migrated += 1
+            source.release(chat_id)
+        schedules = await source.load_schedules()
+        await self.save_schedules([(chat_id, schedule_id, record)
+                                   for chat_id, records in schedules.items()
+                                   for schedule_id, record in records.items()])
+        await self._run(self._set_meta, "migrated_from", f"{type(source).__name__}@{int(time.time())}")
+        logger.info(f"В {self.db_file} перенесено состояние чатов: {migrated}")
+        return migrated
+
+    def size_bytes(self) -> int:
+        # Вместе с WAL-файлом, куда попадают изменения до контрольной точки
+        files = (self.db_file, self.db_file.with_name(f"{self.db_file.name}-wal"))
+        return sum(file.stat().st_size for file in files if file.exists())
+
+    def _close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def close(self) -> None:
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
+
+
+def create_storage(backend: str, state_dir: Path, db_file: Path) -> StateStorage:
+    """
+    Создаёт хранилище состояния по имени бэкенда ('json' или 'sqlite').
+    """
+    if backend == "json":
+        return JsonStateStorage(state_dir)
+    if backend == "sqlite":
+        return SqliteStateStorage(db_file)
+    raise ValueError(f"Неизвестный бэкенд хранилища состояния: {backend}")
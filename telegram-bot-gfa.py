@@ -1,79 +1,245 @@
+import time
+# Отсчёт этапов запуска начинается до импорта тяжёлых модулей (telegram, httpx)
+PROCESS_STARTED = time.perf_counter()
+
+import signal
 import asyncio
 import logging
-from telegram.ext import Application, CommandHandler, ContextTypes
+from typing import Dict
+from telegram.ext import Application, CommandHandler, ContextTypes, TypeHandler
 import nest_asyncio
 
-from config import TOKEN, STATE_FILE, MESSAGES_DIR
+from config import (TOKEN, CHAT_ID, STATE_FILE, STATE_JOURNAL_FILE, STATE_BACKEND, STATE_DIR,
+                    STATE_DB_FILE, MESSAGES_DIR, CATALOG_POLL_INTERVAL, CATALOG_DIR, BACKLOG_CATCH_UP, CONCURRENT_UPDATES, BOT_MODE, WEBHOOK_LISTEN, PORT, WEBHOOK_PATH,
+                    WEBHOOK_URL, WEBHOOK_SECRET, METRICS_LISTEN, METRICS_PORT)
 from message_manager import MessageManager
-from state_manager import StateManager
-from handlers import help_command, post_command_handler, global_error_handler, track_new_users
+from chat_registry import ChatRegistry
+from logging_setup import setup_logging
+from metrics import REGISTRY, register_state_gauges
+from startup_timer import StartupTimer
+from send_dispatcher import SendDispatcher
+from backlog import catch_up
+from storage import JsonStateStorage, SqliteStateStorage, create_storage
+from handlers import (help_command, post_command_handler, global_error_handler, track_new_users, track_left_users,
+                      schedule_command, scheduled_post)
+from post_scheduler import PostScheduler
 from telegram import Update
 from telegram.ext import MessageHandler, filters
 
 
-def setup_logging() -> None:
+async def run_webhook(application: Application) -> None:
     """
-    Настраивает логирование с использованием RotatingFileHandler для файла и консольного вывода.
+    Запускает бота в режиме вебхука: Telegram присылает обновления HTTP-запросами
+    на WEBHOOK_URL/WEBHOOK_PATH, которые принимает WebhookServer на порту PORT.
+
+    В отличие от run_polling, машина не опрашивает Telegram каждые 10 секунд и может
+    быть остановлена fly.io при простое. Работает до SIGTERM/SIGINT, после чего
+    выполняет те же шаги остановки, что и run_polling (включая post_stop и post_shutdown).
     """
-    from logging.handlers import RotatingFileHandler
-    logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    
-    # Консольный обработчик
-    console_handler = logging.StreamHandler()
-    console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
-    
-    # Файловый обработчик с ротацией
-    file_handler = RotatingFileHandler("bot.log", maxBytes=5 * 1024 * 1024, backupCount=2, encoding='utf-8')
-    file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    # tornado нужен только в этом режиме, поэтому импортируем его здесь
+    from webhook_server import WebhookServer
+
+    logger = logging.getLogger(__name__)
+    stop_requested = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_requested.set)
+
+    server = WebhookServer(application, WEBHOOK_LISTEN, PORT, WEBHOOK_PATH, WEBHOOK_SECRET)
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    await server.start()
+    try:
+        webhook_url = f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH.strip('/')}"
+        # Лишний setWebhook при каждом пробуждении не нужен: адрес обычно уже установлен
+        info = await application.bot.get_webhook_info()
+        if info.url != webhook_url:
+            await application.bot.set_webhook(url=webhook_url, secret_token=WEBHOOK_SECRET,
+                                              allowed_updates=Update.ALL_TYPES)
+            logger.info(f"Вебхук установлен на {webhook_url}")
+        await stop_requested.wait()
+    finally:
+        logger.info("Остановка бота")
+        await server.stop()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
 
 async def main() -> None:
     """
     Основная асинхронная функция для запуска Telegram-бота.
     
-    Создает менеджеры сообщений и состояния, регистрирует обработчики:
-    - Единый обработчик для команды /post (а также для /post_<category>) с ограничением: можно отправлять только одно сообщение в 30 минут.
+    Создает менеджер сообщений и реестр состояний чатов, регистрирует обработчики:
+    - Единый обработчик для команды /post (а также для /post_<category>) с ограничением: в каждый чат можно отправлять только одно сообщение в 15 минут.
     - Обработчик для команды /help без ограничений.
     - Глобальный обработчик ошибок.
+
+    Каталог messages_lists перечитывается раз в CATALOG_POLL_INTERVAL секунд без
+    перезапуска; команды /post_<category> регистрируются и снимаются на лету.
+
+    Сообщения /post отправляются через SendDispatcher: обработчик не ждёт отправки,
+    а сообщение считается использованным только после доставки.
+
+    Публикации по расписанию (/schedule) всех чатов выполняет PostScheduler
+    на одном таймере JobQueue.
+
+    Состояние сохраняется в фоне и дописывается на диск при остановке бота.
+    Метрики Prometheus доступны на METRICS_LISTEN:METRICS_PORT/metrics.
+    Обновления получаются опросом (по умолчанию) или через вебхук (BOT_MODE=webhook).
     """
+    startup = StartupTimer(PROCESS_STARTED)
+    startup.mark("imports")
     setup_logging()
     logger = logging.getLogger(__name__)
     logger.info("Запуск бота")
+    startup.mark("logging")
     
-    # Создаем менеджеры сообщений и состояния
-    message_manager = await MessageManager.create(MESSAGES_DIR)
-    state_manager = StateManager(STATE_FILE)
-    await state_manager.load_state(message_manager)
+    # Создаем менеджер сообщений и реестр состояний чатов
+    message_manager = await MessageManager.create(MESSAGES_DIR, CATALOG_DIR)
+    startup.mark("catalog")
+    json_storage = JsonStateStorage(STATE_DIR)
+    if CHAT_ID:
+        # Состояние единственного чата из прежних версий становится его шардом
+        json_storage.adopt_legacy_state(CHAT_ID, STATE_FILE, STATE_JOURNAL_FILE)
+    storage = create_storage(STATE_BACKEND, STATE_DIR, STATE_DB_FILE)
+    if isinstance(storage, SqliteStateStorage):
+        # Однократный перенос состояния из JSON-файлов в базу
+        await storage.migrate_from(json_storage)
+    registry = ChatRegistry(storage, message_manager)
+    # Публикации по расписанию идут тем же путём, что и /post
+    scheduler = PostScheduler(storage, lambda chat_id, category: scheduled_post(
+        chat_id, category, registry, message_manager, dispatcher))
+    startup.mark("storage")
     
+    metrics_server = None
+
+    async def on_startup(application: Application) -> None:
+        nonlocal metrics_server
+        # Сюда приложение попадает после initialize (в том числе запроса getMe)
+        startup.mark("initialize")
+        registry.start_autosave()
+        REGISTRY.gauge("bot_startup_seconds", "Длительность этапов последнего запуска бота.", ("phase",),
+                       lambda: {**{(phase,): duration for phase, duration in startup.phases.items()},
+                                **({("first_update",): startup.first_update}
+                                   if startup.first_update is not None else {})})
+        if METRICS_PORT:
+            # tornado подгружается только при включённых метриках
+            from webhook_server import MetricsHandler, WebhookServer
+            register_state_gauges(registry, storage, dispatcher)
+            metrics_server = WebhookServer(application, METRICS_LISTEN, METRICS_PORT, None, WEBHOOK_SECRET,
+                                           extra_handlers=[(r"/metrics", MetricsHandler, {"registry": REGISTRY})])
+            await metrics_server.start()
+        startup.mark("post_init")
+        if BACKLOG_CATCH_UP:
+            # Обновления, накопившиеся пока машина спала, — одной пачкой до начала опроса
+            await catch_up(application, registry, message_manager, dispatcher, BOT_MODE == "webhook")
+            startup.mark("backlog")
+        # Пропущенные за время сна публикации по расписанию выполнятся сразу после запуска JobQueue
+        await scheduler.start(application.job_queue)
+        REGISTRY.gauge("bot_schedules", "Расписания публикаций во всех чатах.", (),
+                       lambda: {(): len(scheduler)})
+        startup.mark("schedules")
+        startup.report()
+
+    async def on_stop(application: Application) -> None:
+        # Новых публикаций по расписанию больше не будет
+        await scheduler.stop()
+        # Бот ещё не закрыт: даём очереди отправки доставить ожидающие сообщения
+        await dispatcher.stop()
+
+    async def on_shutdown(application: Application) -> None:
+        if metrics_server is not None:
+            await metrics_server.stop()
+        # run_polling перехватывает SIGTERM/SIGINT и вызывает этот хук при остановке,
+        # поэтому накопленные изменения не теряются, когда fly.io гасит машину.
+        await registry.stop_autosave()
+        await storage.close()
+        logger.info("Состояние сохранено перед остановкой")
+
     # Создаем приложение Telegram-бота
-    application = Application.builder().token(TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        # Разные чаты обрабатываются параллельно, один чат — по очереди (ChatRegistry.acquire)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    # Сообщения /post уходят через очередь с учётом ограничений Telegram
+    dispatcher = SendDispatcher(application.bot)
+    startup.mark("application")
     
     # Единый обработчик для всех команд, связанных с отправкой сообщений (/post и /post_<category>)
     async def post_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        await post_command_handler(update, context, state_manager, message_manager)
+        await post_command_handler(update, context, registry, message_manager, dispatcher)
     
     # Обработчик для команды /help
     async def help_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await help_command(update, context, message_manager)
+
+    # Обработчик для команды /schedule
+    async def schedule_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        await schedule_command(update, context, scheduler, message_manager)
     
     # Регистрируем обработчики
     application.add_handler(CommandHandler("post", post_handler))
-    for category in message_manager.categories.keys():
-        application.add_handler(CommandHandler(f"post_{category}", post_handler))
     application.add_handler(CommandHandler("help", help_handler))
+    application.add_handler(CommandHandler("schedule", schedule_handler))
+
+    # Обработчики /post_<category> добавляются и удаляются вместе с категориями каталога
+    category_handlers: Dict[str, CommandHandler] = {}
+
+    def sync_category_handlers() -> None:
+        for category in list(category_handlers):
+            if category not in message_manager.categories:
+                application.remove_handler(category_handlers.pop(category))
+        for category in message_manager.categories:
+            if category not in category_handlers:
+                category_handlers[category] = CommandHandler(f"post_{category}", post_handler)
+                application.add_handler(category_handlers[category])
+
+    sync_category_handlers()
+
+    async def reload_catalog(context: ContextTypes.DEFAULT_TYPE) -> None:
+        added, removed, changed = await message_manager.reload()
+        if added or removed or changed:
+            registry.sync_catalog()
+            sync_category_handlers()
+
+    if CATALOG_POLL_INTERVAL > 0:
+        application.job_queue.run_repeating(reload_catalog, interval=CATALOG_POLL_INTERVAL,
+                                            first=CATALOG_POLL_INTERVAL, name="reload_catalog")
     
     # Регистрируем глобальный обработчик ошибок
     application.add_error_handler(global_error_handler)
 
     async def message_tracker(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await track_new_users(update, state_manager)
+        await track_new_users(update, registry)
 
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_tracker))
+
+    async def member_left_tracker(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await track_left_users(update, registry)
+
+    application.add_handler(MessageHandler(filters.StatusUpdate.LEFT_CHAT_MEMBER, member_left_tracker))
+
+    # Группа 1 выполняется после основных обработчиков: отмечаем время до первого ответа
+    async def first_update_marker(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        startup.mark_first_update()
+
+    application.add_handler(TypeHandler(Update, first_update_marker), group=1)
     
-    await application.run_polling()
+    if BOT_MODE == "webhook":
+        await run_webhook(application)
+    else:
+        await application.run_polling()
 
 if __name__ == "__main__":
     # nest_asyncio используется для совместимости в некоторых окружениях (например, Jupyter)
@@ -0,0 +1,7 @@
+import os
+import sys
+from pathlib import Path
+
+# config.py требует TOKEN при импорте; модули бота лежат в корне репозитория
+os.environ.setdefault("TOKEN", "test-token")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,81 @@
+import random
+from collections import Counter
+
+import pytest
+
+from participant_selector import FenwickTree, ParticipantSelector
+
+NOW = 1_700_000_000.0
+DAY = 86400.0
+
+
+def make_selector(**kwargs) -> ParticipantSelector:
+    options = dict(base_weight=1.0, activity_half_life=7 * DAY, pick_half_life=DAY, absence_window=90 * DAY)
+    options.update(kwargs)
+    return ParticipantSelector(**options)
+
+
+def frequencies(selector: ParticipantSelector, picks: int = 20000, seed: int = 1) -> Counter:
+    rng = random.Random(seed)
+    return Counter(selector.choose(NOW, rng) for _ in range(picks))
+
+
+def test_choice_is_proportional_to_base_plus_activity():
+    selector = make_selector()
+    # Веса: 1 + 1 = 2 и 1 + 3 = 4
+    selector.load({"a": [1.0, NOW, NOW, 0.0], "b": [3.0, NOW, NOW, 0.0]}, ["a", "b"], NOW)
+    counts = frequencies(selector)
+    assert counts["b"] / sum(counts.values()) == pytest.approx(2 / 3, abs=0.015)
+
+
+def test_activity_halves_after_half_life():
+    selector = make_selector()
+    selector.add("a", NOW - 7 * DAY)
+    selector.seen("a", NOW)
+    assert selector.stats["a"][0] == pytest.approx(1.5)
+    # Старая активность почти затухла: оба участника весят почти одинаково
+    selector.load({"a": [8.0, NOW - 70 * DAY, NOW, 0.0], "b": [0.0, NOW, NOW, 0.0]}, ["a", "b"], NOW)
+    counts = frequencies(selector)
+    assert counts["a"] / sum(counts.values()) == pytest.approx((1 + 8 / 1024) / (2 + 8 / 1024), abs=0.015)
+
+
+def test_recent_pick_is_penalized():
+    selector = make_selector()
+    selector.load({"a": [0.0, NOW, NOW, NOW - DAY], "b": [0.0, NOW, NOW, 0.0]}, ["a", "b"], NOW)
+    # Выбран сутки назад: вес a умножается на 1 - 2^-1 = 0.5
+    counts = frequencies(selector)
+    assert counts["a"] / sum(counts.values()) == pytest.approx(1 / 3, abs=0.015)
+
+
+def test_excluded_participants_are_never_chosen():
+    selector = make_selector()
+    stats = {
+        "active": [1.0, NOW, NOW, 0.0],
+        "left": [5.0, NOW, 0.0, 0.0],                   # Вышел из чата
+        "absent": [5.0, NOW - 100 * DAY, NOW - 100 * DAY, 0.0],  # Давно не писал
+        "reserved": [5.0, NOW, NOW, 0.0],
+    }
+    selector.load(stats, list(stats), NOW)
+    selector.reserve("reserved", NOW)
+    assert set(frequencies(selector, picks=2000)) == {"active"}
+
+    selector.left("active", NOW)
+    assert selector.choose(NOW, random.Random(1)) is None
+    selector.release("reserved", NOW)
+    assert selector.choose(NOW, random.Random(1)) == "reserved"
+
+
+def test_fenwick_tree_matches_prefix_sums():
+    rng = random.Random(7)
+    weights = [rng.choice([0.0, rng.random() * 10]) for _ in range(57)]
+    tree = FenwickTree(weights[:30])
+    for weight in weights[30:]:
+        tree.append(weight)
+    for _ in range(200):
+        index = rng.randrange(len(weights))
+        weights[index] = rng.random() * 10
+        tree.set(index, weights[index])
+        assert tree.total == pytest.approx(sum(weights))
+        value = rng.random() * sum(weights)
+        found = tree.find(value)
+        assert sum(weights[:found]) <= value + 1e-9 < sum(weights[:found + 1]) + 1e-9
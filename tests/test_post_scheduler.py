@@ -0,0 +1,120 @@
+import asyncio
+from typing import List, Optional, Tuple
+
+import post_scheduler
+from post_scheduler import PostScheduler, SAVE_RETRY_DELAY
+from storage import JsonStateStorage
+
+START = 1_700_000_000.0  # 2023-11-14 22:13:20 UTC
+MINUTE = 60.0
+
+
+class FakeJob:
+    def schedule_removal(self) -> None:
+        pass
+
+
+class FakeJobQueue:
+    """
+    Запоминает, через сколько секунд планировщик просит его разбудить.
+    """
+    def __init__(self) -> None:
+        self.delays: List[float] = []
+
+    def run_once(self, callback, when: float, **kwargs) -> FakeJob:
+        self.delays.append(when)
+        return FakeJob()
+
+
+def make_scheduler(tmp_path, monkeypatch) -> Tuple[PostScheduler, JsonStateStorage, list, list]:
+    clock = [START]
+    monkeypatch.setattr(post_scheduler.time, "time", lambda: clock[0])
+    storage = JsonStateStorage(tmp_path)
+    posts: List[Tuple[str, Optional[str]]] = []
+
+    async def post(chat_id: str, category: Optional[str]) -> None:
+        posts.append((chat_id, category))
+
+    return PostScheduler(storage, post, catch_up_window=3600), storage, posts, clock
+
+
+async def fire(scheduler: PostScheduler) -> None:
+    await scheduler._on_timer(None)
+    await asyncio.sleep(0)  # Даём выполниться созданным задачам публикации
+
+
+def test_last_is_saved_before_posting(tmp_path, monkeypatch):
+    async def main():
+        scheduler, storage, posts, clock = make_scheduler(tmp_path, monkeypatch)
+        await scheduler.start(FakeJobQueue())
+        await scheduler.add("1", "cron * * * * *", "cool")
+
+        clock[0] += MINUTE
+        await fire(scheduler)
+        assert posts == [("1", "cool")]
+        saved = await storage.load_schedules()
+        assert saved["1"]["1"]["last"] == clock[0]
+
+        # После перезапуска та же публикация не повторяется
+        restarted = PostScheduler(storage, scheduler.post, catch_up_window=3600)
+        await restarted.start(FakeJobQueue())
+        await fire(restarted)
+        assert posts == [("1", "cool")]
+    asyncio.run(main())
+
+
+def test_failed_save_defers_post(tmp_path, monkeypatch):
+    async def main():
+        scheduler, storage, posts, clock = make_scheduler(tmp_path, monkeypatch)
+        job_queue = FakeJobQueue()
+        await scheduler.start(job_queue)
+        await scheduler.add("1", "cron * * * * *", None)
+        added_at = clock[0]
+
+        save = storage.save_schedules
+        failures = [True]
+
+        async def flaky_save(changes):
+            if failures.pop(0) if failures else False:
+                return False
+            return await save(changes)
+
+        monkeypatch.setattr(storage, "save_schedules", flaky_save)
+        clock[0] += MINUTE
+        await fire(scheduler)
+        assert posts == []
+        entry = scheduler._chats["1"]["1"]
+        assert entry.record["last"] == added_at
+        assert entry.due == clock[0] + SAVE_RETRY_DELAY
+        assert job_queue.delays[-1] == SAVE_RETRY_DELAY
+        assert (await storage.load_schedules())["1"]["1"]["last"] == added_at
+
+        clock[0] += SAVE_RETRY_DELAY
+        await fire(scheduler)
+        assert posts == [("1", None)]
+        assert (await storage.load_schedules())["1"]["1"]["last"] == clock[0]
+    asyncio.run(main())
+
+
+def test_failed_save_does_not_restore_removed_schedule(tmp_path, monkeypatch):
+    async def main():
+        scheduler, storage, posts, clock = make_scheduler(tmp_path, monkeypatch)
+        await scheduler.start(FakeJobQueue())
+        await scheduler.add("1", "cron * * * * *", None)
+        save = storage.save_schedules
+
+        async def failing_save(changes):
+            # Пока сохранение идёт, расписание удаляют
+            if any(record is not None for _, _, record in changes):
+                monkeypatch.setattr(storage, "save_schedules", save)
+                await scheduler.remove("1", "1")
+                return False
+            return await save(changes)
+
+        monkeypatch.setattr(storage, "save_schedules", failing_save)
+        clock[0] += MINUTE
+        await fire(scheduler)
+        assert posts == []
+        assert "1" not in scheduler._chats
+        assert scheduler._heap == [] or all(entry.due != due for due, _, entry in scheduler._heap)
+    asyncio.run(main())
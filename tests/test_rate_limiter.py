@@ -0,0 +1,33 @@
+import pytest
+
+from rate_limiter import BucketPolicy
+
+
+@pytest.mark.parametrize("spec", ["", "   ", "0:900", "-1:5"])
+def test_parse_disabled(spec):
+    assert BucketPolicy.parse(spec) is None
+
+
+def test_parse_valid():
+    policy = BucketPolicy.parse(" 2:900 ")
+    assert (policy.capacity, policy.refill_seconds) == (2.0, 900.0)
+
+
+@pytest.mark.parametrize("spec", ["1", "1:2:3", "a:b", ":", "1:", "1:0", "1:-5", "1:nan", "inf:1"])
+def test_parse_rejects_invalid(spec):
+    with pytest.raises(ValueError, match="RATE_LIMIT_CHAT"):
+        BucketPolicy.parse(spec, "RATE_LIMIT_CHAT")
+
+
+def test_bucket_refills_one_token_per_interval():
+    policy = BucketPolicy(2, 10)
+    bucket = policy.take(None, 100.0)
+    assert bucket == [1.0, 100.0, 110.0]
+    assert policy.wait_time(bucket, 100.0) == 0.0
+
+    bucket = policy.take(bucket, 100.0)
+    assert policy.tokens_at(bucket, 100.0) == 0.0
+    assert policy.wait_time(bucket, 100.0) == 10.0
+    assert policy.wait_time(bucket, 104.0) == pytest.approx(6.0)
+    assert bucket[2] == 120.0  # Полная корзина — через два интервала
+    assert policy.tokens_at(bucket, 1000.0) == 2.0  # Не больше ёмкости
@@ -0,0 +1,112 @@
+import hmac
+import json
+import logging
+from typing import Any, List, Optional, Tuple
+import tornado.web
+from tornado.httpserver import HTTPServer
+from telegram import Update
+from telegram.ext import Application
+from metrics import MetricsRegistry
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+class WebhookHandler(tornado.web.RequestHandler):
+    """
+    Принимает обновления от Telegram и кладёт их в очередь приложения.
+
+    Запрос без правильного заголовка X-Telegram-Bot-Api-Secret-Token отклоняется.
+    Для локальной проверки достаточно отправить сохранённый JSON обновления:
+
+        curl -X POST -H "X-Telegram-Bot-Api-Secret-Token: <secret>" \\
+             -d @update.json http://localhost:8080/telegram
+    """
+    def initialize(self, bot_app: Application, secret_token: str) -> None:
+        self.bot_app = bot_app
+        self.secret_token = secret_token
+
+    async def post(self) -> None:
+        received = self.request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(received.encode(), self.secret_token.encode()):
+            logger.warning(f"Отклонён запрос к вебхуку с неверным токеном от {self.request.remote_ip}")
+            raise tornado.web.HTTPError(403)
+        try:
+            data = json.loads(self.request.body)
+        except json.JSONDecodeError as e:
+            logger.warning(f"Вебхук получил некорректный JSON: {e}")
+            raise tornado.web.HTTPError(400)
+        update = Update.de_json(data, self.bot_app.bot)
+        if update is None:
+            raise tornado.web.HTTPError(400)
+        await self.bot_app.update_queue.put(update)
+        self.set_status(200)
+
+    def log_exception(self, typ: Any, value: Any, tb: Any) -> None:
+        # HTTPError (403/400) — ожидаемая ситуация, трассировка в лог не нужна
+        if not isinstance(value, tornado.web.HTTPError):
+            super().log_exception(typ, value, tb)
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    """
+    Проверка живости для fly.io: 200, пока приложение запущено.
+    """
+    def initialize(self, bot_app: Application) -> None:
+        self.bot_app = bot_app
+
+    def get(self) -> None:
+        if not self.bot_app.running:
+            self.set_status(503)
+        self.set_header("Content-Type", "application/json")
+        self.finish({"status": "ok" if self.bot_app.running else "stopped"})
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    Метрики бота в текстовом формате Prometheus (см. metrics.py).
+    """
+    def initialize(self, registry: MetricsRegistry) -> None:
+        self.registry = registry
+
+    def get(self) -> None:
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.finish(self.registry.render())
+
+
+class WebhookServer:
+    """
+    HTTP-сервер бота: вебхук Telegram на url_path и проверка живости на /healthz.
+    Дополнительные маршруты (например, метрики) передаются через extra_handlers.
+    """
+    def __init__(self, application: Application, listen: str, port: int,
+                 url_path: Optional[str], secret_token: str,
+                 extra_handlers: Optional[List[Tuple[str, Any, dict]]] = None) -> None:
+        self.listen = listen
+        self.port = port
+        handlers: List[Tuple[str, Any, dict]] = [
+            (r"/healthz", HealthHandler, {"bot_app": application}),
+        ]
+        if url_path is not None:
+            handlers.append((rf"/{url_path.strip('/')}", WebhookHandler,
+                             {"bot_app": application, "secret_token": secret_token}))
+        handlers.extend(extra_handlers or [])
+        self._app = tornado.web.Application(handlers)
+        self._server: Optional[HTTPServer] = None
+
+    async def start(self) -> None:
+        """
+        Начинает принимать HTTP-запросы.
+        """
+        self._server = HTTPServer(self._app, xheaders=True)
+        self._server.listen(self.port, address=self.listen)
+        logger.info(f"HTTP-сервер слушает {self.listen}:{self.port}")
+
+    async def stop(self) -> None:
+        """
+        Прекращает приём запросов и дожидается завершения текущих.
+        """
+        if self._server is not None:
+            self._server.stop()
+            await self._server.close_all_connections()
+            self._server = None